@@ -0,0 +1,361 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A local stand-in for the GitHub Actions OIDC token endpoint, for benchmarks.
+"""
+
+from __future__ import annotations
+
+import base64
+import json
+import math
+import os
+import socket
+import ssl
+import subprocess
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+from urllib.parse import parse_qs, urlparse
+
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def make_token(audience: str, lifetime: int = 300) -> str:
+    """
+    Build an unsigned, GitHub-shaped JWT for `audience`.
+    """
+    header = _b64(json.dumps({"alg": "RS256", "typ": "JWT"}).encode())
+    payload = _b64(
+        json.dumps(
+            {
+                "iss": "https://token.actions.githubusercontent.com",
+                "sub": "repo:example/example:ref:refs/heads/main",
+                "aud": audience,
+                "exp": int(time.time()) + lifetime,
+            }
+        ).encode()
+    )
+    return f"{header}.{payload}.{_b64(b'signature')}"
+
+
+class Issuer:
+    """
+    A threaded HTTP server answering GitHub-style token requests after
+    `latency()` seconds, and counting the requests and connections it sees.
+
+    If `throttle()` returns a number of seconds, the request is instead
+    refused with a `429` and that `Retry-After`. If `junk()` returns a number
+    of bytes, the request is instead answered with a `502` and that much body,
+    without a `Content-Length`, like a misbehaving proxy.
+    """
+
+    def __init__(
+        self,
+        latency: Callable[[], float] = lambda: 0.0,
+        ssl_context: ssl.SSLContext | None = None,
+        throttle: Callable[[], float | None] = lambda: None,
+        junk: Callable[[], int | None] = lambda: None,
+    ) -> None:
+        self.latency = latency
+        self.throttle = throttle
+        self.junk = junk
+        self.throttled = 0
+        self.requests = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+        issuer = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately; without this, each
+            # response waits out the client's delayed ACK.
+            disable_nagle_algorithm = True
+
+            def setup(self) -> None:
+                super().setup()
+                with issuer._lock:
+                    issuer.connections += 1
+
+            def do_GET(self) -> None:
+                with issuer._lock:
+                    issuer.requests += 1
+                retry_after = issuer.throttle()
+                if retry_after is not None:
+                    with issuer._lock:
+                        issuer.throttled += 1
+                    self.send_response(429)
+                    self.send_header("Retry-After", str(math.ceil(retry_after)))
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                junk = issuer.junk()
+                if junk is not None:
+                    self._send_junk(junk)
+                    return
+                time.sleep(issuer.latency())
+                audience = parse_qs(urlparse(self.path).query)["audience"][0]
+                body = json.dumps({"value": make_token(audience)}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _send_junk(self, size: int) -> None:
+                self.send_response(502)
+                self.send_header("Connection", "close")
+                self.end_headers()
+                chunk = b"<html>Bad Gateway</html>\n" * 4096
+                try:
+                    while size > 0:
+                        self.wfile.write(chunk[:size])
+                        size -= len(chunk)
+                except OSError:
+                    # The client hung up without reading everything.
+                    pass
+                self.close_connection = True
+
+            def log_message(self, format: str, *args: object) -> None:
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        port = self._server.server_address[1]
+        if ssl_context is not None:
+            self._server.socket = ssl_context.wrap_socket(self._server.socket, server_side=True)
+            self.url = f"https://localhost:{port}/token"
+        else:
+            self.url = f"http://127.0.0.1:{port}/token"
+
+    def __enter__(self) -> Issuer:
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def use_github(url: str) -> None:
+    """
+    Point the GitHub detector at `url`, and disable every other detector.
+    """
+    for var in ("GOOGLE_SERVICE_ACCOUNT_NAME", "BUILDKITE", "GITLAB_CI", "CIRCLECI"):
+        os.environ.pop(var, None)
+    for var in [v for v in os.environ if v.endswith("_ID_TOKEN_FILE")]:
+        del os.environ[var]
+    os.environ["GITHUB_ACTIONS"] = "true"
+    os.environ["ACTIONS_ID_TOKEN_REQUEST_TOKEN"] = "bench"
+    os.environ["ACTIONS_ID_TOKEN_REQUEST_URL"] = url
+
+
+def self_signed_context(directory: str) -> ssl.SSLContext:
+    """
+    Create a server context with a throwaway certificate for `localhost`, and
+    make it trusted by clients in this process via `SSL_CERT_FILE`.
+    """
+    cert, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1"]
+        + ["-keyout", key, "-out", cert, "-subj", "/CN=localhost"]
+        + ["-addext", "subjectAltName=DNS:localhost"],
+        check=True,
+        capture_output=True,
+    )
+    os.environ["SSL_CERT_FILE"] = cert
+
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert, key)
+    return context
+
+
+class H2Reply:
+    """
+    The answer to one request on an `H2Server`.
+    """
+
+    def __init__(self, server: H2Server, conn: H2ServerConnection, stream_id: int) -> None:
+        self._server = server
+        self._conn = conn
+        self.stream_id = stream_id
+
+    def send(self, body: bytes, *, status: int = 200, end_stream: bool = True) -> None:
+        """
+        Answer with `body`; without `end_stream`, the response never finishes.
+        """
+        with self._conn.lock:
+            self._conn.h2.send_headers(
+                self.stream_id, [(":status", str(status)), ("content-type", "application/json")]
+            )
+            self._conn.h2.send_data(self.stream_id, body, end_stream=end_stream)
+            self._server.finished()
+            self._conn.flush()
+
+    def reset(self) -> None:
+        """
+        Answer with `RST_STREAM`.
+        """
+        with self._conn.lock:
+            self._conn.h2.reset_stream(self.stream_id)
+            self._server.finished()
+            self._conn.flush()
+
+
+class H2ServerConnection:
+    """
+    One client connection to an `H2Server`.
+    """
+
+    def __init__(self, sock: ssl.SSLSocket, max_concurrent_streams: int) -> None:
+        import h2.config
+        import h2.connection
+        import h2.settings
+
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.h2 = h2.connection.H2Connection(
+            config=h2.config.H2Configuration(client_side=False, header_encoding=None)
+        )
+        with self.lock:
+            self.h2.initiate_connection()
+            self.h2.update_settings(
+                {h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS: max_concurrent_streams}
+            )
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Send whatever the connection has queued; call with `lock` held.
+        """
+        data = self.h2.data_to_send()
+        if data:
+            self.sock.sendall(data)
+
+    def terminate(self) -> None:
+        """
+        Close the connection with `GOAWAY`.
+        """
+        with self.lock:
+            self.h2.close_connection()
+            self.flush()
+
+
+class H2Server:
+    """
+    A minimal HTTP/2-only server. `handler(reply, path)` is called on a thread
+    of its own for every request, and answers through `reply`; the server
+    notes the connections, paths, and stream resets it sees.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[H2Reply, str], None],
+        ssl_context: ssl.SSLContext,
+        max_concurrent_streams: int = 100,
+    ) -> None:
+        ssl_context.set_alpn_protocols(["h2"])
+        self._context = ssl_context
+        self._handler = handler
+        self._max_concurrent_streams = max_concurrent_streams
+        self._lock = threading.Lock()
+
+        self.connections: list[H2ServerConnection] = []
+        self.paths: list[str] = []
+        self.resets: list[int] = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+        self._listener = socket.create_server(("127.0.0.1", 0))
+        self.url = f"https://localhost:{self._listener.getsockname()[1]}"
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def __enter__(self) -> H2Server:
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.close()
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                sock, _ = self._listener.accept()
+                sock = self._context.wrap_socket(sock, server_side=True)
+            except OSError:
+                return
+            conn = H2ServerConnection(sock, self._max_concurrent_streams)
+            self.connections.append(conn)
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn: H2ServerConnection) -> None:
+        import h2.events
+        import h2.exceptions
+
+        try:
+            while data := conn.sock.recv(65535):
+                with conn.lock:
+                    for event in conn.h2.receive_data(data):
+                        if isinstance(event, h2.events.RequestReceived):
+                            path = dict(event.headers)[b":path"].decode()
+                            with self._lock:
+                                self.paths.append(path)
+                                self.in_flight += 1
+                                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+                            reply = H2Reply(self, conn, event.stream_id)
+                            threading.Thread(
+                                target=self._handler, args=(reply, path), daemon=True
+                            ).start()
+                        elif isinstance(event, h2.events.StreamReset):
+                            self.resets.append(event.stream_id)
+                    conn.flush()
+        except (OSError, h2.exceptions.ProtocolError):
+            pass
+        finally:
+            conn.sock.close()
+
+    def finished(self) -> None:
+        """
+        Note that a request has been answered.
+        """
+        with self._lock:
+            self.in_flight -= 1
+
+    def close(self) -> None:
+        """
+        Stop accepting connections, and close every open one.
+        """
+        self._listener.close()
+        for conn in self.connections:
+            conn.sock.close()
+
+
+class H2Issuer(H2Server):
+    """
+    An HTTP/2-only stand-in for the GitHub token endpoint, answering each
+    stream after `latency()` seconds.
+    """
+
+    def __init__(self, latency: Callable[[], float], ssl_context: ssl.SSLContext) -> None:
+        self.latency = latency
+        super().__init__(self._respond, ssl_context)
+        self.url += "/token"
+
+    def _respond(self, reply: H2Reply, path: str) -> None:
+        time.sleep(self.latency())
+        audience = parse_qs(urlparse(path).query)["audience"][0]
+        reply.send(json.dumps({"value": make_token(audience)}).encode())
@@ -0,0 +1,91 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Claim queries over an archive, compared with re-decoding every token.
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import json
+import os
+import tempfile
+import time
+
+from id import TokenArchive, build_archive, decode_oidc_token
+
+
+def _b64(obj: object) -> str:
+    return base64.urlsafe_b64encode(json.dumps(obj).encode()).decode().rstrip("=")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--tokens", type=int, default=200_000)
+    parser.add_argument("--repositories", type=int, default=1000)
+    args = parser.parse_args()
+
+    header = _b64({"alg": "RS256", "typ": "JWT"})
+    tokens = [
+        f"{header}."
+        + _b64(
+            {
+                "iss": "https://token.actions.githubusercontent.com",
+                "sub": f"repo:org/repo{i % args.repositories}:ref:refs/heads/main",
+                "repository": f"org/repo{i % args.repositories}",
+                "aud": "pypi",
+                "exp": 1_700_000_000 + i,
+            }
+        )
+        + ".signature"
+        for i in range(args.tokens)
+    ]
+
+    path = os.path.join(tempfile.mkdtemp(), "tokens.idar")
+    start = time.perf_counter()
+    build_archive(tokens, path)
+    build = time.perf_counter() - start
+
+    target = "org/repo7"
+
+    start = time.perf_counter()
+    scanned = [
+        claims
+        for claims in (json.loads(decode_oidc_token(token)[1]) for token in tokens)
+        if claims["repository"] == target
+    ]
+    scan = time.perf_counter() - start
+
+    with TokenArchive(path) as archive:
+        start = time.perf_counter()
+        indexed = list(archive.query(repository=target))
+        query = time.perf_counter() - start
+
+        start = time.perf_counter()
+        ranged = list(archive.query(exp_min=1_700_000_000, exp_max=1_700_000_099))
+        exp_query = time.perf_counter() - start
+
+    assert scanned == indexed and len(ranged) == 100
+
+    print(f"{args.tokens} tokens, {os.path.getsize(path) / 2**20:.1f} MiB archive")
+    print(f"{'build archive':<28}{build * 1000:>12.1f} ms")
+    print(f"{'re-decode and filter':<28}{scan * 1000:>12.1f} ms ({len(scanned)} matches)")
+    print(f"{'archive query repository':<28}{query * 1000:>12.3f} ms")
+    print(f"{'archive query exp range':<28}{exp_query * 1000:>12.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
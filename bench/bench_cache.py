@@ -0,0 +1,79 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Issuer load from many runner processes minting the same audiences, with and
+without a shared SQLite cache.
+
+Each of `--runners` processes mints credentials for the same `--audiences`,
+`--rounds` times over, from a local GitHub-style issuer answering after
+`--latency` seconds.
+"""
+
+from __future__ import annotations
+
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+
+import _issuer
+
+import id
+
+
+def _runner(url: str, audiences: int, rounds: int, cache_path: str | None) -> None:
+    _issuer.use_github(url)
+    cache = id.SqliteTokenCache(cache_path, plaintext=True) if cache_path is not None else None
+    with id.Session(cache=cache) as session:
+        for _ in range(rounds):
+            for i in range(audiences):
+                assert session.detect_credential(f"audience-{i}")
+
+
+def _run(args: argparse.Namespace, issuer: _issuer.Issuer, cache_path: str | None) -> None:
+    issuer.requests = 0
+    start = time.perf_counter()
+    runners = [
+        multiprocessing.Process(
+            target=_runner, args=(issuer.url, args.audiences, args.rounds, cache_path)
+        )
+        for _ in range(args.runners)
+    ]
+    for runner in runners:
+        runner.start()
+    for runner in runners:
+        runner.join()
+    elapsed = time.perf_counter() - start
+
+    name = "shared cache" if cache_path is not None else "no cache"
+    print(f"{name:<16}{elapsed:>8.2f} s{issuer.requests:>8} issuer requests")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runners", type=int, default=8)
+    parser.add_argument("--audiences", type=int, default=10)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.05)
+    args = parser.parse_args()
+
+    with _issuer.Issuer(lambda: args.latency) as issuer, tempfile.TemporaryDirectory() as tmp:
+        _run(args, issuer, None)
+        _run(args, issuer, os.path.join(tmp, "cache.db"))
+
+
+if __name__ == "__main__":
+    main()
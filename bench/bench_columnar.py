@@ -0,0 +1,130 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Fleet analytics over decoded claims: per-token dicts versus columns.
+
+Both variants decode `--tokens` synthetic tokens once, then run `--queries`
+rounds of analytics: counting the distinct (repository, audience) pairs and
+taking the median lifetime per issuer. The "dicts" variant keeps the claim
+dicts from `decode_oidc_token` and loops over them; the "columns" variant
+keeps the columns from `decode_columns` and queries them with NumPy.
+
+Decoding is dominated by parsing each token's JSON in both variants; the
+columns are what make the queries fast, and small to keep around.
+
+Requires NumPy (`pip install id[columnar]`).
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import collections
+import json
+import random
+import statistics
+import time
+from typing import Any, Callable
+
+import numpy
+
+import id
+
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def _tokens(count: int) -> list[str]:
+    rng = random.Random(0)
+    issuers = ["https://token.actions.githubusercontent.com", "https://gitlab.com"]
+    header = _b64(json.dumps({"alg": "RS256", "typ": "JWT"}).encode())
+    tokens = []
+    for _ in range(count):
+        iat = 1_700_000_000 + rng.randrange(10**6)
+        repository = f"org/repo-{rng.randrange(500)}"
+        claims = {
+            "iss": rng.choice(issuers),
+            "sub": f"repo:{repository}:ref:refs/heads/main",
+            "aud": rng.choice(["pypi", "sigstore", "npm"]),
+            "repository": repository,
+            "iat": iat,
+            "nbf": iat,
+            "exp": iat + rng.choice([300, 600, 3600]),
+        }
+        tokens.append(f"{header}.{_b64(json.dumps(claims).encode())}.{_b64(b'signature')}")
+    return tokens
+
+
+def _decode_dicts(tokens: list[str]) -> list[dict[str, Any]]:
+    return [json.loads(id.decode_oidc_token(token)[1]) for token in tokens]
+
+
+def _query_dicts(claims: list[dict[str, Any]]) -> Any:
+    pairs = {(c.get("repository"), c.get("aud")) for c in claims}
+    lifetimes: dict[str, list[int]] = collections.defaultdict(list)
+    for c in claims:
+        lifetimes[c["iss"]].append(c["exp"] - c["iat"])
+    return len(pairs), {iss: statistics.median(values) for iss, values in lifetimes.items()}
+
+
+def _query_columns(columns: id.ClaimColumns) -> Any:
+    arrays = columns.to_numpy()
+    # One number per (repository, audience) pair.
+    pairs = arrays["repository"].astype(numpy.int64) * len(columns.values["aud"]) + arrays["aud"]
+    lifetimes = arrays["exp"] - arrays["iat"]
+    return len(numpy.unique(pairs)), {
+        iss: numpy.median(lifetimes[arrays["iss"] == code])
+        for code, iss in enumerate(columns.values["iss"])
+    }
+
+
+def _run(
+    name: str,
+    decode: Callable[[list[str]], Any],
+    query: Callable[[Any], Any],
+    tokens: list[str],
+    queries: int,
+) -> Any:
+    start = time.perf_counter()
+    decoded = decode(tokens)
+    decoding = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(queries):
+        result = query(decoded)
+    querying = (time.perf_counter() - start) / queries
+
+    print(
+        f"{name:<10}{len(tokens) / decoding:>12,.0f} tokens/s decoded"
+        f"{querying * 1000:>10.1f} ms/query"
+    )
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--tokens", type=int, default=200_000)
+    parser.add_argument("--queries", type=int, default=10)
+    args = parser.parse_args()
+
+    tokens = _tokens(args.tokens)
+    expected = _run("dicts", _decode_dicts, _query_dicts, tokens, args.queries)
+    actual = _run("columns", id.decode_columns, _query_columns, tokens, args.queries)
+    assert expected == actual, "the variants disagree"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+`detect_credential` latency percentiles against a long-tailed issuer, with
+and without hedged requests.
+
+A local GitHub-style issuer answers after `--latency` seconds, except for a
+`--tail` fraction of requests that take `--slow` seconds instead.
+"""
+
+from __future__ import annotations
+
+import argparse
+import random
+import statistics
+import time
+
+import _issuer
+
+import id
+
+
+def _run(requests: int) -> list[float]:
+    latencies = []
+    for i in range(requests):
+        start = time.perf_counter()
+        assert id.detect_credential(f"audience-{i}")
+        latencies.append(time.perf_counter() - start)
+    return sorted(latencies)
+
+
+def _report(name: str, latencies: list[float]) -> None:
+    p50 = statistics.median(latencies)
+    p99 = latencies[int(len(latencies) * 0.99)]
+    print(f"{name:<12}{p50 * 1000:>10.1f} ms p50{p99 * 1000:>10.1f} ms p99")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--latency", type=float, default=0.01)
+    parser.add_argument("--slow", type=float, default=0.5)
+    parser.add_argument("--tail", type=float, default=0.03)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+
+    def latency() -> float:
+        return args.slow if rng.random() < args.tail else args.latency
+
+    with _issuer.Issuer(latency) as issuer:
+        _issuer.use_github(issuer.url)
+
+        _report("unhedged", _run(args.requests))
+
+        policy = id.HedgingPolicy(percentile=0.9)
+        id.configure(hedging=policy)
+        _report("hedged", _run(args.requests))
+
+    (stats,) = policy.stats().values()
+    print(
+        f"hedges fired {stats['hedged']}/{stats['requests']}, won {stats['hedge_wins']}, "
+        f"delay {stats['delay'] * 1000:.1f} ms; issuer saw {issuer.requests} requests"
+    )
+
+
+if __name__ == "__main__":
+    main()
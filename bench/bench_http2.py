@@ -0,0 +1,88 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Concurrent minting of many audiences from one issuer, over HTTP/1.1 and HTTP/2.
+
+Requires `h2` (`pip install id[http2]`) and the `openssl` CLI, which is used
+to create a throwaway certificate for the local TLS stand-ins.
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import _issuer
+
+import id
+
+
+def _mint_all(audiences: list[str], concurrency: int) -> list[float]:
+    # A fresh session per transport: `ID_HTTP2` is read when it's created.
+    with id.Session() as session:
+
+        def mint(audience: str) -> float:
+            start = time.perf_counter()
+            assert session.detect_credential(audience)
+            return time.perf_counter() - start
+
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            return list(pool.map(mint, audiences))
+
+
+def _report(name: str, latencies: list[float], connections: int) -> None:
+    latencies = sorted(latencies)
+    p50 = statistics.median(latencies)
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(
+        f"{name:<10}{connections:>13}{p50 * 1000:>10.1f}{p99 * 1000:>10.1f}"
+        f"{latencies[-1] * 1000:>10.1f}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--audiences", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--latency", type=float, default=0.02)
+    args = parser.parse_args()
+
+    def latency() -> float:
+        return random.expovariate(1 / args.latency)
+
+    audiences = [f"aud-{i}" for i in range(args.audiences)]
+    context = _issuer.self_signed_context(tempfile.mkdtemp())
+
+    print(f"{args.audiences} audiences, {args.concurrency} concurrent mints")
+    print(f"{'transport':<10}{'connections':>13}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+
+    os.environ.pop("ID_HTTP2", None)
+    with _issuer.Issuer(latency, ssl_context=context) as issuer:
+        _issuer.use_github(issuer.url)
+        _report("HTTP/1.1", _mint_all(audiences, args.concurrency), issuer.connections)
+
+    os.environ["ID_HTTP2"] = "1"
+    with _issuer.H2Issuer(latency, ssl_context=context) as h2issuer:
+        _issuer.use_github(h2issuer.url)
+        _report("HTTP/2", _mint_all(audiences, args.concurrency), len(h2issuer.connections))
+
+
+if __name__ == "__main__":
+    main()
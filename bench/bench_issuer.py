@@ -0,0 +1,54 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Minting throughput of the local test issuer, one token at a time and batched.
+
+Requires `cryptography` (`pip install id[issuer]`).
+"""
+
+from __future__ import annotations
+
+import argparse
+import time
+
+from id import LocalIssuer
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--tokens", type=int, default=5000)
+    parser.add_argument("--batch", type=int, default=500)
+    args = parser.parse_args()
+
+    print(f"{'algorithm':<12}{'mode':<10}{'tokens/s':>12}")
+    for algorithm in ("ES256", "RS256"):
+        issuer = LocalIssuer(algorithm=algorithm)
+
+        start = time.perf_counter()
+        for _ in range(args.tokens):
+            issuer.mint("bench")
+        single = args.tokens / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for _ in range(args.tokens // args.batch):
+            issuer.mint_batch("bench", args.batch)
+        batched = (args.tokens // args.batch * args.batch) / (time.perf_counter() - start)
+
+        print(f"{algorithm:<12}{'single':<10}{single:>12,.0f}")
+        print(f"{algorithm:<12}{'batched':<10}{batched:>12,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Peak memory allocated per mint, against a well-behaved issuer and against
+one answering with a huge error body.
+
+Each of `--mints` mints is measured with `tracemalloc`; the misbehaving issuer
+answers every request with a `502` and `--junk` bytes of body.
+"""
+
+from __future__ import annotations
+
+import argparse
+import statistics
+import tracemalloc
+
+import _issuer
+
+import id
+
+
+def _mint(audience: str) -> tuple[int, int]:
+    """
+    Mint a credential, returning the peak bytes allocated while doing so and
+    the length of the resulting credential or error message.
+    """
+    tracemalloc.reset_peak()
+    start, _ = tracemalloc.get_traced_memory()
+    try:
+        result = id.detect_credential(audience) or ""
+    except id.AmbientCredentialError as e:
+        result = str(e)
+    _, peak = tracemalloc.get_traced_memory()
+    return peak - start, len(result)
+
+
+def _run(name: str, issuer: _issuer.Issuer, mints: int) -> None:
+    _issuer.use_github(issuer.url)
+    _mint("warmup")
+
+    peaks, lengths = zip(*(_mint(f"audience-{i}") for i in range(mints)))
+    print(
+        f"{name:<12}{statistics.median(peaks) / 1024:>12.1f} KiB/mint"
+        f"{max(peaks) / 1024:>12.1f} KiB max{max(lengths):>12} chars"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--mints", type=int, default=50)
+    parser.add_argument("--junk", type=int, default=64 * 1024 * 1024)
+    args = parser.parse_args()
+
+    tracemalloc.start()
+    with _issuer.Issuer() as issuer:
+        _run("ok", issuer, args.mints)
+    with _issuer.Issuer(junk=lambda: args.junk) as issuer:
+        _run("junk", issuer, args.mints)
+    tracemalloc.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+First-call `detect_credential` latency, with and without `prefetch`.
+
+A local GitHub-style issuer answers after `--latency` seconds; in the warmed
+run, `prefetch` is called at "startup" and the first credential is requested
+after `--work` seconds of other work.
+"""
+
+from __future__ import annotations
+
+import argparse
+import time
+
+import _issuer
+
+import id
+
+
+def _first_call(audience: str) -> float:
+    start = time.perf_counter()
+    assert id.detect_credential(audience)
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--latency", type=float, default=0.15)
+    parser.add_argument("--work", type=float, default=0.5)
+    args = parser.parse_args()
+
+    with _issuer.Issuer(lambda: args.latency) as issuer:
+        _issuer.use_github(issuer.url)
+
+        cold = _first_call("cold")
+
+        id.prefetch(["warm"])
+        time.sleep(args.work)
+        warm = _first_call("warm")
+
+    print(f"issuer latency {args.latency * 1000:.0f} ms, startup work {args.work * 1000:.0f} ms")
+    print(f"{'first call (cold)':<24}{cold * 1000:>10.2f} ms")
+    print(f"{'first call (prefetched)':<24}{warm * 1000:>10.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
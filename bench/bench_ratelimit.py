@@ -0,0 +1,108 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Minting many credentials from many threads against an issuer with a quota,
+with and without a client-side `RateLimiter`.
+
+The issuer allows `--quota` requests per second. Like GitHub's secondary rate
+limits, exceeding it refuses every request for a `--penalty` period, with a
+`429` and a matching `Retry-After`. Without a limiter, threads back off for
+the `Retry-After` and try again, as a careful caller would.
+"""
+
+from __future__ import annotations
+
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import _issuer
+
+import id
+
+
+class _Quota:
+    def __init__(self, rate: float, penalty: float) -> None:
+        self.rate = rate
+        self.penalty = penalty
+        self._lock = threading.Lock()
+        self._window = 0
+        self._count = 0
+        self._blocked_until = 0.0
+
+    def __call__(self) -> float | None:
+        with self._lock:
+            now = time.monotonic()
+            if now < self._blocked_until:
+                return self._blocked_until - now
+            if int(now) != self._window:
+                self._window, self._count = int(now), 0
+            self._count += 1
+            if self._count > self.rate:
+                self._blocked_until = now + self.penalty
+                return self.penalty
+            return None
+
+
+# The unlimited run's callers don't see response headers, so they back off for
+# the issuer's penalty period.
+_retry_after = 0.0
+
+
+def _mint(audience: str) -> None:
+    while True:
+        try:
+            assert id.detect_credential(audience)
+            return
+        except id.AmbientCredentialError:
+            time.sleep(_retry_after)
+
+
+def _run(threads: int, requests: int, issuer: _issuer.Issuer, name: str) -> None:
+    issuer.requests = issuer.throttled = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(_mint, (f"{name}-{i}" for i in range(requests))))
+    elapsed = time.perf_counter() - start
+    print(
+        f"{name:<12}{elapsed:>8.2f} s{issuer.requests:>8} requests{issuer.throttled:>8} throttled"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--quota", type=float, default=100)
+    parser.add_argument("--penalty", type=float, default=2.0)
+    args = parser.parse_args()
+
+    global _retry_after
+    _retry_after = args.penalty
+
+    with _issuer.Issuer(throttle=_Quota(args.quota, args.penalty)) as issuer:
+        _issuer.use_github(issuer.url)
+
+        _run(args.threads, args.requests, issuer, "unlimited")
+        time.sleep(args.penalty)
+
+        # Stay just under the quota, and let the issuer absorb a short burst.
+        id.configure(rate_limits={"GitHub": id.RateLimiter(args.quota * 0.9, burst=10)})
+        _run(args.threads, args.requests, issuer, "limited")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Minting from a live issuer while recording a cassette, versus replaying it.
+
+`--mints` credentials (one per audience) are minted from a local GitHub-style
+issuer that answers after `--latency` milliseconds, recording a cassette. The
+cassette is then replayed with the issuer stopped and the GitHub Actions
+environment cleared: at full speed, and with the recorded latencies.
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import tempfile
+import time
+
+import _issuer
+
+import id
+
+
+def _mint(name: str, mints: int) -> None:
+    # A fresh session, so that every credential is minted rather than cached.
+    with id.Session() as session:
+        start = time.perf_counter()
+        for i in range(mints):
+            assert session.detect_credential(f"audience-{i}")
+        elapsed = time.perf_counter() - start
+    print(f"{name:<20}{mints / elapsed:>12,.0f} mints/s{elapsed / mints * 1000:>10.2f} ms/mint")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--mints", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=5.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "cassette.json")
+
+        with _issuer.Issuer(lambda: args.latency / 1000) as issuer:
+            _issuer.use_github(issuer.url)
+            with id.record(path):
+                _mint("live (recording)", args.mints)
+
+        for var in (
+            "GITHUB_ACTIONS",
+            "ACTIONS_ID_TOKEN_REQUEST_TOKEN",
+            "ACTIONS_ID_TOKEN_REQUEST_URL",
+        ):
+            del os.environ[var]
+        with id.replay(path):
+            _mint("replayed", args.mints)
+        with id.replay(path, latency=1.0):
+            _mint("replayed, latency", args.mints)
+
+
+if __name__ == "__main__":
+    main()
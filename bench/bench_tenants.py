@@ -0,0 +1,107 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Minting for many tenants from one process, versus a subprocess per tenant.
+
+Each of `--tenants` tenants has a GitHub Actions environment of its own,
+pointing at a local issuer that answers after `--latency` milliseconds. The
+in-process variant mints every tenant's credential from one `Session`, on
+`--jobs` threads, passing each tenant's environment as `env`; the other runs
+`python -m id` once per tenant, `--jobs` at a time, with the tenant's
+environment as the child's.
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+import _issuer
+
+import id
+
+_AUDIENCE = "bench"
+
+
+def _tenants(url: str, count: int) -> list[dict[str, str]]:
+    return [
+        {
+            "GITHUB_ACTIONS": "true",
+            "ACTIONS_ID_TOKEN_REQUEST_TOKEN": f"tenant-{i}",
+            "ACTIONS_ID_TOKEN_REQUEST_URL": f"{url}?tenant={i}",
+        }
+        for i in range(count)
+    ]
+
+
+def _in_process(session: id.Session) -> Callable[[dict[str, str]], object]:
+    return lambda env: session.detect_credential(_AUDIENCE, env=env)
+
+
+def _subprocess(env: dict[str, str]) -> object:
+    # The child needs enough of our environment to start Python at all.
+    base = {var: os.environ[var] for var in ("PATH", "PYTHONPATH") if var in os.environ}
+    return subprocess.run(
+        [sys.executable, "-m", "id", _AUDIENCE],
+        env={**base, **env},
+        capture_output=True,
+        check=True,
+    )
+
+
+def _run(
+    name: str, mint: Callable[[dict[str, str]], object], tenants: list[dict[str, str]], jobs: int
+) -> None:
+    latencies: list[float] = []
+
+    def timed(env: dict[str, str]) -> None:
+        start = time.perf_counter()
+        mint(env)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(jobs) as pool:
+        list(pool.map(timed, tenants))
+    elapsed = time.perf_counter() - start
+
+    print(
+        f"{name:<12}{len(tenants) / elapsed:>12,.0f} tenants/s"
+        f"{statistics.median(latencies) * 1000:>10.1f} ms p50"
+        f"{max(latencies) * 1000:>10.1f} ms max"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--tenants", type=int, default=200)
+    parser.add_argument("--jobs", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=5.0)
+    args = parser.parse_args()
+
+    with _issuer.Issuer(latency=lambda: args.latency / 1000) as issuer:
+        tenants = _tenants(issuer.url, args.tenants)
+        with id.Session(pool_maxsize=args.jobs) as session:
+            _run("in-process", _in_process(session), tenants, args.jobs)
+        _run("subprocess", _subprocess, tenants, args.jobs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Thread-scaling benchmark for token decoding, validation and in-memory minting.
+
+Run it on both a regular and a free-threaded (`python3.13t`) interpreter:
+
+    python bench/bench_threads.py --threads 8 --ops 20000
+
+The "mint" workload goes through the real `detect_credential` detector chain,
+with the credential served from a GitLab-style environment variable, so it
+measures the cost of a mint that never leaves the process.
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+import id
+from id import _validate_credential, decode_oidc_token
+
+_AUDIENCE = "bench"
+
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def _token() -> str:
+    header = _b64(json.dumps({"alg": "RS256", "typ": "JWT"}).encode())
+    payload = _b64(
+        json.dumps(
+            {
+                "iss": "https://token.actions.githubusercontent.com",
+                "sub": "repo:example/example:ref:refs/heads/main",
+                "aud": _AUDIENCE,
+                "exp": int(time.time()) + 300,
+            }
+        ).encode()
+    )
+    return f"{header}.{payload}.{_b64(b'signature')}"
+
+
+def _run(nthreads: int, ops: int, op: Callable[[], object]) -> float:
+    per_thread = ops // nthreads
+
+    def work() -> None:
+        for _ in range(per_thread):
+            op()
+
+    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+        start = time.perf_counter()
+        futures = [pool.submit(work) for _ in range(nthreads)]
+        for f in futures:
+            f.result()
+        elapsed = time.perf_counter() - start
+
+    return (per_thread * nthreads) / elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--threads", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--ops", type=int, default=20000)
+    args = parser.parse_args()
+
+    token = _token()
+
+    # Make the detector chain resolve to the in-memory GitLab detector.
+    for var in ("GITHUB_ACTIONS", "GOOGLE_SERVICE_ACCOUNT_NAME", "BUILDKITE", "CIRCLECI"):
+        os.environ.pop(var, None)
+    os.environ["GITLAB_CI"] = "true"
+    os.environ[f"{_AUDIENCE.upper()}_ID_TOKEN"] = token
+
+    workloads: dict[str, Callable[[], object]] = {
+        "decode": lambda: decode_oidc_token(token),
+        "validate": lambda: _validate_credential.__wrapped__(token, _AUDIENCE),
+        "mint": lambda: id.detect_credential(_AUDIENCE),
+    }
+
+    gil = getattr(sys, "_is_gil_enabled", lambda: True)()
+    print(f"python {sys.version.split()[0]}, GIL {'enabled' if gil else 'disabled'}")
+    print(f"{'workload':<10}{'threads':>8}{'ops/s':>14}{'scaling':>10}")
+
+    nthreads = 1
+    counts = []
+    while nthreads <= args.threads:
+        counts.append(nthreads)
+        nthreads *= 2
+    if counts[-1] != args.threads:
+        counts.append(args.threads)
+
+    for name, op in workloads.items():
+        baseline = None
+        for n in counts:
+            rate = _run(n, args.ops, op)
+            baseline = baseline or rate
+            print(f"{name:<10}{n:>8}{rate:>14,.0f}{rate / baseline:>9.2f}x")
+
+
+if __name__ == "__main__":
+    main()
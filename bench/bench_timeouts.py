@@ -0,0 +1,82 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+How long a mint from a hung issuer takes to fail, with the fixed timeout and
+with adaptive timeouts.
+
+A local GitHub-style issuer answers `--requests` mints after `--latency`
+seconds each, then hangs for `--hang` seconds per request. The fixed timeout
+waits the hang out; adaptive timeouts, learned from the healthy requests,
+give up much sooner (after a single read timeout, which isn't retried).
+"""
+
+from __future__ import annotations
+
+import argparse
+import statistics
+import time
+
+import _issuer
+
+import id
+
+
+def _run(session: id.Session, requests: int) -> list[float]:
+    latencies = []
+    for i in range(requests):
+        start = time.perf_counter()
+        assert session.detect_credential(f"audience-{i}")
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def _fail(session: id.Session) -> str:
+    start = time.perf_counter()
+    try:
+        session.detect_credential("hung")
+        outcome = "answered"
+    except id.AmbientCredentialError:
+        outcome = "failed"
+    return f"{outcome} after {time.perf_counter() - start:.2f}s"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.01)
+    parser.add_argument("--hang", type=float, default=10.0)
+    args = parser.parse_args()
+
+    latency = args.latency
+    adaptive = id.AdaptiveTimeouts()
+
+    with _issuer.Issuer(lambda: latency) as issuer:
+        _issuer.use_github(issuer.url)
+
+        for name, timeouts in [("fixed", None), ("adaptive", adaptive)]:
+            latency = args.latency
+            with id.Session(timeouts=timeouts) as session:
+                healthy = statistics.median(_run(session, args.requests))
+                latency = args.hang
+                print(
+                    f"{name:<10}{healthy * 1000:>8.1f} ms p50 healthy; hung issuer {_fail(session)}"
+                )
+
+    (stats,) = adaptive.stats().values()
+    print(f"adaptive read timeout: {stats['read']:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Throughput of `TokenVerifier` for repeatedly presented tokens, compared with
+decoding and checking every presentation.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import time
+
+import _issuer
+
+from id import TokenVerifier, decode_oidc_token
+
+_ISS = "https://token.actions.githubusercontent.com"
+
+
+def _uncached(token: str) -> None:
+    claims = json.loads(decode_oidc_token(token)[1])
+    assert claims["iss"] == _ISS and claims["aud"] == "pypi" and claims["exp"] > time.time()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--presentations", type=int, default=200_000)
+    parser.add_argument("--tokens", type=int, default=100, help="distinct tokens presented")
+    args = parser.parse_args()
+
+    tokens = [_issuer.make_token("pypi", lifetime=300 + i) for i in range(args.tokens)]
+    presented = [tokens[i % len(tokens)] for i in range(args.presentations)]
+
+    start = time.perf_counter()
+    for token in presented:
+        _uncached(token)
+    uncached = args.presentations / (time.perf_counter() - start)
+
+    # The bench's tokens are unsigned, and only claims checking is measured.
+    verifier = TokenVerifier(
+        audiences=["pypi"], issuers=[_ISS], verify_signature=lambda token: None
+    )
+    start = time.perf_counter()
+    for token in presented:
+        verifier.verify(token)
+    cached = args.presentations / (time.perf_counter() - start)
+
+    print(f"{args.presentations} presentations of {args.tokens} distinct tokens")
+    print(f"{'decode and check':<20}{uncached:>14,.0f} tokens/s")
+    print(f"{'TokenVerifier':<20}{cached:>14,.0f} tokens/s ({verifier.hits} cache hits)")
+
+
+if __name__ == "__main__":
+    main()
@@ -20,11 +20,120 @@ from __future__ import annotations
 
 import base64
 import binascii
+import functools
+import importlib
 import json
-from typing import Callable
+import threading
+from collections.abc import Iterable, Mapping
+from typing import TYPE_CHECKING, Any, Callable
+
+if TYPE_CHECKING:
+    from concurrent.futures import Future
+
+    from ._internal.archive import TokenArchive, build_archive
+    from ._internal.cache import (
+        CacheBackend,
+        MemcacheTokenCache,
+        RefreshPolicy,
+        SqliteTokenCache,
+    )
+    from ._internal.columnar import ClaimColumns, decode_columns
+    from ._internal.exchange import TokenExchange
+    from ._internal.issuer import LocalIssuer
+    from ._internal.oidc.breaker import CircuitBreaker
+    from ._internal.oidc.cassette import Cassette, record, replay
+    from ._internal.oidc.hedging import HedgingPolicy
+    from ._internal.oidc.ratelimit import RateLimiter
+    from ._internal.oidc.timeouts import AdaptiveTimeouts
+    from ._internal.profile import profile
+    from ._internal.session import Session, _DefaultSession
+    from ._internal.verify import TokenVerifier
+
+    _default_session: _DefaultSession
 
 __version__ = "1.6.1"
 
+# Stands in for options `configure` wasn't passed, since `None` means "disable".
+_UNSET: Any = object()
+
+# Public names whose modules are only imported on first use, so that
+# `import id` doesn't pay for dependencies a caller may never touch (PEP 562).
+_LAZY_EXPORTS = {
+    "TokenArchive": "._internal.archive",
+    "build_archive": "._internal.archive",
+    "CacheBackend": "._internal.cache",
+    "MemcacheTokenCache": "._internal.cache",
+    "RefreshPolicy": "._internal.cache",
+    "SqliteTokenCache": "._internal.cache",
+    "ClaimColumns": "._internal.columnar",
+    "decode_columns": "._internal.columnar",
+    "TokenExchange": "._internal.exchange",
+    "LocalIssuer": "._internal.issuer",
+    "CircuitBreaker": "._internal.oidc.breaker",
+    "Cassette": "._internal.oidc.cassette",
+    "record": "._internal.oidc.cassette",
+    "replay": "._internal.oidc.cassette",
+    "HedgingPolicy": "._internal.oidc.hedging",
+    "RateLimiter": "._internal.oidc.ratelimit",
+    "AdaptiveTimeouts": "._internal.oidc.timeouts",
+    "Session": "._internal.session",
+    "TokenVerifier": "._internal.verify",
+    "profile": "._internal.profile",
+}
+
+
+def __getattr__(name: str) -> Any:
+    if name == "_default_session":
+        return _get_default_session()
+    module = _LAZY_EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list[str]:
+    return sorted(set(globals()) | set(_LAZY_EXPORTS))
+
+
+__all__ = [
+    "AdaptiveTimeouts",
+    "AmbientCredentialError",
+    "CacheBackend",
+    "Cassette",
+    "CircuitBreaker",
+    "ClaimColumns",
+    "GitHubOidcPermissionCredentialError",
+    "HedgingPolicy",
+    "IdentityError",
+    "LocalIssuer",
+    "MemcacheTokenCache",
+    "RateLimiter",
+    "RefreshPolicy",
+    "Session",
+    "SqliteTokenCache",
+    "TokenArchive",
+    "TokenExchange",
+    "TokenVerifier",
+    "build_archive",
+    "configure",
+    "decode_columns",
+    "decode_oidc_token",
+    "detect_credential",
+    "prefetch",
+    "profile",
+    "record",
+    "replay",
+]
+
+# NOTE: `id` is expected to run on free-threaded (PEP 703) interpreters, where
+# there is no GIL to serialize access to shared state. Module-level state
+# anywhere in this package must therefore either be immutable after import
+# (like compiled regular expressions and constant tables) or be guarded by its
+# own `threading.Lock`, held only for the duration of the read or update and
+# never across network or subprocess calls.
+
 
 class IdentityError(Exception):
     """
@@ -52,13 +161,20 @@ class GitHubOidcPermissionCredentialError(AmbientCredentialError):
     pass
 
 
+def _b64decode(segment: str) -> str:
+    # JWT segments are unpadded base64url; over-padding is harmless.
+    return base64.urlsafe_b64decode(segment + "==").decode("utf-8")
+
+
+# Validation is a pure function of its arguments, so detectors that serve the
+# same credential repeatedly (like token files) only pay for it once.
+@functools.lru_cache(maxsize=64)
 def _validate_credential(credential: str, audience: str) -> None:
     # Decode credential to verify it roughly looks like a token and contains
     # the correct audience
     try:
         _, payload, _ = credential.split(".")
-        decoded_payload = base64.urlsafe_b64decode(payload + "==").decode("utf-8")
-        payload_json = json.loads(decoded_payload)
+        payload_json = json.loads(_b64decode(payload))
     except (ValueError, binascii.Error, json.decoder.JSONDecodeError) as e:
         raise AmbientCredentialError("Malformed token") from e
 
@@ -72,43 +188,149 @@ def _validate_credential(credential: str, audience: str) -> None:
         )
 
 
-def detect_credential(audience: str) -> str | None:
+def _expiry(credential: str) -> float | None:
+    # Only called on validated credentials, but `exp` itself is optional.
+    _, payload, _ = credential.split(".")
+    exp = json.loads(_b64decode(payload)).get("exp")
+    return exp if isinstance(exp, (int, float)) else None
+
+
+# The session behind the module-level API, created on first use.
+_default_session_lock = threading.Lock()
+
+
+def _get_default_session() -> _DefaultSession:
+    # Read through `globals()` so that a session swapped in by
+    # `monkeypatch.setattr(id, "_default_session", ...)` is honored.
+    session = globals().get("_default_session")
+    if session is None:
+        from ._internal.session import _DefaultSession
+
+        with _default_session_lock:
+            session = globals().get("_default_session")
+            if session is None:
+                session = globals()["_default_session"] = _DefaultSession()
+    return session
+
+
+def detect_credential(
+    audience: str,
+    *,
+    claims: Mapping[str, Any] | None = None,
+    circleci_root_issuer: bool = True,
+    env: Mapping[str, str] | None = None,
+) -> str | None:
     """
     Try each ambient credential detector, returning the first one to succeed
     or `None` if all fail.
 
+    If `audience` has been passed to `prefetch`, the prefetched credential is
+    returned instead (waiting for the prefetch to finish, if necessary).
+
+    On CircleCI, the credential is minted with the custom `claims`, by the
+    root issuer or (without `circleci_root_issuer`) the organization's; other
+    environments ignore these.
+
+    Detectors read the environment variables in `env` rather than the
+    process environment, if given; see `Session.detect_credential`.
+
     Raises `AmbientCredentialError` if any detector fails internally (i.e.
     detects a credential, but cannot retrieve it).
+
+    This uses the default `Session`; see `Session.detect_credential`.
     """
+    return _get_default_session().detect_credential(
+        audience, claims=claims, circleci_root_issuer=circleci_root_issuer, env=env
+    )
+
+
+def _detect_credential(
+    audience: str,
+    *,
+    claims: Mapping[str, Any] | None = None,
+    circleci_root_issuer: bool = True,
+    env: Mapping[str, str] | None = None,
+) -> str | None:
     from ._internal.oidc.ambient import (
         detect_buildkite,
         detect_circleci,
+        detect_file,
         detect_gcp,
         detect_github,
         detect_gitlab,
     )
 
     detectors: list[Callable[..., str | None]] = [
+        detect_file,
         detect_github,
         detect_gcp,
         detect_buildkite,
         detect_gitlab,
-        detect_circleci,
+        functools.partial(detect_circleci, root_issuer=circleci_root_issuer, claims=claims),
     ]
+    # Only passed when given, so detectors can be swapped out (e.g. in tests)
+    # without accepting it.
+    options = {} if env is None else {"env": env}
     for detector in detectors:
-        credential = detector(audience)
+        credential = detector(audience, **options)
         if credential is not None:
             _validate_credential(credential, audience)
             return credential
     return None
 
 
+def prefetch(audiences: Iterable[str]) -> dict[str, Future[str | None]]:
+    """
+    Start detecting and minting credentials for each of `audiences` in the
+    background, so that later `detect_credential` calls for them return
+    immediately.
+
+    Minting in the background also performs DNS resolution and connection
+    setup to the credential issuer ahead of time; established connections are
+    kept alive and reused by later requests to the same issuer.
+
+    Returns a mapping of each audience to a `Future` for its credential. Errors
+    are raised from the `Future`, and again from `detect_credential` calls
+    that wait on an in-flight prefetch.
+
+    This uses the default `Session`; see `Session.prefetch`.
+    """
+    return _get_default_session().prefetch(audiences)
+
+
+def configure(
+    *,
+    hedging: HedgingPolicy | None = _UNSET,
+    circuit_breaker: CircuitBreaker | None = _UNSET,
+    rate_limits: Mapping[str, RateLimiter] | None = _UNSET,
+    timeouts: AdaptiveTimeouts | None = _UNSET,
+    refresh: RefreshPolicy | None = _UNSET,
+) -> None:
+    """
+    Configure how `detect_credential` contacts credential issuers, and serves
+    the credentials they mint. Options that aren't passed are left unchanged;
+    `None` disables an option.
+
+    This configures the default `Session`; see `Session.configure`.
+    """
+    options: dict[str, Any] = {
+        "hedging": hedging,
+        "circuit_breaker": circuit_breaker,
+        "rate_limits": rate_limits,
+        "timeouts": timeouts,
+        "refresh": refresh,
+    }
+    _get_default_session().configure(
+        **{name: value for name, value in options.items() if value is not _UNSET}
+    )
+
+
 def decode_oidc_token(token: str) -> tuple[str, str, str]:
     # Split the token into its three parts: header, payload, and signature
     header, payload, signature = token.split(".")
 
     # Decode base64-encoded header and payload
-    decoded_header = base64.urlsafe_b64decode(header + "==").decode("utf-8")
-    decoded_payload = base64.urlsafe_b64decode(payload + "==").decode("utf-8")
+    decoded_header = _b64decode(header)
+    decoded_payload = _b64decode(payload)
 
     return decoded_header, decoded_payload, signature
@@ -16,9 +16,24 @@
 The `python -m id` entrypoint.
 """
 
+from __future__ import annotations
+
 import argparse
+import contextlib
+import contextvars
+import functools
+import json
 import logging
 import os
+import re
+import shlex
+import signal
+import subprocess  # nosec B404
+import sys
+import threading
+import time
+from collections.abc import Iterator
+from typing import Any, Callable
 
 from . import __version__
 
@@ -31,13 +46,7 @@ package_logger = logging.getLogger("id")
 package_logger.setLevel(os.environ.get("ID_LOGLEVEL", "INFO").upper())
 
 
-def _parser() -> argparse.ArgumentParser:
-    parser = argparse.ArgumentParser(
-        prog="id",
-        description="a tool for generating OIDC identities",
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
-    )
-    parser.add_argument("-V", "--version", action="version", version=f"%(prog)s {__version__}")
+def _add_verbose(parser: argparse.ArgumentParser) -> None:
     parser.add_argument(
         "-v",
         "--verbose",
@@ -45,37 +54,597 @@ def _parser() -> argparse.ArgumentParser:
         default=0,
         help="run with additional debug logging; supply multiple times to increase verbosity",
     )
+
+
+def _configure_logging(args: argparse.Namespace) -> None:
+    # Configure logging upfront, so that we don't miss anything.
+    if args.verbose >= 1:
+        package_logger.setLevel("DEBUG")
+    if args.verbose >= 2:
+        logging.getLogger().setLevel("DEBUG")
+
+    logger.debug(f"parsed arguments {args}")
+
+
+def _parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="id",
+        description="a tool for generating OIDC identities",
+        epilog=f"other commands: {', '.join(_SUBCOMMANDS)} (see `id <command> --help`)",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("-V", "--version", action="version", version=f"%(prog)s {__version__}")
+    _add_verbose(parser)
     parser.add_argument(
         "-d",
         "--decode",
         action="store_true",
         help="decode the OIDC token into JSON",
     )
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=["token", "json", "env", "dotenv"],
+        default="token",
+        help="print each token on a line of its own, a JSON object of audiences to tokens, "
+        "shell `export` statements or a dotenv file",
+    )
+    _add_names(parser)
+    _add_claims(parser)
+    parser.add_argument(
+        "--profile",
+        metavar="PATH",
+        help="profile this invocation, imports included, with cProfile, writing pstats to PATH "
+        "and a summary to stderr; setting $ID_PROFILE to PATH does the same",
+    )
+    parser.add_argument(
+        "--profile-memory",
+        action="store_true",
+        help="with --profile, trace allocations with tracemalloc too, as does $ID_PROFILE_MEMORY=1",
+    )
     parser.add_argument(
         "audience",
         type=str,
-        default=os.getenv("ID_OIDC_AUDIENCE"),
-        help="the OIDC audience to use",
+        nargs="*",
+        default=[],
+        help="the OIDC audiences to use; $ID_OIDC_AUDIENCE if none are given",
     )
 
     return parser
 
 
-def main() -> None:
-    parser = _parser()
-    args = parser.parse_args()
+def _add_names(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--name",
+        metavar="AUDIENCE=VAR",
+        action="append",
+        default=[],
+        help="the environment variable to put the token for AUDIENCE in, rather than "
+        "<AUD>_ID_TOKEN as for GitLab",
+    )
 
-    # Configure logging upfront, so that we don't miss anything.
-    if args.verbose >= 1:
-        package_logger.setLevel("DEBUG")
-    if args.verbose >= 2:
-        logging.getLogger().setLevel("DEBUG")
 
-    logger.debug(f"parsed arguments {args}")
+_VAR_NAME = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+
+def _names(parser: argparse.ArgumentParser, args: argparse.Namespace) -> dict[str, str]:
+    from ._internal.oidc.ambient import _env_var_name
+
+    # Variable names can't contain `=`, but audiences (often URLs) can.
+    names = {audience: _env_var_name(audience, "ID_TOKEN") for audience in args.audience}
+    for name in args.name:
+        audience, _, var = name.rpartition("=")
+        if not _VAR_NAME.fullmatch(var):
+            parser.error(f"invalid --name {name!r}: expected AUDIENCE=VAR")
+        names[audience] = var
+    return names
+
+
+def _add_claims(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--claim",
+        metavar="KEY=VALUE",
+        action="append",
+        default=[],
+        help="on CircleCI, a custom claim to mint tokens with; VALUE is parsed as JSON if it "
+        "can be, and used as a string otherwise",
+    )
+    parser.add_argument(
+        "--circleci-org-issuer",
+        action="store_true",
+        help="on CircleCI, mint tokens with the organization's issuer rather than the root "
+        "issuer (oidc.circleci.com)",
+    )
+
+
+def _claims(parser: argparse.ArgumentParser, args: argparse.Namespace) -> dict[str, Any]:
+    """
+    The `detect_credential` options for the claims and issuer in `args`.
+    """
+    claims: dict[str, Any] = {}
+    for claim in args.claim:
+        key, sep, value = claim.partition("=")
+        if not key or not sep:
+            parser.error(f"invalid --claim {claim!r}: expected KEY=VALUE")
+        try:
+            claims[key] = json.loads(value)
+        except ValueError:
+            claims[key] = value
+    if "aud" in claims:
+        parser.error("--claim can't set `aud`; pass the audience instead")
+
+    options: dict[str, Any] = {}
+    if claims:
+        options["claims"] = claims
+    if args.circleci_org_issuer:
+        options["circleci_root_issuer"] = False
+    return options
+
+
+def _mint(audiences: list[str], options: dict[str, Any] | None = None) -> dict[str, str]:
+    """
+    Mint a credential for each audience concurrently, with `detect_credential`
+    `options`, exiting if any can't be.
+    """
+    from . import detect_credential, prefetch
+
+    if options:
+        # Prefetches are per audience, so custom claims are minted directly.
+        from concurrent.futures import ThreadPoolExecutor
+
+        from ._internal.profile import profiled
+
+        # Each mint runs in a copy of this context, so that a cassette being
+        # recorded or replayed (see `_cassette`) applies on the pool's threads,
+        # and so does a profile being taken.
+        with ThreadPoolExecutor(len(audiences)) as pool:
+            minted = [
+                pool.submit(
+                    contextvars.copy_context().run,
+                    profiled,
+                    functools.partial(detect_credential, audience, **options),
+                )
+                for audience in audiences
+            ]
+            tokens = {audience: future.result() for audience, future in zip(audiences, minted)}
+    else:
+        futures = prefetch(audiences)
+        tokens = {audience: future.result() for audience, future in futures.items()}
+    missing = [audience for audience, token in tokens.items() if token is None]
+    if missing:
+        print(f"no credential available for {', '.join(map(repr, missing))}", file=sys.stderr)
+        sys.exit(1)
+    return {audience: token for audience, token in tokens.items() if token is not None}
+
+
+def _format(tokens: dict[str, str], names: dict[str, str], format: str) -> str:
+    if format == "json":
+        return json.dumps(tokens)
+    if format == "env":
+        return "\n".join(
+            f"export {names[audience]}={shlex.quote(token)}" for audience, token in tokens.items()
+        )
+    if format == "dotenv":
+        return "\n".join(f"{names[audience]}={token}" for audience, token in tokens.items())
+    return "\n".join(tokens.values())
+
+
+def _archive_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="id archive",
+        description="build and query indexed archives of collected OIDC tokens",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    _add_verbose(parser)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build = commands.add_parser(
+        "build",
+        help="build an archive from tokens, one per line",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    build.add_argument("archive", help="the archive file to write")
+    build.add_argument(
+        "tokens",
+        type=argparse.FileType("r"),
+        nargs="?",
+        default="-",
+        help="the file of tokens to read, or - for stdin",
+    )
+
+    query = commands.add_parser(
+        "query",
+        help="print the claims of matching tokens as JSON, one per line",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    query.add_argument("archive", help="the archive file to query")
+    query.add_argument("--iss", help="match tokens with this issuer")
+    query.add_argument("--sub", help="match tokens with this subject")
+    query.add_argument("--repository", help="match tokens with this repository")
+    query.add_argument("--exp-min", type=int, help="match tokens expiring at or after this time")
+    query.add_argument("--exp-max", type=int, help="match tokens expiring at or before this time")
+
+    return parser
+
+
+def _archive(argv: list[str]) -> None:
+    args = _archive_parser().parse_args(argv)
+    _configure_logging(args)
+
+    from . import TokenArchive, build_archive
+
+    if args.command == "build":
+        with args.tokens:
+            count = build_archive(args.tokens, args.archive)
+        print(f"archived {count} tokens to {args.archive}", file=sys.stderr)
+        return
+
+    claims = {
+        claim: getattr(args, claim)
+        for claim in ("iss", "sub", "repository")
+        if getattr(args, claim) is not None
+    }
+    with TokenArchive(args.archive) as archive:
+        for match in archive.query(exp_min=args.exp_min, exp_max=args.exp_max, **claims):
+            print(json.dumps(match))
+
+
+def _mint_test_parser() -> argparse.ArgumentParser:
+    from ._internal.issuer import PROVIDERS
+
+    parser = argparse.ArgumentParser(
+        prog="id mint-test",
+        description="mint signed, provider-shaped test tokens from a local key",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    _add_verbose(parser)
+    parser.add_argument("audience", help="the OIDC audience to mint tokens for")
+    parser.add_argument(
+        "--provider", choices=list(PROVIDERS), default="github", help="the token shape"
+    )
+    parser.add_argument(
+        "--subject",
+        default="",
+        help="the provider-specific identity: a repository, service account or project",
+    )
+    parser.add_argument(
+        "--algorithm", choices=["ES256", "RS256"], default="ES256", help="the signing algorithm"
+    )
+    parser.add_argument("-n", "--count", type=int, default=1, help="the number of tokens to mint")
+    parser.add_argument("--lifetime", type=int, default=300, help="the token lifetime, in seconds")
+    parser.add_argument(
+        "--key",
+        metavar="PEM",
+        help="load the signing key from this file, creating it if it doesn't exist",
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="after minting, keep serving the issuer's discovery document, JWKS and a "
+        "/token endpoint on localhost until interrupted",
+    )
+    parser.add_argument("--port", type=int, default=0, help="the port to serve on with --serve")
+
+    return parser
+
+
+def _mint_test(argv: list[str]) -> None:
+    args = _mint_test_parser().parse_args(argv)
+    _configure_logging(args)
+
+    from . import LocalIssuer
+
+    key = None
+    if args.key and os.path.exists(args.key):
+        with open(args.key, "rb") as f:
+            key = f.read()
+
+    issuer = LocalIssuer(
+        provider=args.provider,
+        algorithm=args.algorithm,
+        lifetime=args.lifetime,
+        private_key_pem=key,
+    )
+    if args.key and key is None:
+        fd = os.open(args.key, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(issuer.private_key_pem)
+
+    if args.serve:
+        url = issuer.serve(port=args.port)
+        print(f"serving issuer {url}", file=sys.stderr)
+
+    for token in issuer.mint_batch(args.audience, args.count, args.subject):
+        print(token)
+    sys.stdout.flush()
+
+    if args.serve:
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            issuer.shutdown()
+
+
+def _doctor_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="id doctor",
+        description="diagnose which environments are detected, and why minting is slow or failing",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    _add_verbose(parser)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument(
+        "audience",
+        nargs="?",
+        default=os.getenv("ID_OIDC_AUDIENCE", "id-doctor"),
+        help="the OIDC audience to mint test credentials for",
+    )
+    return parser
+
+
+def _doctor(argv: list[str]) -> None:
+    args = _doctor_parser().parse_args(argv)
+    _configure_logging(args)
+
+    from ._internal.oidc.doctor import diagnose, format_report
+
+    report = diagnose(args.audience)
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+
+
+def _exec_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="id exec",
+        usage="%(prog)s [options] -a AUDIENCE [-a AUDIENCE ...] -- command [arg ...]",
+        description="mint credentials for each audience, then run a command with them in its "
+        "environment",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    _add_verbose(parser)
+    parser.add_argument(
+        "-a",
+        "--audience",
+        action="append",
+        required=True,
+        help="an OIDC audience to mint a credential for; supply multiple times for several",
+    )
+    _add_names(parser)
+    _add_claims(parser)
+    return parser
+
+
+def _exec(argv: list[str]) -> None:
+    parser = _exec_parser()
+    # Everything after `--` is the command, even if it looks like our options.
+    split = argv.index("--") if "--" in argv else len(argv)
+    args = parser.parse_args(argv[:split])
+    command = argv[split + 1 :]
+    if not command:
+        parser.error("a command to run is required, after --")
+    _configure_logging(args)
+
+    names = _names(parser, args)
+    env = dict(os.environ)
+    for audience, token in _mint(args.audience, _claims(parser, args)).items():
+        env[names[audience]] = token
+
+    # NOTE: We're silencing `bandit` here: running the caller's command is
+    # the point of `id exec`, and it's resolved on the `PATH` like a shell would.
+    from ._internal.oidc.cassette import current
+    from ._internal.profile import active
+
+    cassette = current()
+    recording = cassette is not None and not cassette.replaying
+    if sys.platform == "win32" or active() or recording:
+        # There's no `exec` on Windows, and exec'ing would lose the profile
+        # being taken or the cassette being recorded; wait for the command
+        # and pass on its status instead.
+        sys.exit(subprocess.run(command, env=env).returncode)  # nosec B603
+    os.execvpe(command[0], command, env)  # nosec B606
+
+
+def _sidecar_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="id sidecar",
+        description="keep a token file per audience up to date, rewriting each before its "
+        "token expires; exits with status 1 once a file can't be kept valid",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    _add_verbose(parser)
+    parser.add_argument(
+        "-a",
+        "--audience",
+        action="append",
+        required=True,
+        help="an OIDC audience to keep a token file for; supply multiple times for several",
+    )
+    parser.add_argument(
+        "--directory", default=".", help="the directory to write <audience>.token files to"
+    )
+    parser.add_argument(
+        "--file",
+        metavar="AUDIENCE=PATH",
+        action="append",
+        default=[],
+        help="the file to write the token for AUDIENCE to, rather than one in --directory",
+    )
+    parser.add_argument(
+        "--heartbeat",
+        metavar="PATH",
+        help="write the current UNIX time to this file whenever every token file is valid",
+    )
+    parser.add_argument(
+        "--refresh-at",
+        type=float,
+        default=0.8,
+        help="the fraction of each token's lifetime after which it's refreshed",
+    )
+    parser.add_argument(
+        "--once", action="store_true", help="write every token file once, then exit"
+    )
+    return parser
+
+
+def _sidecar(argv: list[str]) -> None:
+    parser = _sidecar_parser()
+    args = parser.parse_args(argv)
+    _configure_logging(args)
+
+    from ._internal.sidecar import Sidecar
+
+    files = {
+        audience: os.path.join(
+            args.directory, re.sub(r"[^A-Za-z0-9._-]+", "_", audience) + ".token"
+        )
+        for audience in args.audience
+    }
+    for file in args.file:
+        audience, _, path = file.rpartition("=")
+        if audience not in files or not path:
+            parser.error(f"invalid --file {file!r}: expected AUDIENCE=PATH for an --audience")
+        files[audience] = path
+
+    sidecar = Sidecar(files, heartbeat=args.heartbeat, refresh_at=args.refresh_at)
+    if args.once:
+        sys.exit(0 if sidecar.refresh() else 1)
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    try:
+        healthy = sidecar.run(stop)
+    except KeyboardInterrupt:
+        healthy = True
+    sys.exit(0 if healthy else 1)
+
+
+# NOTE: Subcommands are dispatched on the first argument before the top-level
+# parser runs, since the top-level parser takes a bare audience positional.
+_SUBCOMMANDS: dict[str, Callable[[list[str]], None]] = {
+    "archive": _archive,
+    "mint-test": _mint_test,
+    "doctor": _doctor,
+    "exec": _exec,
+    "sidecar": _sidecar,
+}
+
+
+def _profiling(argv: list[str]) -> tuple[list[str], str | None, bool]:
+    """
+    Take the profiling options out of `argv`, so that they apply to every
+    command: returns the remaining arguments, the profile path and whether to
+    trace memory.
+    """
+    path = os.getenv("ID_PROFILE") or None
+    memory = os.getenv("ID_PROFILE_MEMORY", "").lower() in {"1", "true", "yes"}
+
+    rest: list[str] = []
+    args = iter(argv)
+    for arg in args:
+        # Leave `id exec`'s command alone.
+        if arg == "--":
+            rest.append(arg)
+            rest.extend(args)
+        elif arg == "--profile":
+            path = next(args, None)
+            if path is None or path.startswith("-"):
+                _parser().error("argument --profile: expected a PATH")
+        elif arg.startswith("--profile="):
+            path = arg.partition("=")[2]
+            if not path:
+                _parser().error("argument --profile: expected a PATH")
+        elif arg == "--profile-memory":
+            memory = True
+        else:
+            rest.append(arg)
+    return rest, path, memory
+
+
+@contextlib.contextmanager
+def _timeouts() -> Iterator[None]:
+    """
+    Learn request timeouts from the latencies of every run, kept in
+    `$ID_TIMEOUTS_FILE`, if set.
+    """
+    path = os.getenv("ID_TIMEOUTS_FILE")
+    if not path:
+        yield
+        return
+
+    from . import AdaptiveTimeouts, configure
+
+    timeouts = AdaptiveTimeouts(path=path)
+    configure(timeouts=timeouts)
+    try:
+        yield
+    finally:
+        try:
+            timeouts.save()
+        except OSError as e:
+            logger.warning(f"couldn't save request latencies to {path}: {e}")
+
+
+@contextlib.contextmanager
+def _cassette() -> Iterator[None]:
+    """
+    Record the run's interactions with the environment to the cassette at
+    `$ID_RECORD`, or replay them from the one at `$ID_REPLAY`, if either is set.
+    """
+    path = os.getenv("ID_REPLAY") or os.getenv("ID_RECORD")
+    if not path:
+        yield
+        return
+
+    from . import record, replay
+
+    with replay(path) if os.getenv("ID_REPLAY") else record(path):
+        yield
+
+
+def main(argv: list[str] | None = None) -> None:
+    argv, path, memory = _profiling(sys.argv[1:] if argv is None else argv)
+    with _timeouts(), _cassette():
+        if path is None:
+            _main(argv)
+            return
+
+        # Commands import what they need as they run, so those imports are
+        # profiled too.
+        from ._internal.profile import profile
+
+        with profile(path, memory=memory):
+            _main(argv)
+
+
+def _main(argv: list[str]) -> None:
+    if argv and argv[0] in _SUBCOMMANDS:
+        _SUBCOMMANDS[argv[0]](argv[1:])
+        return
+
+    parser = _parser()
+    args = parser.parse_args(argv)
+    _configure_logging(args)
+
+    if not args.audience:
+        if not os.getenv("ID_OIDC_AUDIENCE"):
+            parser.error("an audience is required")
+        args.audience = [os.environ["ID_OIDC_AUDIENCE"]]
 
     from . import decode_oidc_token, detect_credential
 
-    token = detect_credential(args.audience)
+    options = _claims(parser, args)
+    if len(args.audience) > 1 or args.format != "token":
+        tokens = _mint(args.audience, options)
+        if args.decode and args.format == "token":
+            for token in tokens.values():
+                header, payload, signature = decode_oidc_token(token)
+                print(header)
+                print(payload)
+        else:
+            print(_format(tokens, _names(parser, args), args.format))
+        return
+
+    token = detect_credential(args.audience[0], **options)
     if token and args.decode:
         header, payload, signature = decode_oidc_token(token)
         print(header)
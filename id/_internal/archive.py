@@ -0,0 +1,311 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+An indexed, memory-mapped archive of decoded OIDC tokens, for audit queries.
+
+The archive is a single little-endian file:
+
+* a fixed-size header, pointing at each of the sections below;
+* the records, one per token, each holding the decoded header and payload JSON
+  and the signature as produced by `decode_oidc_token`;
+* the record offsets table;
+* the `exp` column, plus a copy sorted by `exp` with the matching record
+  numbers, for range queries;
+* a sorted value table and postings lists for each indexed string claim.
+
+Queries are answered from the indexes and columns alone; only matching
+records are read and parsed.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import mmap
+import os
+import struct
+from collections.abc import Iterable, Iterator
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = b"IDARCH01"
+_HEADER = struct.Struct("<8sQQQQ")
+_HEADER_SIZE = 64
+_RECORD = struct.Struct("<III")
+_VALUE_ENTRY = struct.Struct("<QIQI")
+_FIELD_ENTRY = struct.Struct("<QI")
+
+# NOTE: Records with a missing or non-integer `exp` get this sentinel in the
+# `exp` column, and are left out of the sorted copy used for range queries.
+_NO_EXP = -(2**63)
+
+INDEXED_CLAIMS = ("iss", "sub", "repository")
+
+
+def build_archive(tokens: Iterable[str], path: str | os.PathLike[str]) -> int:
+    """
+    Decode each of `tokens` and write them to a new archive at `path`,
+    replacing any existing file atomically.
+
+    Malformed tokens are logged and skipped. Returns the number of tokens
+    written.
+    """
+    from .. import decode_oidc_token
+
+    path = os.fspath(path)
+    tmp_path = f"{path}.tmp"
+
+    offsets: list[int] = []
+    exps: list[int] = []
+    postings: dict[str, dict[str, list[int]]] = {claim: {} for claim in INDEXED_CLAIMS}
+
+    with open(tmp_path, "wb") as f:
+        f.write(b"\0" * _HEADER_SIZE)
+
+        for lineno, token in enumerate(tokens, start=1):
+            token = token.strip()
+            if not token:
+                continue
+            try:
+                header, payload, signature = decode_oidc_token(token)
+                claims = json.loads(payload)
+                if not isinstance(claims, dict):
+                    raise ValueError("payload is not a JSON object")
+            except ValueError as e:
+                logger.warning(f"archive: skipping malformed token #{lineno}: {e}")
+                continue
+
+            record = len(offsets)
+            offsets.append(f.tell())
+
+            fields = [header.encode(), payload.encode(), signature.encode()]
+            f.write(_RECORD.pack(*(len(field) for field in fields)))
+            for field in fields:
+                f.write(field)
+
+            exp = claims.get("exp")
+            exps.append(exp if isinstance(exp, int) and not isinstance(exp, bool) else _NO_EXP)
+
+            for claim, values in postings.items():
+                value = claims.get(claim)
+                if isinstance(value, str):
+                    values.setdefault(value, []).append(record)
+
+        count = len(offsets)
+        offsets.append(f.tell())
+
+        offsets_pos = f.tell()
+        f.write(struct.pack(f"<{count + 1}Q", *offsets))
+
+        exp_pos = f.tell()
+        by_exp = sorted((exp, record) for record, exp in enumerate(exps) if exp != _NO_EXP)
+        f.write(struct.pack("<Q", len(by_exp)))
+        f.write(struct.pack(f"<{count}q", *exps))
+        f.write(struct.pack(f"<{len(by_exp)}q", *(exp for exp, _ in by_exp)))
+        f.write(struct.pack(f"<{len(by_exp)}I", *(record for _, record in by_exp)))
+
+        tables: list[tuple[str, int, int]] = []
+        for claim, values in postings.items():
+            entries = []
+            for value in sorted(values, key=lambda v: v.encode()):
+                encoded = value.encode()
+                value_pos = f.tell()
+                f.write(encoded)
+                records = values[value]
+                postings_pos = f.tell()
+                f.write(struct.pack(f"<{len(records)}I", *records))
+                entries.append((value_pos, len(encoded), postings_pos, len(records)))
+
+            table_pos = f.tell()
+            for entry in entries:
+                f.write(_VALUE_ENTRY.pack(*entry))
+            tables.append((claim, table_pos, len(entries)))
+
+        index_pos = f.tell()
+        f.write(struct.pack("<I", len(tables)))
+        for claim, table_pos, nvalues in tables:
+            name = claim.encode()
+            f.write(struct.pack("<H", len(name)))
+            f.write(name)
+            f.write(_FIELD_ENTRY.pack(table_pos, nvalues))
+
+        f.seek(0)
+        f.write(_HEADER.pack(_MAGIC, count, offsets_pos, exp_pos, index_pos))
+
+    os.replace(tmp_path, path)
+    return count
+
+
+class TokenArchive:
+    """
+    A read-only, memory-mapped view of an archive written by `build_archive`.
+    """
+
+    def __init__(self, path: str | os.PathLike[str]) -> None:
+        """
+        Open the archive at `path`.
+
+        Raises `IdentityError` if the file isn't an archive.
+        """
+        from .. import IdentityError
+
+        with open(path, "rb") as f:
+            try:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError as e:
+                raise IdentityError(f"{os.fspath(path)!r} is not a token archive") from e
+
+        try:
+            magic, self._count, self._offsets_pos, exp_pos, index_pos = _HEADER.unpack_from(
+                self._mm
+            )
+        except struct.error:
+            magic = b""
+        if magic != _MAGIC:
+            self._mm.close()
+            raise IdentityError(f"{os.fspath(path)!r} is not a token archive")
+
+        (self._nexp,) = struct.unpack_from("<Q", self._mm, exp_pos)
+        self._exp_pos = exp_pos + 8
+        self._sorted_exp_pos = self._exp_pos + 8 * self._count
+        self._perm_pos = self._sorted_exp_pos + 8 * self._nexp
+
+        self._tables: dict[str, tuple[int, int]] = {}
+        (nfields,) = struct.unpack_from("<I", self._mm, index_pos)
+        pos = index_pos + 4
+        for _ in range(nfields):
+            (name_len,) = struct.unpack_from("<H", self._mm, pos)
+            name = self._mm[pos + 2 : pos + 2 + name_len].decode()
+            pos += 2 + name_len
+            self._tables[name] = _FIELD_ENTRY.unpack_from(self._mm, pos)
+            pos += _FIELD_ENTRY.size
+
+    def __enter__(self) -> TokenArchive:
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return int(self._count)
+
+    def close(self) -> None:
+        """
+        Unmap the archive.
+        """
+        self._mm.close()
+
+    def _exp(self, record: int) -> int:
+        (exp,) = struct.unpack_from("<q", self._mm, self._exp_pos + 8 * record)
+        return int(exp)
+
+    def _postings(self, claim: str, value: str) -> tuple[int, ...]:
+        table_pos, nvalues = self._tables[claim]
+        target = value.encode()
+
+        lo, hi = 0, nvalues
+        while lo < hi:
+            mid = (lo + hi) // 2
+            value_pos, value_len, postings_pos, npostings = _VALUE_ENTRY.unpack_from(
+                self._mm, table_pos + mid * _VALUE_ENTRY.size
+            )
+            candidate = self._mm[value_pos : value_pos + value_len]
+            if candidate == target:
+                return struct.unpack_from(f"<{npostings}I", self._mm, postings_pos)
+            if candidate < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return ()
+
+    def _bisect(self, target: int, *, right: bool) -> int:
+        # `bisect` only gained `key=` in 3.10, so search the sorted `exp` copy
+        # by hand, reading one value at a time out of the mapping.
+        lo, hi = 0, self._nexp
+        while lo < hi:
+            mid = (lo + hi) // 2
+            (exp,) = struct.unpack_from("<q", self._mm, self._sorted_exp_pos + 8 * mid)
+            if exp < target or (right and exp == target):
+                lo = mid + 1
+            else:
+                hi = mid
+        return int(lo)
+
+    def _exp_range(self, exp_min: int | None, exp_max: int | None) -> tuple[int, ...]:
+        lo = 0 if exp_min is None else self._bisect(exp_min, right=False)
+        hi = self._nexp if exp_max is None else self._bisect(exp_max, right=True)
+        if lo >= hi:
+            return ()
+        return struct.unpack_from(f"<{hi - lo}I", self._mm, self._perm_pos + 4 * lo)
+
+    def record(self, record: int) -> tuple[str, str, str]:
+        """
+        Return the `(header, payload, signature)` of the `record`-th token,
+        in the same form as `decode_oidc_token`.
+        """
+        (start,) = struct.unpack_from("<Q", self._mm, self._offsets_pos + 8 * record)
+        lengths = _RECORD.unpack_from(self._mm, start)
+        pos = start + _RECORD.size
+        fields = []
+        for length in lengths:
+            fields.append(self._mm[pos : pos + length].decode())
+            pos += length
+        return fields[0], fields[1], fields[2]
+
+    def query(
+        self,
+        *,
+        exp_min: int | None = None,
+        exp_max: int | None = None,
+        **claims: str,
+    ) -> Iterator[dict[str, Any]]:
+        """
+        Yield the claims of every token matching all of the given criteria, in
+        archive order.
+
+        `claims` may constrain any of the indexed claims (`iss`, `sub` and
+        `repository`) to an exact value; `exp_min` and `exp_max` constrain
+        `exp` to an inclusive range. With no criteria, every token matches.
+        """
+        unknown = set(claims) - set(self._tables)
+        if unknown:
+            raise ValueError(f"not an indexed claim: {', '.join(sorted(unknown))}")
+
+        candidates: set[int] | None = None
+        # Intersect the smallest postings lists first, to keep the working set small.
+        for postings in sorted(
+            (self._postings(claim, value) for claim, value in claims.items()), key=len
+        ):
+            candidates = set(postings) if candidates is None else candidates & set(postings)
+            if not candidates:
+                return
+
+        if exp_min is not None or exp_max is not None:
+            if candidates is None:
+                candidates = set(self._exp_range(exp_min, exp_max))
+            else:
+                candidates = {
+                    record
+                    for record in candidates
+                    if self._exp(record) != _NO_EXP
+                    and (exp_min is None or self._exp(record) >= exp_min)
+                    and (exp_max is None or self._exp(record) <= exp_max)
+                }
+
+        records: Iterable[int] = range(self._count) if candidates is None else sorted(candidates)
+        for record in records:
+            _, payload, _ = self.record(record)
+            yield json.loads(payload)
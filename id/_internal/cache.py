@@ -0,0 +1,414 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Caching of minted credentials, in memory or in a backend shared between
+processes and hosts.
+"""
+
+from __future__ import annotations
+
+import abc
+import hashlib
+import logging
+import os
+import socket
+import sqlite3
+import stat
+import sys
+import threading
+import time
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+
+class CacheBackend(abc.ABC):
+    """
+    The interface of credential caches: a mapping of keys to credentials,
+    each held until shortly before it expires.
+    """
+
+    def __init__(self, leeway: float = 60) -> None:
+        """
+        Create a new cache. Entries stop being served `leeway` seconds before
+        their expiry, so that callers never receive a credential that is about
+        to expire in flight.
+        """
+        self.leeway = leeway
+
+    @abc.abstractmethod
+    def get(self, key: str) -> str | None:
+        """
+        Return the credential cached under `key`, or `None` if there is no
+        credential or it is too close to expiry.
+        """
+
+    @abc.abstractmethod
+    def put(self, key: str, credential: str, expires_at: float) -> None:
+        """
+        Cache `credential` under `key` until `expires_at` (a UNIX timestamp),
+        less the cache's leeway.
+        """
+
+    @abc.abstractmethod
+    def clear(self) -> None:
+        """
+        Drop every cached credential.
+        """
+
+
+class TokenCache(CacheBackend):
+    """
+    A thread-safe, in-memory cache of credentials.
+    """
+
+    def __init__(self, leeway: float = 60) -> None:
+        """
+        Create a new cache; see `CacheBackend`.
+        """
+        super().__init__(leeway)
+        self._lock = threading.Lock()
+        self._entries: dict[str, tuple[str, float]] = {}
+
+    def get(self, key: str) -> str | None:
+        """
+        See `CacheBackend.get`.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            credential, expires_at = entry
+            if time.time() + self.leeway >= expires_at:
+                del self._entries[key]
+                return None
+            return credential
+
+    def put(self, key: str, credential: str, expires_at: float) -> None:
+        """
+        See `CacheBackend.put`.
+        """
+        with self._lock:
+            self._entries[key] = (credential, expires_at)
+
+    def clear(self) -> None:
+        """
+        See `CacheBackend.clear`.
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+class RefreshPolicy:
+    """
+    Serves the last credential minted for an audience while it's still valid,
+    refreshing it in the background rather than making callers wait.
+
+    A credential with more than `soft` seconds of validity left is served as
+    is. Once it has `soft` seconds or less left, it's still served, but a
+    single re-mint is started in the background; if that fails, the old
+    credential keeps being served. Once it has `hard` seconds or less left,
+    it's no longer served, and callers wait for a new one.
+    """
+
+    def __init__(self, *, soft: float = 120.0, hard: float = 30.0) -> None:
+        """
+        Create a new policy, refreshing credentials `soft` seconds before
+        they expire and no longer serving them `hard` seconds before.
+        """
+        if hard < 0:
+            raise ValueError("hard must not be negative")
+        if soft < hard:
+            raise ValueError("soft must be at least hard")
+
+        self.soft = soft
+        self.hard = hard
+
+
+class _Sealer:
+    """
+    Serializes cache entries, encrypting them with Fernet unless they're
+    explicitly kept in plaintext, and derives storage keys that don't reveal
+    the audience they're for.
+    """
+
+    def __init__(self, namespace: str, encryption_key: bytes | str | None, plaintext: bool) -> None:
+        from .. import IdentityError
+
+        if (encryption_key is None) != plaintext:
+            raise ValueError(
+                "shared caches need an `encryption_key`, or `plaintext=True` to store "
+                "credentials unencrypted (but not both)"
+            )
+
+        self._namespace = namespace.encode()
+        self._fernet: Any = None
+        if encryption_key is not None:
+            try:
+                from cryptography.fernet import Fernet
+            except ImportError as e:
+                raise IdentityError("encrypted caches require `cryptography` (id[cache])") from e
+            self._fernet = Fernet(encryption_key)
+
+    def key(self, key: str) -> str:
+        return hashlib.sha256(self._namespace + b"\0" + key.encode()).hexdigest()
+
+    def seal(self, credential: str, expires_at: float) -> bytes:
+        data = f"{expires_at!r} {credential}".encode()
+        return self._fernet.encrypt(data) if self._fernet is not None else data
+
+    def open(self, data: bytes) -> tuple[str, float] | None:
+        if self._fernet is not None:
+            from cryptography.fernet import InvalidToken
+
+            try:
+                data = self._fernet.decrypt(data)
+            except InvalidToken:
+                logger.warning("cache: entry failed to decrypt; ignoring it")
+                return None
+        try:
+            expires_at, credential = data.decode().split(" ", 1)
+            return credential, float(expires_at)
+        except ValueError:
+            logger.warning("cache: malformed entry; ignoring it")
+            return None
+
+
+def _create_private(path: str) -> None:
+    from .. import IdentityError
+
+    # Create the file ourselves, since SQLite would create it with the
+    # umask's (typically world-readable) permissions.
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        mode = os.fstat(fd).st_mode
+    finally:
+        os.close(fd)
+    if mode & stat.S_IRWXO:
+        raise IdentityError(f"cache: {path} is accessible to other users; refusing to use it")
+
+
+class SqliteTokenCache(CacheBackend):
+    """
+    A credential cache in a SQLite database, which can be shared between
+    processes on a host.
+    """
+
+    def __init__(
+        self,
+        path: str | os.PathLike[str],
+        *,
+        leeway: float = 60,
+        namespace: str = "",
+        encryption_key: bytes | str | None = None,
+        plaintext: bool = False,
+    ) -> None:
+        """
+        Create a new cache in the SQLite database at `path`, creating it if
+        necessary. The database holds bearer credentials, so it's created
+        readable by its owner only, and an existing one that other users can
+        read is refused.
+
+        Entries are stored under hashed keys, scoped by `namespace`.
+        Credentials are encrypted at rest with `encryption_key` (a Fernet key,
+        see `cryptography.fernet`), which requires `cryptography` (`id[cache]`).
+        Storing them unencrypted instead takes an explicit `plaintext=True`.
+        """
+        super().__init__(leeway)
+        self._sealer = _Sealer(namespace, encryption_key, plaintext)
+        self._lock = threading.Lock()
+        path = os.fspath(path)
+        if sys.platform != "win32" and path != ":memory:":
+            _create_private(path)
+        self._db = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS tokens "
+                "(key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL)"
+            )
+
+    def get(self, key: str) -> str | None:
+        """
+        See `CacheBackend.get`.
+        """
+        try:
+            with self._lock:
+                row = self._db.execute(
+                    "SELECT value FROM tokens WHERE key = ? AND expires_at > ?",
+                    (self._sealer.key(key), time.time() + self.leeway),
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"cache: SQLite lookup failed: {e}")
+            return None
+        if row is None:
+            return None
+        entry = self._sealer.open(row[0])
+        return entry[0] if entry is not None else None
+
+    def put(self, key: str, credential: str, expires_at: float) -> None:
+        """
+        See `CacheBackend.put`. Expired entries are purged at the same time.
+        """
+        try:
+            with self._lock, self._db:
+                self._db.execute("DELETE FROM tokens WHERE expires_at <= ?", (time.time(),))
+                self._db.execute(
+                    "INSERT OR REPLACE INTO tokens VALUES (?, ?, ?)",
+                    (
+                        self._sealer.key(key),
+                        self._sealer.seal(credential, expires_at),
+                        expires_at,
+                    ),
+                )
+        except sqlite3.Error as e:
+            logger.warning(f"cache: SQLite store failed: {e}")
+
+    def clear(self) -> None:
+        """
+        See `CacheBackend.clear`. This clears the whole database, including
+        entries cached by other processes.
+        """
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM tokens")
+
+    def close(self) -> None:
+        """
+        Close the database connection.
+        """
+        with self._lock:
+            self._db.close()
+
+
+class MemcacheTokenCache(CacheBackend):
+    """
+    A credential cache on a server speaking the memcached text protocol,
+    which can be shared between hosts.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 11211,
+        *,
+        leeway: float = 60,
+        namespace: str = "",
+        encryption_key: bytes | str | None = None,
+        plaintext: bool = False,
+        timeout: float = 1.0,
+    ) -> None:
+        """
+        Create a new cache on the memcached server at `host:port`. Connection
+        failures are logged and treated as cache misses, waiting no more than
+        `timeout` seconds.
+
+        See `SqliteTokenCache` for `namespace`, `encryption_key` and
+        `plaintext`.
+        """
+        super().__init__(leeway)
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._sealer = _Sealer(namespace, encryption_key, plaintext)
+        self._lock = threading.Lock()
+        self._sock: socket.socket | None = None
+        self._file: Any = None
+        # memcached can't enumerate keys, so `clear` deletes the ones we set.
+        self._keys: set[str] = set()
+
+    def _command(self, line: bytes, payload: bytes | None = None) -> Any:
+        # Callers must hold `self._lock`.
+        if self._sock is None:
+            self._sock = socket.create_connection((self.host, self.port), self.timeout)
+            self._file = self._sock.makefile("rb")
+        self._sock.sendall(line + b"\r\n" + (payload + b"\r\n" if payload is not None else b""))
+        return self._file
+
+    def _disconnect(self) -> None:
+        if self._sock is not None:
+            self._sock.close()
+        self._sock = self._file = None
+
+    def get(self, key: str) -> str | None:
+        """
+        See `CacheBackend.get`.
+        """
+        data = None
+        try:
+            with self._lock:
+                try:
+                    f = self._command(b"get " + self._sealer.key(key).encode())
+                    header = f.readline()
+                    if header.startswith(b"VALUE "):
+                        size = int(header.split()[3])
+                        data = f.read(size + 2)[:-2]
+                        header = f.readline()
+                    if header != b"END\r\n":
+                        raise OSError(f"unexpected response {header!r}")
+                except (OSError, ValueError, IndexError):
+                    self._disconnect()
+                    raise
+        except (OSError, ValueError, IndexError) as e:
+            logger.warning(f"cache: memcached lookup failed: {e}")
+            return None
+
+        entry = self._sealer.open(data) if data is not None else None
+        if entry is None or time.time() + self.leeway >= entry[1]:
+            return None
+        return entry[0]
+
+    def put(self, key: str, credential: str, expires_at: float) -> None:
+        """
+        See `CacheBackend.put`. The entry's memcached TTL is its remaining
+        lifetime, less the leeway.
+        """
+        ttl = int(expires_at - self.leeway - time.time())
+        if ttl <= 0:
+            return
+        storage_key = self._sealer.key(key)
+        payload = self._sealer.seal(credential, expires_at)
+        try:
+            with self._lock:
+                try:
+                    line = f"set {storage_key} 0 {ttl} {len(payload)}".encode()
+                    response = self._command(line, payload).readline()
+                    if response != b"STORED\r\n":
+                        raise OSError(f"unexpected response {response!r}")
+                    self._keys.add(storage_key)
+                except OSError:
+                    self._disconnect()
+                    raise
+        except OSError as e:
+            logger.warning(f"cache: memcached store failed: {e}")
+
+    def clear(self) -> None:
+        """
+        See `CacheBackend.clear`. Only entries cached through this instance
+        are dropped.
+        """
+        with self._lock:
+            keys, self._keys = self._keys, set()
+            try:
+                for storage_key in keys:
+                    self._command(f"delete {storage_key}".encode()).readline()
+            except OSError as e:
+                self._disconnect()
+                logger.warning(f"cache: memcached delete failed: {e}")
+
+    def close(self) -> None:
+        """
+        Close the connection to the server.
+        """
+        with self._lock:
+            self._disconnect()
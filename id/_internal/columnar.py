@@ -0,0 +1,230 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Columnar decoding of many tokens' claims at once, for analytics.
+
+Claims are decoded straight into typed buffers: timestamps into int64 columns,
+and strings into int32 codes over a table of distinct values (dictionary
+encoding). These are handed to NumPy or Arrow without copying, and neither is
+needed to decode. Both are optional (`id[columnar]`).
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+from array import array
+from collections.abc import Iterable, Iterator, Sequence
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    import numpy
+    import pyarrow
+
+logger = logging.getLogger(__name__)
+
+STRING_CLAIMS = ("iss", "sub", "aud", "repository")
+TIMESTAMP_CLAIMS = ("iat", "nbf", "exp")
+
+# NOTE: Missing (or non-numeric) timestamps get this sentinel in the int64
+# columns, like the `exp` column of a `TokenArchive`; missing strings get the
+# code -1. Arrow columns have nulls instead.
+MISSING = -(2**63)
+
+# Tokens are decoded this many at a time; see `_claims`.
+_CHUNK = 4096
+
+
+class ClaimColumns:
+    """
+    The claims of many tokens, one column per claim.
+
+    `timestamps` maps each timestamp claim to its int64 column, and `codes`
+    maps each string claim to its int32 codes into `values`, that claim's
+    distinct values in order of first appearance.
+    """
+
+    def __init__(self, strings: Sequence[str], timestamps: Sequence[str]) -> None:
+        """
+        Create empty columns for the `strings` and `timestamps` claims.
+        """
+        self.codes = {claim: array("i") for claim in strings}
+        self.values: dict[str, list[str]] = {claim: [] for claim in strings}
+        self.timestamps = {claim: array("q") for claim in timestamps}
+        self._count = 0
+
+        # Each string claim's code for every value seen so far; values that
+        # aren't strings have the code -1.
+        self._index: dict[str, dict[Any, int]] = {claim: {} for claim in strings}
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _extend(self, decoded: list[dict[str, Any]]) -> None:
+        # Each column is built in a few passes over the whole chunk, which
+        # run in C, rather than with a Python loop over its tokens.
+        raw: list[Any]
+        for claim, codes in self.codes.items():
+            raw = [claims.get(claim) for claims in decoded]
+            try:
+                distinct = dict.fromkeys(raw)
+            except TypeError:
+                # Lists (like `aud`) and objects aren't hashable.
+                raw = [_string(value) for value in raw]
+                distinct = dict.fromkeys(raw)
+
+            index, values = self._index[claim], self.values[claim]
+            for value in distinct:
+                if value not in index:
+                    if isinstance(value, str):
+                        index[value] = len(values)
+                        values.append(value)
+                    else:
+                        index[value] = -1
+            codes.extend(array("i", map(index.__getitem__, raw)))
+
+        for claim, column in self.timestamps.items():
+            raw = [claims.get(claim) for claims in decoded]
+            if set(map(type, raw)) <= {int}:
+                try:
+                    column.extend(array("q", raw))
+                    continue
+                except OverflowError:
+                    pass
+            column.extend(array("q", map(_timestamp, raw)))
+
+        self._count += len(decoded)
+
+    def to_numpy(self) -> dict[str, numpy.ndarray]:
+        """
+        Return each column as a NumPy array, sharing memory with this object.
+
+        Timestamps are `int64`, with `MISSING` where absent. Strings are
+        their `int32` codes into `values`, with -1 where absent, as
+        `pandas.Categorical.from_codes` expects.
+
+        Raises `IdentityError` if NumPy isn't installed.
+        """
+        from .. import IdentityError
+
+        try:
+            import numpy
+        except ImportError as e:
+            raise IdentityError("NumPy columns require `numpy` (id[columnar])") from e
+
+        columns = {
+            claim: numpy.frombuffer(codes, dtype=numpy.int32) for claim, codes in self.codes.items()
+        }
+        for claim, column in self.timestamps.items():
+            columns[claim] = numpy.frombuffer(column, dtype=numpy.int64)
+        return columns
+
+    def to_arrow(self) -> pyarrow.Table:
+        """
+        Return the columns as an Arrow table, which can be written out with
+        `pyarrow.parquet.write_table`.
+
+        Timestamps are `int64` columns and strings are dictionary-encoded
+        (`int32` indices over `string` values); absent claims are null.
+
+        Raises `IdentityError` if PyArrow isn't installed.
+        """
+        from .. import IdentityError
+
+        try:
+            import pyarrow
+            import pyarrow.compute
+        except ImportError as e:
+            raise IdentityError("Arrow columns require `pyarrow` (id[columnar])") from e
+
+        def column(buffer: array[int], type: pyarrow.DataType, missing: int) -> pyarrow.Array:
+            values = pyarrow.Array.from_buffers(
+                type, len(buffer), [None, pyarrow.py_buffer(buffer)]
+            )
+            null = pyarrow.scalar(None, type)
+            return pyarrow.compute.if_else(pyarrow.compute.equal(values, missing), null, values)
+
+        columns: dict[str, pyarrow.Array] = {}
+        for claim, codes in self.codes.items():
+            indices = column(codes, pyarrow.int32(), -1)
+            dictionary = pyarrow.array(self.values[claim], pyarrow.string())
+            columns[claim] = pyarrow.DictionaryArray.from_arrays(indices, dictionary)
+        for claim, timestamps in self.timestamps.items():
+            columns[claim] = column(timestamps, pyarrow.int64(), MISSING)
+        return pyarrow.table(columns)
+
+
+def _string(value: Any) -> str | None:
+    if isinstance(value, list) and len(value) == 1:
+        value = value[0]
+    return value if isinstance(value, str) else None
+
+
+def _timestamp(value: Any) -> int:
+    # NaN and infinities fail the range check too.
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        if MISSING < value < 2**63:
+            return int(value)
+    return MISSING
+
+
+def _claims(tokens: Iterable[str]) -> Iterator[list[dict[str, Any]]]:
+    """
+    Yield the claims of well-formed tokens, a chunk at a time.
+    """
+    from .. import _b64decode
+
+    chunk: list[dict[str, Any]] = []
+    for lineno, token in enumerate(tokens, start=1):
+        token = token.strip()
+        if not token:
+            continue
+        parts = token.split(".")
+        try:
+            if len(parts) != 3:
+                raise ValueError("not a JWT")
+            claims = json.loads(_b64decode(parts[1]))
+            if not isinstance(claims, dict):
+                raise ValueError("payload is not a JSON object")
+        except ValueError as e:
+            logger.warning(f"columns: skipping malformed token #{lineno}: {e}")
+            continue
+        chunk.append(claims)
+        if len(chunk) == _CHUNK:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def decode_columns(
+    tokens: Iterable[str],
+    *,
+    strings: Sequence[str] = STRING_CLAIMS,
+    timestamps: Sequence[str] = TIMESTAMP_CLAIMS,
+) -> ClaimColumns:
+    """
+    Decode the claims of each of `tokens` into columns: one for each of the
+    `strings` claims, and one for each of the `timestamps` claims.
+
+    String claims that aren't strings are treated as absent, except for an
+    `aud` list holding a single audience. Fractional timestamps are truncated.
+
+    Malformed tokens are logged and skipped, as for `build_archive`.
+    """
+    columns = ClaimColumns(strings, timestamps)
+    for decoded in _claims(tokens):
+        columns._extend(decoded)
+    return columns
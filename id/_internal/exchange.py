@@ -0,0 +1,168 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Exchange of ambient OIDC credentials for downstream credentials, such as
+PyPI trusted publishing API tokens.
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from typing import TYPE_CHECKING, Any
+
+import urllib3
+
+from .cache import CacheBackend, TokenCache
+from .oidc.response import error_body
+
+if TYPE_CHECKING:
+    from .session import Session
+
+logger = logging.getLogger(__name__)
+
+
+class TokenExchange:
+    """
+    Exchanges the ambient OIDC credential for an audience for a downstream
+    credential, by POSTing it to an exchange endpoint, and caches the result
+    until it expires.
+
+    Concurrent callers share a single in-flight exchange.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        audience: str,
+        *,
+        request_field: str = "token",
+        response_field: str = "token",
+        default_lifetime: float | None = None,
+        cache: CacheBackend | None = None,
+        session: Session | None = None,
+    ) -> None:
+        """
+        Create a new exchange of credentials for `audience` at `url`.
+
+        The OIDC credential is sent as the `request_field` member of a JSON
+        object, and the downstream credential is read from the
+        `response_field` member of the JSON response. Its expiry is read from
+        an `expires` (a UNIX timestamp) or `expires_in` (seconds) member;
+        without either, it's cached for `default_lifetime` seconds, or not at
+        all if that's `None`.
+
+        Downstream credentials are cached in `cache`, or in memory by default,
+        and OIDC credentials are detected and exchanged with `session`, or the
+        default session.
+        """
+        self.url = url
+        self.audience = audience
+        self.request_field = request_field
+        self.response_field = response_field
+        self.default_lifetime = default_lifetime
+
+        self._cache = cache if cache is not None else TokenCache()
+        self._session = session
+        self._lock = threading.Lock()
+        self._inflight: Future[str | None] | None = None
+
+    def credential(self) -> str | None:
+        """
+        Return a downstream credential, exchanging a freshly detected OIDC
+        credential for it unless a cached one is still valid.
+
+        Returns `None` if there's no ambient OIDC credential for the audience.
+        Raises `AmbientCredentialError` if detection or the exchange fails.
+        """
+        key = self._key()
+        credential = self._cache.get(key)
+        if credential is not None:
+            return credential
+
+        leading: Future[str | None] = Future()
+        with self._lock:
+            inflight = self._inflight
+            if inflight is None:
+                self._inflight = leading
+        if inflight is not None:
+            return inflight.result()
+
+        try:
+            # Another caller may have finished an exchange since we looked.
+            credential = self._cache.get(key) or self._exchange(key)
+        except BaseException as e:
+            leading.set_exception(e)
+            raise
+        else:
+            leading.set_result(credential)
+            return credential
+        finally:
+            with self._lock:
+                self._inflight = None
+
+    def _key(self) -> str:
+        from .oidc.ambient import _cache_key
+
+        # Scoped to the OIDC credential's identity, like the session's own.
+        return f"exchange:{self.url}:{_cache_key(self.audience)}"
+
+    def _exchange(self, key: str) -> str | None:
+        from .. import AmbientCredentialError, _get_default_session
+        from .oidc import ambient
+
+        session = self._session if self._session is not None else _get_default_session()
+        oidc_token = session.detect_credential(self.audience)
+        if oidc_token is None:
+            return None
+
+        logger.debug(f"Exchange: exchanging OIDC token at {self.url}")
+        try:
+            with session._activated():
+                resp = ambient._request(
+                    "POST", self.url, json={self.request_field: oidc_token}, timeout=30
+                )
+        except urllib3.exceptions.MaxRetryError:
+            raise AmbientCredentialError("Exchange: token exchange request timed out")
+
+        if resp.status != 200:
+            raise AmbientCredentialError(
+                f"Exchange: token exchange failed (code={resp.status}, body={error_body(resp)})"
+            )
+
+        try:
+            body: dict[str, Any] = resp.json()
+            credential = body[self.response_field]
+            if not isinstance(credential, str):
+                raise ValueError("credential is not a string")
+        except Exception as e:
+            raise AmbientCredentialError("Exchange: malformed or incomplete JSON") from e
+
+        expires_at = self._expiry(body)
+        if expires_at is not None:
+            self._cache.put(key, credential, expires_at)
+        return credential
+
+    def _expiry(self, body: dict[str, Any]) -> float | None:
+        expires, expires_in = body.get("expires"), body.get("expires_in")
+        if isinstance(expires, (int, float)) and not isinstance(expires, bool):
+            return float(expires)
+        if isinstance(expires_in, (int, float)) and not isinstance(expires_in, bool):
+            return time.time() + expires_in
+        if self.default_lifetime is not None:
+            return time.time() + self.default_lifetime
+        return None
@@ -0,0 +1,345 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A local OIDC issuer minting signed, provider-shaped test tokens, for
+load-testing relying parties.
+
+This requires the `cryptography` package (installable with `id[issuer]`).
+"""
+
+from __future__ import annotations
+
+import base64
+import hashlib
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable
+from urllib.parse import parse_qs, urlparse
+
+_ALGORITHMS = ("ES256", "RS256")
+
+# The most tokens the served `/token` endpoint mints in one request.
+_MAX_COUNT = 1000
+
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def _b64int(n: int, length: int | None = None) -> str:
+    return _b64(n.to_bytes(length or (n.bit_length() + 7) // 8, "big"))
+
+
+def _json(obj: Any) -> bytes:
+    return json.dumps(obj, separators=(",", ":"), sort_keys=True).encode()
+
+
+def _github(subject: str, now: int) -> dict[str, Any]:
+    repository = subject or "example/example"
+    owner = repository.split("/")[0]
+    return {
+        "sub": f"repo:{repository}:ref:refs/heads/main",
+        "repository": repository,
+        "repository_owner": owner,
+        "repository_visibility": "public",
+        "ref": "refs/heads/main",
+        "ref_type": "branch",
+        "sha": hashlib.sha1(repository.encode()).hexdigest(),  # nosec B324
+        "workflow": "release",
+        "workflow_ref": f"{repository}/.github/workflows/release.yml@refs/heads/main",
+        "job_workflow_ref": f"{repository}/.github/workflows/release.yml@refs/heads/main",
+        "event_name": "push",
+        "actor": owner,
+        "run_id": str(now),
+        "run_attempt": "1",
+        "runner_environment": "github-hosted",
+    }
+
+
+def _gcp(subject: str, now: int) -> dict[str, Any]:
+    email = subject or "example@example.iam.gserviceaccount.com"
+    return {
+        "sub": str(int(hashlib.sha256(email.encode()).hexdigest()[:20], 16)),
+        "azp": str(int(hashlib.sha256(email.encode()).hexdigest()[:20], 16)),
+        "email": email,
+        "email_verified": True,
+    }
+
+
+def _gitlab(subject: str, now: int) -> dict[str, Any]:
+    project = subject or "example/example"
+    return {
+        "sub": f"project_path:{project}:ref_type:branch:ref:main",
+        "namespace_path": project.split("/")[0],
+        "project_path": project,
+        "ref": "main",
+        "ref_type": "branch",
+        "ref_protected": "true",
+        "pipeline_id": str(now),
+        "pipeline_source": "push",
+        "user_login": project.split("/")[0],
+        "ci_config_ref_uri": f"gitlab.com/{project}//.gitlab-ci.yml@refs/heads/main",
+        "runner_environment": "gitlab-hosted",
+    }
+
+
+def _circleci(subject: str, now: int) -> dict[str, Any]:
+    project = subject or str(uuid.uuid5(uuid.NAMESPACE_URL, "example"))
+    org = str(uuid.uuid5(uuid.NAMESPACE_URL, f"org:{project}"))
+    user = str(uuid.uuid5(uuid.NAMESPACE_URL, f"user:{project}"))
+    return {
+        "sub": f"org/{org}/project/{project}/user/{user}",
+        "oidc.circleci.com/project-id": project,
+        "oidc.circleci.com/context-ids": [],
+        "oidc.circleci.com/vcs-origin": f"github.com/{org}/{project}",
+        "oidc.circleci.com/vcs-ref": "refs/heads/main",
+    }
+
+
+PROVIDERS: dict[str, Callable[[str, int], dict[str, Any]]] = {
+    "github": _github,
+    "gcp": _gcp,
+    "gitlab": _gitlab,
+    "circleci": _circleci,
+}
+
+
+class LocalIssuer:
+    """
+    An OIDC issuer that mints signed, provider-shaped tokens from a local key,
+    and can serve its discovery document and JWKS on localhost.
+    """
+
+    def __init__(
+        self,
+        *,
+        provider: str = "github",
+        algorithm: str = "ES256",
+        issuer: str = "http://localhost",
+        lifetime: int = 300,
+        private_key_pem: bytes | None = None,
+    ) -> None:
+        """
+        Create a new issuer with tokens shaped like `provider`'s (one of
+        `github`, `gcp`, `gitlab` or `circleci`), valid for `lifetime` seconds.
+
+        Tokens are signed with `algorithm` (`ES256` or `RS256`), using the PEM
+        encoded `private_key_pem` or a freshly generated key. `issuer` is used
+        as the `iss` claim; `serve` replaces it with the local server's URL.
+
+        Raises `IdentityError` if `cryptography` isn't installed.
+        """
+        from .. import IdentityError
+
+        if provider not in PROVIDERS:
+            raise ValueError(f"unknown provider {provider!r}; expected one of {list(PROVIDERS)}")
+        if algorithm not in _ALGORITHMS:
+            raise ValueError(f"unknown algorithm {algorithm!r}; expected one of {_ALGORITHMS}")
+
+        try:
+            from cryptography.hazmat.primitives import hashes, serialization
+            from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa, utils
+        except ImportError as e:
+            raise IdentityError("the local issuer requires `cryptography` (id[issuer])") from e
+
+        self.provider = provider
+        self.algorithm = algorithm
+        self.issuer = issuer
+        self.lifetime = lifetime
+        self._shape = PROVIDERS[provider]
+
+        if private_key_pem is not None:
+            key = serialization.load_pem_private_key(private_key_pem, password=None)
+        elif algorithm == "ES256":
+            key = ec.generate_private_key(ec.SECP256R1())
+        else:
+            key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+        self._sign: Callable[[bytes], bytes]
+        if algorithm == "ES256":
+            if not isinstance(key, ec.EllipticCurvePrivateKey) or not isinstance(
+                key.curve, ec.SECP256R1
+            ):
+                raise ValueError("ES256 requires an EC P-256 private key")
+            numbers = key.public_key().public_numbers()
+            jwk = {
+                "kty": "EC",
+                "crv": "P-256",
+                "x": _b64int(numbers.x, 32),
+                "y": _b64int(numbers.y, 32),
+            }
+            algorithm_ = ec.ECDSA(hashes.SHA256())
+
+            def sign(message: bytes) -> bytes:
+                # JWS wants the raw `r || s` form, not the DER that OpenSSL emits.
+                r, s = utils.decode_dss_signature(key.sign(message, algorithm_))
+                return r.to_bytes(32, "big") + s.to_bytes(32, "big")
+
+            self._sign = sign
+        else:
+            if not isinstance(key, rsa.RSAPrivateKey):
+                raise ValueError("RS256 requires an RSA private key")
+            rsa_numbers = key.public_key().public_numbers()
+            jwk = {"kty": "RSA", "n": _b64int(rsa_numbers.n), "e": _b64int(rsa_numbers.e)}
+            pkcs1v15, sha256 = padding.PKCS1v15(), hashes.SHA256()
+            self._sign = lambda message: key.sign(message, pkcs1v15, sha256)
+
+        # RFC 7638 thumbprint, over the required members in lexicographic order.
+        self.kid = _b64(hashlib.sha256(_json(jwk)).digest())
+        self._jwk = {**jwk, "kid": self.kid, "alg": algorithm, "use": "sig"}
+        self._private_key_pem = key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        )
+
+        # The header is identical for every token, so it's serialized once.
+        self._header = _b64(_json({"alg": algorithm, "kid": self.kid, "typ": "JWT"}))
+        self._server: ThreadingHTTPServer | None = None
+
+    @property
+    def private_key_pem(self) -> bytes:
+        """
+        The issuer's signing key, PEM encoded, for reuse across runs.
+        """
+        return self._private_key_pem
+
+    def jwks(self) -> dict[str, Any]:
+        """
+        The issuer's JSON Web Key Set.
+        """
+        return {"keys": [self._jwk]}
+
+    def discovery(self) -> dict[str, Any]:
+        """
+        The issuer's OpenID Provider configuration document.
+        """
+        return {
+            "issuer": self.issuer,
+            "jwks_uri": f"{self.issuer}/.well-known/jwks",
+            "response_types_supported": ["id_token"],
+            "subject_types_supported": ["public"],
+            "id_token_signing_alg_values_supported": [self.algorithm],
+        }
+
+    def mint(self, audience: str, subject: str = "", **claims: Any) -> str:
+        """
+        Mint a single token for `audience`. See `mint_batch`.
+        """
+        return self.mint_batch(audience, 1, subject, **claims)[0]
+
+    def mint_batch(self, audience: str, count: int, subject: str = "", **claims: Any) -> list[str]:
+        """
+        Mint `count` tokens for `audience`, shaped like the issuer's provider.
+
+        `subject` selects the provider-specific identity (a repository for
+        GitHub, a service account email for GCP, a project path for GitLab or
+        a project ID for CircleCI), and `claims` override or extend the claims
+        of every token. Tokens in a batch differ only in their `jti`.
+        """
+        now = int(time.time())
+        base = {
+            **self._shape(subject, now),
+            "iss": self.issuer,
+            "aud": audience,
+            "iat": now,
+            "nbf": now,
+            "exp": now + self.lifetime,
+            **claims,
+        }
+        base.pop("jti", None)
+
+        # Serialize the shared claims once, and splice a fresh `jti` into each
+        # token's payload rather than re-serializing the whole object.
+        prefix = _json(base)[:-1] + b',"jti":"'
+        header = self._header.encode() + b"."
+        sign = self._sign
+
+        tokens = []
+        for _ in range(count):
+            payload = prefix + uuid.uuid4().hex.encode() + b'"}'
+            signing_input = header + base64.urlsafe_b64encode(payload).rstrip(b"=")
+            signature = base64.urlsafe_b64encode(sign(signing_input)).rstrip(b"=")
+            tokens.append((signing_input + b"." + signature).decode())
+        return tokens
+
+    def serve(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """
+        Serve the issuer on `host:port` from a background thread, and return
+        its URL, which becomes the `iss` of subsequently minted tokens.
+
+        Besides discovery (`/.well-known/openid-configuration`) and the JWKS
+        (`/.well-known/jwks`), the server mints tokens at
+        `/token?audience=...`, in the same shape as the GitHub Actions token
+        endpoint, so it can stand in for it via `ACTIONS_ID_TOKEN_REQUEST_URL`.
+        A batch of up to 1000 tokens can be minted at once with `count`.
+        """
+        issuer = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self) -> None:
+                url = urlparse(self.path)
+                body: Any
+                if url.path == "/.well-known/openid-configuration":
+                    body = issuer.discovery()
+                elif url.path == "/.well-known/jwks":
+                    body = issuer.jwks()
+                elif url.path == "/token":
+                    query = parse_qs(url.query)
+                    audience = query.get("audience", [issuer.issuer])[0]
+                    try:
+                        count = int(query.get("count", ["1"])[0])
+                    except ValueError:
+                        count = 0
+                    if not 1 <= count <= _MAX_COUNT:
+                        self.send_error(400, f"count must be between 1 and {_MAX_COUNT}")
+                        return
+                    subject = query.get("subject", [""])[0]
+                    tokens = issuer.mint_batch(audience, count, subject)
+                    body = {"value": tokens[0]} if count == 1 else {"values": tokens}
+                else:
+                    self.send_error(404)
+                    return
+
+                data = _json(body)
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+        self.issuer = f"http://{host}:{self._server.server_address[1]}"
+        return self.issuer
+
+    def shutdown(self) -> None:
+        """
+        Stop serving, if `serve` was called.
+        """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
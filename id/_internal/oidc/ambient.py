@@ -18,42 +18,126 @@ Ambient OIDC credential detection.
 
 from __future__ import annotations
 
+import contextlib
+import functools
+import hashlib
 import json
 import logging
 import os
 import re
+import secrets
+import shlex
 import shutil
+import socket
 import subprocess  # nosec B404
-from typing import Any, TextIO
+import threading
+import time
+from collections.abc import Iterator, Mapping
+from contextvars import ContextVar
+from typing import Any, Callable, TextIO, TypeVar
 from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
 
 import urllib3
 
 from ... import AmbientCredentialError, GitHubOidcPermissionCredentialError
+from .cassette import current as _current_cassette
+from .config import current as _current_config
+from .hedging import lost as _hedge_lost
+from .response import BufferedResponse, read_capped
+from .response import error_body as _error_body
 
 logger = logging.getLogger(__name__)
 
+_T = TypeVar("_T")
+
 _GCP_PRODUCT_NAME_FILE = "/sys/class/dmi/id/product_name"
-_GCP_TOKEN_REQUEST_URL = (
-    "http://metadata/computeMetadata/v1/instance/service-accounts/default/token"  # noqa # nosec B105
-)
-_GCP_IDENTITY_REQUEST_URL = (
-    "http://metadata/computeMetadata/v1/instance/service-accounts/default/identity"  # noqa
-)
+# The metadata server's well-known link-local address, which (unlike the
+# `metadata` hostname) needs no trip through the resolver's search domains.
+_GCP_METADATA_HOST = "169.254.169.254"
+_GCP_TOKEN_REQUEST_PATH = "/computeMetadata/v1/instance/service-accounts/default/token"  # noqa # nosec B105
+_GCP_IDENTITY_REQUEST_PATH = "/computeMetadata/v1/instance/service-accounts/default/identity"
+_GCP_EMAIL_REQUEST_PATH = "/computeMetadata/v1/instance/service-accounts/default/email"
+_GCP_PRODUCT_NAMES = {"Google", "Google Compute Engine"}
 _GCP_GENERATEIDTOKEN_REQUEST_URL = (
     "https://iamcredentials.googleapis.com/v1/projects/-/serviceAccounts/{}:generateIdToken"  # noqa
 )
 
+# Set by GCP runtimes that may lack the DMI product name file (Cloud Run and
+# Cloud Functions), and in which the metadata server is probed instead. Other
+# hosts (including GKE sandboxes) can opt in with `GCE_METADATA_HOST`.
+_GCP_RUNTIME_ENV_VARS = ("K_SERVICE", "CLOUD_RUN_JOB", "FUNCTION_TARGET")
+
+# A metadata server answers probes within milliseconds; elsewhere, the
+# link-local address may not answer at all, so don't wait long.
+_GCP_PROBE_TIMEOUT = urllib3.Timeout(connect=0.25, read=1.0)
+
+# Besides the audience, these determine the credential that's minted: every
+# variable the detectors read (including those holding credentials, like the
+# GitHub Actions request token), and the job the Buildkite agent or the
+# `circleci` CLI mint for. Per-audience variables are added by `_cache_key`.
+_IDENTITY_ENV_VARS = (
+    "GITHUB_ACTIONS",
+    "ACTIONS_ID_TOKEN_REQUEST_TOKEN",
+    "ACTIONS_ID_TOKEN_REQUEST_URL",
+    "GOOGLE_SERVICE_ACCOUNT_NAME",
+    "GCE_METADATA_HOST",
+    *_GCP_RUNTIME_ENV_VARS,
+    "BUILDKITE",
+    "BUILDKITE_JOB_ID",
+    "GITLAB_CI",
+    "CI_JOB_ID",
+    "CIRCLECI",
+    "CIRCLE_WORKFLOW_JOB_ID",
+)
+
+# Suffixes of the per-audience variables the detectors read; see `_env_var_name`.
+_AUDIENCE_SUFFIXES = ("ID_TOKEN", "ID_TOKEN_FILE")
+
+# Compiled patterns are immutable and safe to share between threads, including
+# on free-threaded builds; see the NOTE in `id/__init__.py`.
 _env_var_regex = re.compile(r"[^A-Z0-9_]|^[^A-Z_]")
 
 
+# While a trace is active (see `doctor.py`), each interaction with an issuer
+# (an HTTP request or a subprocess) is timed and appended to it.
+_trace: ContextVar[list[dict[str, Any]] | None] = ContextVar("_trace", default=None)
+
+
+@contextlib.contextmanager
+def _traced(event: dict[str, Any]) -> Iterator[dict[str, Any]]:
+    trace = _trace.get()
+    if trace is None:
+        yield event
+        return
+
+    start = time.perf_counter()
+    try:
+        yield event
+    except Exception as e:
+        event["error"] = str(e) or type(e).__name__
+        raise
+    finally:
+        event["seconds"] = time.perf_counter() - start
+        trace.append(event)
+
+
+def _recorded(kind: str, request: str, real: Callable[[], _T]) -> _T:
+    # Every interaction with the environment goes through here, so that an
+    # active cassette (see `cassette.py`) can record or replay it.
+    cassette = _current_cassette()
+    if cassette is None:
+        return real()
+    return cassette.interact(kind, request, real)
+
+
 def _request(
     method: str,
     url: str,
     *,
     fields: dict[str, str] | None = None,
+    provider: str | None = None,
     **kwargs: Any,
-) -> urllib3.BaseHTTPResponse:
+) -> BufferedResponse:
     """request wrapper that handles adding query parameters to URLs that may already have them"""
     _encode_url_methods = {"DELETE", "GET", "HEAD", "OPTIONS"}
     if method.upper() in _encode_url_methods and fields:
@@ -65,7 +149,127 @@ def _request(
         url = urlunparse(url_parts)
         fields = None
 
-    return urllib3.request(method, url, fields=fields, **kwargs)
+    config = _current_config()
+    limiter = config.rate_limits.get(provider) if provider is not None else None
+
+    # Query strings are left out of traces, circuit and bucket names and
+    # errors, since they may carry credentials.
+    url_parts = urlparse(url)
+    endpoint = f"{url_parts.scheme}://{url_parts.netloc}{url_parts.path}"
+
+    # Cassettes identify requests by everything but their headers, which
+    # carry credentials.
+    interaction = f"{method} {url}"
+    body = kwargs.get("json", fields)
+    if body is not None:
+        interaction += f" {json.dumps(body, sort_keys=True)}"
+
+    # Bodies are streamed, so that an oversized one is rejected without being
+    # read into memory.
+    urllib3_kwargs: dict[str, Any] = {"preload_content": False}
+    if limiter is not None:
+        # urllib3 otherwise honors `Retry-After` itself, holding back only
+        # this caller; leave it to the limiter, which holds back every caller.
+        urllib3_kwargs["retries"] = urllib3.Retry(3, respect_retry_after_header=False)
+    urllib3_kwargs.update(kwargs)
+    http2_kwargs = kwargs
+
+    # Token requests' fixed timeouts give way to learned ones, per issuer;
+    # other requests (like the GCP metadata server probe) keep theirs.
+    timeouts = config.timeouts if provider is not None else None
+    origin = f"{url_parts.scheme}://{url_parts.netloc}"
+    read_timeout = 0.0
+    if timeouts is not None and isinstance(kwargs.get("timeout"), (int, float)):
+        connect_timeout, read_timeout = timeouts.timeouts(origin, kwargs["timeout"])
+        urllib3_kwargs["timeout"] = urllib3.Timeout(connect=connect_timeout, read=read_timeout)
+        # A read that times out isn't retried: the learned timeout is the
+        # whole wait, rather than one of several.
+        urllib3_kwargs["retries"] = urllib3.Retry(
+            3, read=0, respect_retry_after_header=limiter is None
+        )
+        # The HTTP/2 transport takes a single timeout, for the whole request.
+        http2_kwargs = {**kwargs, "timeout": read_timeout}
+    else:
+        timeouts = None
+
+    def headers() -> Any:
+        transport = config.http2
+        if transport is None:
+            if config.pool is not None:
+                return config.pool.request(method, url, fields=fields, **urllib3_kwargs)
+            return urllib3.request(method, url, fields=fields, **urllib3_kwargs)
+        return transport.request(method, url, fields=fields, preload_content=False, **http2_kwargs)
+
+    def fetch() -> BufferedResponse:
+        if timeouts is None:
+            resp = headers()
+        else:
+            start = time.perf_counter()
+            try:
+                resp = headers()
+            except urllib3.exceptions.HTTPError as e:
+                reason = getattr(e, "reason", e)
+                if isinstance(reason, (urllib3.exceptions.TimeoutError, socket.timeout)):
+                    timeouts.observe(origin, read_timeout, timed_out=True)
+                raise
+            timeouts.observe(origin, time.perf_counter() - start)
+
+        if isinstance(resp, BufferedResponse):
+            # HTTP/2 responses are capped as they're received.
+            return resp
+        if _hedge_lost():
+            # The other attempt of this hedged request has already answered,
+            # so this one's body isn't read; its connection is closed rather
+            # than reused with the body still on the wire. The status is
+            # kept for the circuit breaker and rate limiter.
+            resp.close()
+            resp.release_conn()
+            return BufferedResponse(resp.status, resp.headers, b"")
+        return read_capped(resp, endpoint)
+
+    # Replayed requests don't reach the transport, so adaptive timeouts only
+    # learn from the network; circuit breakers and rate limits still apply.
+    def send() -> BufferedResponse:
+        return _recorded("http", interaction, fetch)
+
+    with _traced({"kind": "http", "method": method, "url": endpoint}) as event:
+        # The circuit breaker wraps the rate limiter, so that an open circuit
+        # fails without queueing and time spent queueing isn't a failure.
+        attempt: Callable[[], BufferedResponse] = send
+        if limiter is not None:
+            attempt = functools.partial(limiter.call, endpoint, send)
+        if config.circuit_breaker is not None:
+            resp = config.circuit_breaker.call(endpoint, attempt, _is_outage)
+        else:
+            resp = attempt()
+        event["status"] = resp.status
+        return resp
+
+
+def _is_outage(resp: BufferedResponse) -> bool:
+    # Client errors (bad audience, missing permissions) say nothing about
+    # whether the issuer is up, so only server errors and throttling count.
+    return resp.status >= 500 or resp.status == 429
+
+
+def _idempotent_request(method: str, url: str, **kwargs: Any) -> BufferedResponse:
+    """
+    `_request`, for requests that are safe to repeat: these are hedged when a
+    `HedgingPolicy` is configured.
+    """
+    policy = _current_config().hedging
+    # A cassette records (or replays) every request once, in order; hedging
+    # would record duplicates, and replays don't wait on the network.
+    if policy is None or _current_cassette() is not None:
+        return _request(method, url, **kwargs)
+
+    # Each attempt runs on the policy's threads, in its own copy of the
+    # caller's context so that traces and the active session still apply.
+    url_parts = urlparse(url)
+    return policy.run(
+        f"{url_parts.scheme}://{url_parts.netloc}{url_parts.path}",
+        functools.partial(_request, method, url, **kwargs),
+    )
 
 
 # Wrap `open` for testing purposes
@@ -73,7 +277,185 @@ def _open(filename: str) -> TextIO:
     return open(filename)
 
 
-def detect_github(audience: str) -> str | None:
+def _read(filename: str) -> str:
+    with _open(filename) as f:
+        return f.read()
+
+
+def _which(name: str) -> str | None:
+    return _recorded("which", name, lambda: shutil.which(name))
+
+
+def _run(cmd: list[str], env: Mapping[str, str] | None) -> subprocess.CompletedProcess[str]:
+    # NOTE(alex): We're silencing `bandit` here. The reasoning for ignoring each
+    # test are as follows.
+    #
+    # B603: This is complaining about invoking an external executable. However,
+    # there doesn't seem to be any way to do this that satisfies `bandit` so I
+    # think we need to ignore this.
+    # More context at:
+    #   https://github.com/PyCQA/bandit/issues/333
+    #
+    # B607: This is complaining about invoking an external executable without
+    # providing an absolute path (we just refer to whatever `buildkite-agent`)
+    # is in the `PATH`. For a Buildkite agent, there's no guarantee where the
+    # `buildkite-agent` is installed so again, I don't think there's anything
+    # we can do about this.
+    return _recorded(
+        "subprocess",
+        shlex.join(cmd),
+        lambda: subprocess.run(  # nosec B603, B607
+            cmd,
+            capture_output=True,
+            text=True,
+            **_child_env(env),
+        ),
+    )
+
+
+def _env_var_name(audience: str, suffix: str) -> str:
+    # construct a reasonable env var name from the audience
+    sanitized_audience = _env_var_regex.sub("_", audience.upper())
+    return f"{sanitized_audience}_{suffix}"
+
+
+def _environ(env: Mapping[str, str] | None) -> Mapping[str, str]:
+    if env is not None:
+        return env
+    cassette = _current_cassette()
+    return os.environ if cassette is None else cassette.environ()
+
+
+def _child_env(env: Mapping[str, str] | None) -> dict[str, Any]:
+    # Subprocesses inherit this process's environment, unless the caller
+    # passed one explicitly; then they see exactly that.
+    return {} if env is None else {"env": dict(env)}
+
+
+def _cache_key(audience: str, variant: str = "", env: Mapping[str, str] | None = None) -> str:
+    """
+    The key to cache credentials for `audience` under, scoped to the identity
+    they're minted for, so that a cache shared between jobs never serves one
+    job's credential to another.
+
+    `variant` distinguishes credentials for the same audience minted with
+    different options, like custom claims; see `_claims_variant`. The identity
+    is read from `env`, or the process environment, and on GCP includes the
+    host's default service account.
+    """
+    env = _environ(env)
+    # GitLab's token and the token file's path are configured per audience.
+    names = [*_IDENTITY_ENV_VARS, *(_env_var_name(audience, sfx) for sfx in _AUDIENCE_SUFFIXES)]
+    parts = [audience, *(env.get(name) or "" for name in names)]
+    parts.append(_gcp_default_account(env))
+    if variant:
+        parts.append(variant)
+    identity = hashlib.sha256("\0".join(parts).encode()).hexdigest()[:32]
+    return f"{audience}:{identity}"
+
+
+def _claims_variant(claims: Mapping[str, Any], root_issuer: bool) -> str:
+    """
+    A canonical form of a CircleCI claim set and issuer choice, so that
+    requests for the same claims in any order share cached credentials.
+    """
+    if "aud" in claims:
+        raise ValueError("custom claims can't include `aud`; pass the audience instead")
+    variant = json.dumps(claims, sort_keys=True, separators=(",", ":"))
+    return variant if root_issuer else f"{variant}:org-issuer"
+
+
+class _TokenFile:
+    """
+    An in-memory copy of a token file, which is only re-read once the file's
+    identity (device, inode, mtime and size) changes.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._stamp: tuple[int, int, int, int] | None = None
+        self._token = ""  # nosec B105
+
+    @staticmethod
+    def _stamp_of(st: os.stat_result) -> tuple[int, int, int, int]:
+        return (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def read(self) -> str:
+        # Kubernetes rotates projected tokens by atomically swapping a symlink,
+        # so following the link with `stat` sees a new inode on every rotation.
+        stamp = self._stamp_of(os.stat(self.path))
+        with self._lock:
+            if stamp != self._stamp:
+                with _open(self.path) as f:
+                    # Take the stamp from the descriptor we actually read, so that
+                    # a rotation racing with this read is picked up next time.
+                    self._stamp = self._stamp_of(os.fstat(f.fileno()))
+                    self._token = f.read().strip()
+            return self._token
+
+
+_token_files: dict[str, _TokenFile] = {}
+_token_files_lock = threading.Lock()
+
+# Whether the metadata server at each host answered a probe. The environment
+# doesn't change within a process, so each host is only probed once.
+_gcp_probes: dict[str, bool] = {}
+_gcp_probes_lock = threading.Lock()
+
+# The email of the default service account behind the metadata server at each
+# host, which identifies the credentials minted there; see `_cache_key`.
+_gcp_accounts: dict[str, str] = {}
+_gcp_accounts_lock = threading.Lock()
+
+# Stands in for a default service account that couldn't be looked up, so that
+# credentials minted for it are never shared with another process.
+_UNKNOWN_GCP_ACCOUNT = f"unknown:{secrets.token_hex(16)}"
+
+
+def _token_file(path: str) -> _TokenFile:
+    with _token_files_lock:
+        token_file = _token_files.get(path)
+        if token_file is None:
+            token_file = _token_files[path] = _TokenFile(path)
+        return token_file
+
+
+def detect_file(audience: str, env: Mapping[str, str] | None = None) -> str | None:
+    """
+    Detect and return an OIDC credential from a token file, such as a
+    Kubernetes projected service account token.
+
+    The file is configured per audience with an environment variable named
+    `<AUD>_ID_TOKEN_FILE`, where `<AUD>` is derived from the audience in the
+    same way as for GitLab (see `detect_gitlab`). The token is kept in memory
+    and the file is only re-read after it changes on disk.
+
+    Returns `None` if no token file is configured for the audience.
+
+    Raises if a token file is configured, but cannot be read.
+    """
+    logger.debug("File: looking for OIDC credentials")
+
+    var_name = _env_var_name(audience, "ID_TOKEN_FILE")
+    path = _environ(env).get(var_name)
+    if not path:
+        logger.debug(f"File: environment variable {var_name} not set; giving up")
+        return None
+
+    try:
+        token = _recorded("file", path, _token_file(path).read)
+    except OSError as e:
+        raise AmbientCredentialError(f"File: could not read token file {path!r}: {e}") from e
+
+    if not token:
+        raise AmbientCredentialError(f"File: token file {path!r} is empty")
+
+    logger.debug(f"File: found token in {path!r}")
+    return token
+
+
+def detect_github(audience: str, env: Mapping[str, str] | None = None) -> str | None:
     """
     Detect and return a GitHub Actions ambient OIDC credential.
 
@@ -84,20 +466,21 @@ def detect_github(audience: str) -> str | None:
     """
 
     logger.debug("GitHub: looking for OIDC credentials")
-    if not os.getenv("GITHUB_ACTIONS"):
+    env = _environ(env)
+    if not env.get("GITHUB_ACTIONS"):
         logger.debug("GitHub: environment doesn't look like a GH action; giving up")
         return None
 
     # If we're running on a GitHub Action, we need to issue a GET request
     # to a special URL with a special bearer token. Both are stored in
     # the environment and are only present if the workflow has sufficient permissions.
-    req_token = os.getenv("ACTIONS_ID_TOKEN_REQUEST_TOKEN")
+    req_token = env.get("ACTIONS_ID_TOKEN_REQUEST_TOKEN")
     if not req_token:
         raise GitHubOidcPermissionCredentialError(
             "GitHub: missing or insufficient OIDC token permissions, the "
             "ACTIONS_ID_TOKEN_REQUEST_TOKEN environment variable was unset"
         )
-    req_url = os.getenv("ACTIONS_ID_TOKEN_REQUEST_URL")
+    req_url = env.get("ACTIONS_ID_TOKEN_REQUEST_URL")
     if not req_url:
         raise GitHubOidcPermissionCredentialError(
             "GitHub: missing or insufficient OIDC token permissions, the "
@@ -107,9 +490,10 @@ def detect_github(audience: str) -> str | None:
     logger.debug("GitHub: requesting OIDC token")
 
     try:
-        resp = _request(
+        resp = _idempotent_request(
             "GET",
             req_url,
+            provider="GitHub",
             fields={"audience": audience},
             headers={"Authorization": f"bearer {req_token}"},
             timeout=30,
@@ -119,7 +503,7 @@ def detect_github(audience: str) -> str | None:
 
     if resp.status != 200:
         raise AmbientCredentialError(
-            f"GitHub: OIDC token request failed (code={resp.status}, body={resp.data.decode()!r})"
+            f"GitHub: OIDC token request failed (code={resp.status}, body={_error_body(resp)})"
         )
 
     try:
@@ -135,7 +519,89 @@ def detect_github(audience: str) -> str | None:
     return value
 
 
-def detect_gcp(audience: str) -> str | None:
+def _gcp_metadata_url(path: str, env: Mapping[str, str] | None = None) -> str:
+    # `GCE_METADATA_HOST` is also honored by Google's own client libraries.
+    host = _environ(env).get("GCE_METADATA_HOST") or _GCP_METADATA_HOST
+    return f"http://{host}{path}"
+
+
+def _gcp_product_name() -> str | None:
+    try:
+        return _recorded(
+            "file", _GCP_PRODUCT_NAME_FILE, lambda: _read(_GCP_PRODUCT_NAME_FILE)
+        ).strip()
+    except OSError:
+        return None
+
+
+def _gcp_runtime(env: Mapping[str, str]) -> bool:
+    # Whether the environment says there's a metadata server to probe; see
+    # `_GCP_RUNTIME_ENV_VARS`.
+    return bool(env.get("GCE_METADATA_HOST") or any(map(env.get, _GCP_RUNTIME_ENV_VARS)))
+
+
+def _gcp_default_account(env: Mapping[str, str]) -> str:
+    """
+    The email of the default service account that `detect_gcp` mints
+    credentials for on this host, or "" if it wouldn't (off GCP, or when
+    impersonating another service account).
+
+    The email is looked up once per metadata server. If it can't be, a value
+    unique to this process is returned instead.
+    """
+    if env.get("GOOGLE_SERVICE_ACCOUNT_NAME"):
+        return ""
+    if _gcp_product_name() not in _GCP_PRODUCT_NAMES:
+        if not (_gcp_runtime(env) and _gcp_metadata_reachable(env)):
+            return ""
+
+    url = _gcp_metadata_url(_GCP_EMAIL_REQUEST_PATH, env)
+    with _gcp_accounts_lock:
+        account = _gcp_accounts.get(url)
+    if account is not None:
+        return account
+
+    logger.debug(f"GCP: looking up the default service account at {url}")
+    try:
+        resp = _request("GET", url, headers={"Metadata-Flavor": "Google"}, timeout=30)
+        account = resp.data.decode().strip() if resp.status == 200 else ""
+    except (urllib3.exceptions.HTTPError, AmbientCredentialError, UnicodeDecodeError):
+        account = ""
+    if not account:
+        logger.debug("GCP: couldn't look up the default service account; not sharing credentials")
+        account = _UNKNOWN_GCP_ACCOUNT
+
+    with _gcp_accounts_lock:
+        _gcp_accounts[url] = account
+    return account
+
+
+def _gcp_metadata_reachable(env: Mapping[str, str] | None = None) -> bool:
+    url = _gcp_metadata_url("/", env)
+    with _gcp_probes_lock:
+        reachable = _gcp_probes.get(url)
+    if reachable is not None:
+        return reachable
+
+    logger.debug(f"GCP: probing metadata server at {url}")
+    try:
+        resp = _request(
+            "GET",
+            url,
+            headers={"Metadata-Flavor": "Google"},
+            timeout=_GCP_PROBE_TIMEOUT,
+            retries=urllib3.Retry(0, redirect=False),
+        )
+        reachable = resp.headers.get("Metadata-Flavor") == "Google"
+    except (urllib3.exceptions.HTTPError, AmbientCredentialError):
+        reachable = False
+
+    with _gcp_probes_lock:
+        _gcp_probes[url] = reachable
+    return reachable
+
+
+def detect_gcp(audience: str, env: Mapping[str, str] | None = None) -> str | None:
     """
     Detect an return a Google Cloud Platform ambient OIDC credential.
 
@@ -146,7 +612,8 @@ def detect_gcp(audience: str) -> str | None:
     """
     logger.debug("GCP: looking for OIDC credentials")
 
-    service_account_name = os.getenv("GOOGLE_SERVICE_ACCOUNT_NAME")
+    env = _environ(env)
+    service_account_name = env.get("GOOGLE_SERVICE_ACCOUNT_NAME")
     if service_account_name:
         logger.debug("GCP: GOOGLE_SERVICE_ACCOUNT_NAME set; attempting impersonation")
 
@@ -155,7 +622,8 @@ def detect_gcp(audience: str) -> str | None:
         try:
             resp = _request(
                 "GET",
-                _GCP_TOKEN_REQUEST_URL,
+                _gcp_metadata_url(_GCP_TOKEN_REQUEST_PATH, env),
+                provider="GCP",
                 fields={"scopes": "https://www.googleapis.com/auth/cloud-platform"},
                 headers={"Metadata-Flavor": "Google"},
                 timeout=30,
@@ -165,8 +633,7 @@ def detect_gcp(audience: str) -> str | None:
 
         if resp.status != 200:
             raise AmbientCredentialError(
-                f"GCP: access token request failed (code={resp.status}, "
-                f"body={resp.data.decode()!r})"
+                f"GCP: access token request failed (code={resp.status}, body={_error_body(resp)})"
             )
 
         access_token = resp.json().get("access_token")
@@ -180,6 +647,7 @@ def detect_gcp(audience: str) -> str | None:
             resp = _request(
                 "POST",
                 _GCP_GENERATEIDTOKEN_REQUEST_URL.format(service_account_name),
+                provider="GCP",
                 json={"audience": audience, "includeEmail": True},
                 headers={
                     "Authorization": f"Bearer {access_token}",
@@ -191,7 +659,7 @@ def detect_gcp(audience: str) -> str | None:
 
         if resp.status != 200:
             raise AmbientCredentialError(
-                f"GCP: OIDC token request failed (code={resp.status}, body={resp.data.decode()!r})"
+                f"GCP: OIDC token request failed (code={resp.status}, body={_error_body(resp)})"
             )
 
         oidc_token: str = resp.json().get("token")
@@ -205,23 +673,31 @@ def detect_gcp(audience: str) -> str | None:
     else:
         logger.debug("GCP: GOOGLE_SERVICE_ACCOUNT_NAME not set; skipping impersonation")
 
-        try:
-            with _open(_GCP_PRODUCT_NAME_FILE) as f:
-                name = f.read().strip()
-        except OSError:
-            logger.debug("GCP: environment doesn't have GCP product name file; giving up")
-            return None
-
-        if name not in {"Google", "Google Compute Engine"}:
-            logger.debug(f"GCP: product name file exists, but product name is {name!r}; giving up")
-            return None
+        # The metadata server is only probed once the DMI product name has
+        # ruled GCE out, rather than concurrently: reading the file takes
+        # microseconds, so a probe thread would add cost and no latency win.
+        name = _gcp_product_name()
+        if name not in _GCP_PRODUCT_NAMES:
+            if not _gcp_runtime(env):
+                if name is None:
+                    logger.debug("GCP: environment doesn't have GCP product name file; giving up")
+                else:
+                    logger.debug(
+                        f"GCP: product name file exists, but product name is {name!r}; giving up"
+                    )
+                return None
+
+            if not _gcp_metadata_reachable(env):
+                logger.debug("GCP: no GCP product name and no metadata server; giving up")
+                return None
 
         logger.debug("GCP: requesting OIDC token")
 
         try:
-            resp = _request(
+            resp = _idempotent_request(
                 "GET",
-                _GCP_IDENTITY_REQUEST_URL,
+                _gcp_metadata_url(_GCP_IDENTITY_REQUEST_PATH, env),
+                provider="GCP",
                 fields={"audience": audience, "format": "full"},
                 headers={"Metadata-Flavor": "Google"},
                 timeout=30,
@@ -231,14 +707,14 @@ def detect_gcp(audience: str) -> str | None:
 
         if resp.status != 200:
             raise AmbientCredentialError(
-                f"GCP: OIDC token request failed (code={resp.status}, body={resp.data.decode()!r})"
+                f"GCP: OIDC token request failed (code={resp.status}, body={_error_body(resp)})"
             )
 
         logger.debug("GCP: successfully requested OIDC token")
         return resp.data.decode()
 
 
-def detect_buildkite(audience: str) -> str | None:
+def detect_buildkite(audience: str, env: Mapping[str, str] | None = None) -> str | None:
     """
     Detect and return a Buildkite ambient OIDC credential.
 
@@ -249,37 +725,20 @@ def detect_buildkite(audience: str) -> str | None:
     """
     logger.debug("Buildkite: looking for OIDC credentials")
 
-    if not os.getenv("BUILDKITE"):
+    if not _environ(env).get("BUILDKITE"):
         logger.debug("Buildkite: environment doesn't look like BuildKite; giving up")
         return None
 
     # Check that the Buildkite agent executable exists in the `PATH`.
-    if shutil.which("buildkite-agent") is None:
+    if _which("buildkite-agent") is None:
         raise AmbientCredentialError(
             "Buildkite: could not find Buildkite agent in Buildkite environment"
         )
 
     # Now query the agent for a token.
-    #
-    # NOTE(alex): We're silencing `bandit` here. The reasoning for ignoring each
-    # test are as follows.
-    #
-    # B603: This is complaining about invoking an external executable. However,
-    # there doesn't seem to be any way to do this that satisfies `bandit` so I
-    # think we need to ignore this.
-    # More context at:
-    #   https://github.com/PyCQA/bandit/issues/333
-    #
-    # B607: This is complaining about invoking an external executable without
-    # providing an absolute path (we just refer to whatever `buildkite-agent`)
-    # is in the `PATH`. For a Buildkite agent, there's no guarantee where the
-    # `buildkite-agent` is installed so again, I don't think there's anything
-    # we can do about this.
-    process = subprocess.run(  # nosec B603, B607
-        ["buildkite-agent", "oidc", "request-token", "--audience", audience],
-        capture_output=True,
-        text=True,
-    )
+    with _traced({"kind": "subprocess", "command": "buildkite-agent"}) as event:
+        process = _run(["buildkite-agent", "oidc", "request-token", "--audience", audience], env)
+        event["returncode"] = process.returncode
 
     if process.returncode != 0:
         raise AmbientCredentialError(
@@ -289,7 +748,7 @@ def detect_buildkite(audience: str) -> str | None:
     return process.stdout.strip()
 
 
-def detect_gitlab(audience: str) -> str | None:
+def detect_gitlab(audience: str, env: Mapping[str, str] | None = None) -> str | None:
     """
     Detect and return a GitLab CI/CD ambient OIDC credential.
 
@@ -309,14 +768,13 @@ def detect_gitlab(audience: str) -> str | None:
     """
     logger.debug("GitLab: looking for OIDC credentials")
 
-    if not os.getenv("GITLAB_CI"):
+    env = _environ(env)
+    if not env.get("GITLAB_CI"):
         logger.debug("GitLab: environment doesn't look like GitLab CI/CD; giving up")
         return None
 
-    # construct a reasonable env var name from the audience
-    sanitized_audience = _env_var_regex.sub("_", audience.upper())
-    var_name = f"{sanitized_audience}_ID_TOKEN"
-    token = os.getenv(var_name)
+    var_name = _env_var_name(audience, "ID_TOKEN")
+    token = env.get(var_name)
     if not token:
         raise AmbientCredentialError(f"GitLab: Environment variable {var_name} not found")
 
@@ -324,10 +782,19 @@ def detect_gitlab(audience: str) -> str | None:
     return token
 
 
-def detect_circleci(audience: str, root_issuer: bool = True) -> str | None:
+def detect_circleci(
+    audience: str,
+    root_issuer: bool = True,
+    claims: Mapping[str, Any] | None = None,
+    env: Mapping[str, str] | None = None,
+) -> str | None:
     """
     Detect and return a CircleCI ambient OIDC credential.
 
+    The token is minted with the `claims` in addition to its audience, by
+    the root issuer (`oidc.circleci.com`) or, without `root_issuer`, the
+    organization's issuer.
+
     Returns `None` if the context is not a CircleCI environment.
 
     Raises if the environment is GitHub Actions, but is incorrect or
@@ -335,25 +802,22 @@ def detect_circleci(audience: str, root_issuer: bool = True) -> str | None:
     """
     logger.debug("CircleCI: looking for OIDC credentials")
 
-    if not os.getenv("CIRCLECI"):
+    if not _environ(env).get("CIRCLECI"):
         logger.debug("CircleCI: environment doesn't look like CircleCI; giving up")
         return None
 
     # Check that the circleci executable exists in the `PATH`.
-    if shutil.which("circleci") is None:
+    if _which("circleci") is None:
         raise AmbientCredentialError("CircleCI: could not find `circleci` in the environment")
 
-    payload = json.dumps({"aud": audience})
+    payload = json.dumps({"aud": audience, **(claims or {})})
     cmd = ["circleci", "run", "oidc", "get", "--claims", payload]
     if root_issuer:
         cmd.append("--root-issuer")
 
-    # See NOTE on `detect_buildkite` for why we silence these warnings.
-    process = subprocess.run(  # nosec B603, B607
-        cmd,
-        capture_output=True,
-        text=True,
-    )
+    with _traced({"kind": "subprocess", "command": "circleci"}) as event:
+        process = _run(cmd, env)
+        event["returncode"] = process.returncode
 
     if process.returncode != 0:
         raise AmbientCredentialError(
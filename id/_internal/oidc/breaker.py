@@ -0,0 +1,163 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Per-endpoint circuit breaking, to fail fast during issuer outages.
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from typing import Callable, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class _Circuit:
+    def __init__(self) -> None:
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+
+
+class CircuitBreaker:
+    """
+    Tracks consecutive failures per endpoint, and rejects requests to an
+    endpoint immediately once it's considered down.
+
+    After `failure_threshold` consecutive failures an endpoint's circuit
+    opens, and requests to it raise `AmbientCredentialError` without being
+    sent. Once `reset_timeout` seconds have passed, the circuit is half-open:
+    a single probe request is let through, closing the circuit if it succeeds
+    and re-opening it if it fails.
+    """
+
+    def __init__(self, *, failure_threshold: int = 5, reset_timeout: float = 30.0) -> None:
+        """
+        Create a new breaker, opening after `failure_threshold` consecutive
+        failures and probing again after `reset_timeout` seconds.
+        """
+        if failure_threshold < 1:
+            raise ValueError("failure_threshold must be at least 1")
+
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._lock = threading.Lock()
+        self._circuits: dict[str, _Circuit] = {}
+
+    def _circuit(self, endpoint: str) -> _Circuit:
+        # Callers must hold `self._lock`.
+        circuit = self._circuits.get(endpoint)
+        if circuit is None:
+            circuit = self._circuits[endpoint] = _Circuit()
+        return circuit
+
+    def state(self, endpoint: str) -> str:
+        """
+        The state of `endpoint`'s circuit: `"closed"`, `"open"` or
+        `"half-open"`.
+        """
+        with self._lock:
+            circuit = self._circuits.get(endpoint)
+            return circuit.state if circuit is not None else CLOSED
+
+    def states(self) -> dict[str, str]:
+        """
+        The state of every endpoint's circuit.
+        """
+        with self._lock:
+            return {endpoint: circuit.state for endpoint, circuit in self._circuits.items()}
+
+    def reset(self) -> None:
+        """
+        Close every circuit.
+        """
+        with self._lock:
+            self._circuits.clear()
+
+    def call(self, endpoint: str, fn: Callable[[], T], is_failure: Callable[[T], bool]) -> T:
+        """
+        Call `fn` through `endpoint`'s circuit. Exceptions (but not interrupts)
+        from `fn` count as failures, as do results for which `is_failure` returns `True`; both are
+        returned (or raised) to the caller as usual.
+
+        Raises `AmbientCredentialError` without calling `fn` if the circuit is
+        open, or half-open with a probe already in flight.
+        """
+        from ... import AmbientCredentialError
+
+        with self._lock:
+            circuit = self._circuit(endpoint)
+            if circuit.state == OPEN:
+                remaining = circuit.opened_at + self.reset_timeout - time.monotonic()
+                if remaining > 0:
+                    raise AmbientCredentialError(
+                        f"{endpoint}: circuit open after {circuit.failures} consecutive "
+                        f"failures; failing fast for another {remaining:.1f}s"
+                    )
+                logger.info(f"{endpoint}: circuit half-open; sending a probe request")
+                circuit.state = HALF_OPEN
+            elif circuit.state == HALF_OPEN:
+                raise AmbientCredentialError(
+                    f"{endpoint}: circuit half-open and a probe is in flight; failing fast"
+                )
+
+        try:
+            result = fn()
+        except Exception:
+            self._record(endpoint, failed=True)
+            raise
+        except BaseException:
+            # An interrupt (or exit) says nothing about the endpoint, so it
+            # isn't a failure; but a probe it cut short mustn't stay in flight.
+            self._abandon(endpoint)
+            raise
+        self._record(endpoint, failed=is_failure(result))
+        return result
+
+    def _abandon(self, endpoint: str) -> None:
+        with self._lock:
+            circuit = self._circuit(endpoint)
+            if circuit.state == HALF_OPEN:
+                # Still past its reset timeout, so the next call probes again.
+                circuit.state = OPEN
+
+    def _record(self, endpoint: str, *, failed: bool) -> None:
+        with self._lock:
+            circuit = self._circuit(endpoint)
+            if not failed:
+                if circuit.state != CLOSED:
+                    logger.info(f"{endpoint}: probe succeeded; circuit closed")
+                circuit.state = CLOSED
+                circuit.failures = 0
+                return
+
+            circuit.failures += 1
+            if circuit.state == HALF_OPEN or circuit.failures >= self.failure_threshold:
+                if circuit.state != OPEN:
+                    logger.warning(
+                        f"{endpoint}: circuit opened after {circuit.failures} consecutive "
+                        f"failures; failing fast for {self.reset_timeout:.1f}s"
+                    )
+                circuit.state = OPEN
+                circuit.opened_at = time.monotonic()
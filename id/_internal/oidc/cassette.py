@@ -0,0 +1,312 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Recording the detectors' interactions with their environment to a cassette
+file, and replaying them offline.
+
+The detectors only reach outside the process at a few points: environment
+variables, `PATH` lookups, token and product name files, subprocesses, and
+HTTP requests. While recording, each interaction at those points is captured
+with its outcome and duration; while replaying, each is answered from the
+cassette instead, so that no provider (or network) is needed.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import json
+import os
+import subprocess  # nosec B404
+import tempfile
+import threading
+import time
+from collections import deque
+from collections.abc import Iterator, Mapping
+from contextvars import ContextVar
+from typing import Any, Callable, TypeVar, cast
+
+import urllib3
+
+from .response import BufferedResponse
+
+_T = TypeVar("_T")
+
+_VERSION = 1
+
+# The cassette recording or replaying in this context, if any.
+_active: ContextVar[Cassette | None] = ContextVar("_active", default=None)
+
+
+def current() -> Cassette | None:
+    """
+    The cassette recording or replaying in the current context, if any.
+    """
+    return _active.get()
+
+
+def _encode_http(resp: BufferedResponse) -> dict[str, Any]:
+    # Bodies are kept as text; undecodable bytes survive as lone surrogates.
+    return {
+        "status": resp.status,
+        "headers": list(resp.headers.items()),
+        "body": resp.data.decode("utf-8", "surrogateescape"),
+    }
+
+
+def _decode_http(recorded: dict[str, Any]) -> BufferedResponse:
+    return BufferedResponse(
+        recorded["status"],
+        urllib3.HTTPHeaderDict(recorded["headers"]),
+        recorded["body"].encode("utf-8", "surrogateescape"),
+    )
+
+
+def _encode_subprocess(process: subprocess.CompletedProcess[str]) -> dict[str, Any]:
+    return {
+        "args": list(process.args),
+        "returncode": process.returncode,
+        "stdout": process.stdout,
+        "stderr": process.stderr,
+    }
+
+
+def _decode_subprocess(recorded: dict[str, Any]) -> subprocess.CompletedProcess[str]:
+    return subprocess.CompletedProcess(
+        recorded["args"], recorded["returncode"], recorded["stdout"], recorded["stderr"]
+    )
+
+
+_CODECS: dict[str, tuple[Callable[[Any], dict[str, Any]], Callable[[dict[str, Any]], Any]]] = {
+    "http": (_encode_http, _decode_http),
+    "subprocess": (_encode_subprocess, _decode_subprocess),
+    "file": (lambda text: {"text": text}, lambda recorded: recorded["text"]),
+    "which": (lambda path: {"path": path}, lambda recorded: recorded["path"]),
+}
+
+
+def _encode_error(e: Exception) -> dict[str, Any]:
+    from ... import AmbientCredentialError
+
+    if isinstance(e, OSError) and e.errno is not None:
+        return {"type": "OSError", "errno": e.errno, "message": e.strerror}
+    if isinstance(e, urllib3.exceptions.MaxRetryError):
+        timeout = isinstance(e.reason, urllib3.exceptions.TimeoutError)
+        return {"type": "MaxRetryError", "url": e.url, "message": str(e), "timeout": timeout}
+    if isinstance(e, urllib3.exceptions.HTTPError):
+        return {"type": "HTTPError", "message": str(e)}
+    if isinstance(e, AmbientCredentialError):
+        return {"type": "AmbientCredentialError", "message": str(e)}
+    return {"type": type(e).__name__, "message": str(e)}
+
+
+def _decode_error(error: dict[str, Any]) -> Exception:
+    # Errors are replayed as the types the detectors tell apart, rather than
+    # reconstructed exactly.
+    from ... import AmbientCredentialError, IdentityError
+
+    kind, message = error["type"], error["message"]
+    if kind == "OSError":
+        # `OSError` picks the subclass (like `FileNotFoundError`) by errno.
+        return OSError(error["errno"], message)
+    if kind == "MaxRetryError":
+        reason_type = (
+            urllib3.exceptions.TimeoutError if error["timeout"] else urllib3.exceptions.HTTPError
+        )
+        # There's no connection pool behind a replayed request.
+        pool: Any = None
+        return urllib3.exceptions.MaxRetryError(pool, error["url"], reason_type(message))
+    if kind == "HTTPError":
+        return urllib3.exceptions.HTTPError(message)
+    if kind == "AmbientCredentialError":
+        return AmbientCredentialError(message)
+    return IdentityError(f"{kind}: {message}")
+
+
+class _RecordingEnviron(Mapping[str, str]):
+    """
+    The process environment, noting every variable that's read and set.
+    """
+
+    def __init__(self, cassette: Cassette) -> None:
+        self._cassette = cassette
+
+    def __getitem__(self, name: str) -> str:
+        value = os.environ[name]
+        with self._cassette._lock:
+            self._cassette._environ[name] = value
+        return value
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(os.environ)
+
+    def __len__(self) -> int:
+        return len(os.environ)
+
+
+class Cassette:
+    """
+    A recording of the detectors' interactions with their environment; see
+    `record` and `replay`.
+    """
+
+    def __init__(self, path: str | os.PathLike[str], *, replay: bool, latency: float = 0.0) -> None:
+        """
+        Create a cassette that records to `path` or, with `replay`, replays
+        from it. Replayed interactions take `latency` times as long as they
+        did when recorded.
+
+        Raises `IdentityError` if a cassette to replay can't be read.
+        """
+        from ... import IdentityError
+
+        self.path = os.fspath(path)
+        self.replaying = replay
+        self.latency = latency
+
+        self._lock = threading.Lock()
+        self._environ: dict[str, str] = {}
+        self._interactions: list[dict[str, Any]] = []
+        self._recorded: dict[tuple[str, str], deque[dict[str, Any]]] = {}
+        if not replay:
+            return
+
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+            if saved.get("version") != _VERSION:
+                raise ValueError(f"unsupported version {saved.get('version')!r}")
+            self._environ = dict(saved["environ"])
+            for interaction in saved["interactions"]:
+                key = (interaction["kind"], interaction["request"])
+                self._recorded.setdefault(key, deque()).append(interaction)
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            raise IdentityError(f"Cassette: can't replay {self.path}: {e}") from e
+
+    def environ(self) -> Mapping[str, str]:
+        """
+        The environment to detect credentials in: the one recorded when
+        replaying, or the process environment (noting what's read from it)
+        when recording.
+        """
+        if self.replaying:
+            return self._environ
+        return _RecordingEnviron(self)
+
+    def interact(self, kind: str, request: str, real: Callable[[], _T]) -> _T:
+        """
+        Perform the `kind` interaction identified by `request` with `real`,
+        recording its outcome; or when replaying, return (or raise) what it
+        did when recorded instead.
+
+        A request that was recorded several times is replayed in the order
+        recorded, and the last outcome repeats once they run out.
+
+        Raises `IdentityError` if replaying, and `request` wasn't recorded.
+        """
+        if self.replaying:
+            return cast(_T, self._replay(kind, request))
+
+        encode = _CODECS[kind][0]
+        interaction: dict[str, Any] = {"kind": kind, "request": request}
+        start = time.perf_counter()
+        try:
+            result = real()
+            interaction.update(encode(result))
+            return result
+        except Exception as e:
+            interaction["error"] = _encode_error(e)
+            raise
+        finally:
+            interaction["seconds"] = time.perf_counter() - start
+            with self._lock:
+                self._interactions.append(interaction)
+
+    def _replay(self, kind: str, request: str) -> Any:
+        from ... import IdentityError
+
+        with self._lock:
+            recorded = self._recorded.get((kind, request))
+            if not recorded:
+                raise IdentityError(f"Cassette: no {kind} interaction {request!r} in {self.path}")
+            interaction = recorded.popleft() if len(recorded) > 1 else recorded[0]
+
+        if self.latency > 0:
+            time.sleep(interaction["seconds"] * self.latency)
+        if "error" in interaction:
+            raise _decode_error(interaction["error"])
+        return _CODECS[kind][1](interaction)
+
+    def save(self) -> None:
+        """
+        Write what's been recorded to `path`, replacing it atomically.
+        """
+        with self._lock:
+            saved = {
+                "version": _VERSION,
+                "environ": dict(sorted(self._environ.items())),
+                "interactions": list(self._interactions),
+            }
+
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path) or ".", prefix=".id-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(saved, f, indent=2)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+
+@contextlib.contextmanager
+def record(path: str | os.PathLike[str]) -> Iterator[Cassette]:
+    """
+    Record every interaction of the detectors with their environment in the
+    current context, writing them to the cassette file at `path` on exit.
+
+    The cassette holds the environment variables the detectors read and the
+    credentials that were minted, so treat it as a secret until scrubbed.
+    Credentials cached by the session (see `Session`) aren't minted again,
+    and so aren't recorded.
+    """
+    cassette = Cassette(path, replay=False)
+    token = _active.set(cassette)
+    try:
+        yield cassette
+    finally:
+        _active.reset(token)
+        cassette.save()
+
+
+@contextlib.contextmanager
+def replay(path: str | os.PathLike[str], *, latency: float = 0.0) -> Iterator[Cassette]:
+    """
+    Replay the cassette file at `path`, written by `record`, in the current
+    context: the detectors see the recorded environment (unless given an
+    `env`), and every interaction is answered as it was when recorded,
+    without any provider.
+
+    By default, replayed interactions take no time; with `latency`, each
+    takes that multiple of the time it took when recorded (1.0 to replay at
+    the recorded speed).
+
+    Raises `IdentityError` if the cassette can't be read, or when an
+    interaction that wasn't recorded is attempted.
+    """
+    cassette = Cassette(path, replay=True, latency=latency)
+    token = _active.set(cassette)
+    try:
+        yield cassette
+    finally:
+        _active.reset(token)
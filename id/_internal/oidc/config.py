@@ -0,0 +1,64 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+How issuers are contacted, per `Session`.
+"""
+
+from __future__ import annotations
+
+from collections.abc import Mapping
+from contextvars import ContextVar
+from typing import NamedTuple
+
+import urllib3
+
+from .breaker import CircuitBreaker
+from .hedging import HedgingPolicy
+from .http2 import Http2Transport
+from .ratelimit import RateLimiter
+from .timeouts import AdaptiveTimeouts
+
+
+class Config(NamedTuple):
+    """
+    A session's connection pool and request policies. Replaced wholesale on
+    reconfiguration, never mutated.
+    """
+
+    # `None` sends requests through urllib3's module-level pool.
+    pool: urllib3.PoolManager | None = None
+    # Set when HTTP/2 is enabled; its HTTP/1.1 fallback also uses `pool`.
+    http2: Http2Transport | None = None
+    hedging: HedgingPolicy | None = None
+    circuit_breaker: CircuitBreaker | None = None
+    rate_limits: Mapping[str, RateLimiter] = {}
+    timeouts: AdaptiveTimeouts | None = None
+
+
+# The configuration of the session detecting credentials in this context, if
+# any; detectors called directly use the default session's.
+_active: ContextVar[Config | None] = ContextVar("_active", default=None)
+
+
+def current() -> Config:
+    """
+    The configuration for requests made in the current context.
+    """
+    config = _active.get()
+    if config is None:
+        from ... import _get_default_session
+
+        config = _get_default_session()._config
+    return config
@@ -0,0 +1,305 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Instrumented, non-failing diagnostics for every ambient credential detector.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import socket
+import ssl
+import subprocess  # nosec B404
+import time
+from typing import Any, Callable
+from urllib.parse import urlparse
+
+from . import ambient
+
+# Probes are only diagnostics, so they get a much tighter budget than mints.
+_PROBE_TIMEOUT = 5
+
+_GCP_PRODUCT_NAMES = {"Google", "Google Compute Engine"}
+
+Check = dict[str, Any]
+
+
+def _env_check(var: str) -> Check:
+    # Only report whether variables are set: their values may be credentials.
+    return {"check": f"{var} set", "matched": bool(os.getenv(var))}
+
+
+def _which_check(command: str) -> Check:
+    path = shutil.which(command)
+    return {"check": f"{command} on PATH", "matched": path is not None, "detail": path}
+
+
+def _probe(url: str) -> dict[str, Any]:
+    """
+    Time DNS resolution, TCP connection and (for `https`) the TLS handshake
+    to `url`'s host, independently of any request.
+    """
+    parsed = urlparse(url)
+    host = parsed.hostname or ""
+    port = parsed.port or (443 if parsed.scheme == "https" else 80)
+    probe: dict[str, Any] = {"host": host, "port": port}
+
+    start = time.perf_counter()
+    try:
+        addresses = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except OSError as e:
+        probe["error"] = f"DNS resolution failed: {e}"
+        return probe
+    probe["dns_seconds"] = time.perf_counter() - start
+    family, type_, proto, _, address = addresses[0]
+    probe["address"] = address[0]
+
+    sock = socket.socket(family, type_, proto)
+    sock.settimeout(_PROBE_TIMEOUT)
+    try:
+        start = time.perf_counter()
+        try:
+            sock.connect(address)
+        except OSError as e:
+            probe["error"] = f"connection failed: {e}"
+            return probe
+        probe["connect_seconds"] = time.perf_counter() - start
+
+        if parsed.scheme == "https":
+            start = time.perf_counter()
+            try:
+                sock = ssl.create_default_context().wrap_socket(sock, server_hostname=host)
+            except OSError as e:
+                probe["error"] = f"TLS handshake failed: {e}"
+                return probe
+            probe["tls_seconds"] = time.perf_counter() - start
+            probe["tls_version"] = sock.version()
+    finally:
+        sock.close()
+
+    return probe
+
+
+def _spawn(argv: list[str]) -> dict[str, Any]:
+    """
+    Time a trivial invocation of a provider's CLI, to separate process startup
+    from the time spent minting.
+    """
+    spawn: dict[str, Any] = {"command": " ".join(argv)}
+    start = time.perf_counter()
+    try:
+        # See NOTE on `ambient.detect_buildkite` for why we silence these warnings.
+        process = subprocess.Popen(  # nosec B603, B607
+            argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+    except OSError as e:
+        spawn["error"] = str(e)
+        return spawn
+
+    spawn["spawn_seconds"] = time.perf_counter() - start
+    try:
+        spawn["returncode"] = process.wait(timeout=_PROBE_TIMEOUT)
+        spawn["exit_seconds"] = time.perf_counter() - start
+    except subprocess.TimeoutExpired as e:
+        # Don't leave a hung CLI behind, or its zombie once it's killed.
+        process.kill()
+        process.wait()
+        spawn["error"] = str(e)
+    return spawn
+
+
+def _token_info(token: str) -> dict[str, Any]:
+    info: dict[str, Any] = {"size": len(token.encode())}
+    try:
+        from ... import decode_oidc_token
+
+        claims = json.loads(decode_oidc_token(token)[1])
+    except ValueError as e:
+        info["error"] = f"malformed token: {e}"
+        return info
+
+    for claim in ("iss", "aud", "sub"):
+        if claim in claims:
+            info[claim] = claims[claim]
+    if isinstance(claims.get("exp"), (int, float)):
+        info["expires_in"] = claims["exp"] - time.time()
+    return info
+
+
+def _file(audience: str) -> tuple[list[Check], list[str], list[str] | None]:
+    var = ambient._env_var_name(audience, "ID_TOKEN_FILE")
+    path = os.getenv(var)
+    checks = [
+        _env_check(var),
+        {"check": "token file exists", "matched": bool(path and os.path.isfile(path))},
+    ]
+    return checks, [], None
+
+
+def _github(audience: str) -> tuple[list[Check], list[str], list[str] | None]:
+    checks = [
+        _env_check("GITHUB_ACTIONS"),
+        _env_check("ACTIONS_ID_TOKEN_REQUEST_TOKEN"),
+        _env_check("ACTIONS_ID_TOKEN_REQUEST_URL"),
+    ]
+    url = os.getenv("ACTIONS_ID_TOKEN_REQUEST_URL")
+    return checks, [url] if checks[0]["matched"] and url else [], None
+
+
+def _gcp(audience: str) -> tuple[list[Check], list[str], list[str] | None]:
+    try:
+        with ambient._open(ambient._GCP_PRODUCT_NAME_FILE) as f:
+            name: str | None = f.read().strip()
+    except OSError:
+        name = None
+    runtime = [
+        var for var in ("GCE_METADATA_HOST", *ambient._GCP_RUNTIME_ENV_VARS) if os.getenv(var)
+    ]
+    checks = [
+        _env_check("GOOGLE_SERVICE_ACCOUNT_NAME"),
+        {"check": "GCP product name", "matched": name in _GCP_PRODUCT_NAMES, "detail": name},
+        {"check": "GCP runtime variables", "matched": bool(runtime), "detail": ", ".join(runtime)},
+    ]
+
+    if checks[0]["matched"]:
+        endpoints = [
+            ambient._gcp_metadata_url(ambient._GCP_TOKEN_REQUEST_PATH),
+            ambient._GCP_GENERATEIDTOKEN_REQUEST_URL,
+        ]
+    elif checks[1]["matched"] or checks[2]["matched"]:
+        endpoints = [ambient._gcp_metadata_url(ambient._GCP_IDENTITY_REQUEST_PATH)]
+    else:
+        endpoints = []
+    return checks, endpoints, None
+
+
+def _buildkite(audience: str) -> tuple[list[Check], list[str], list[str] | None]:
+    checks = [_env_check("BUILDKITE"), _which_check("buildkite-agent")]
+    matched = all(check["matched"] for check in checks)
+    return checks, [], ["buildkite-agent", "--version"] if matched else None
+
+
+def _gitlab(audience: str) -> tuple[list[Check], list[str], list[str] | None]:
+    checks = [_env_check("GITLAB_CI"), _env_check(ambient._env_var_name(audience, "ID_TOKEN"))]
+    return checks, [], None
+
+
+def _circleci(audience: str) -> tuple[list[Check], list[str], list[str] | None]:
+    checks = [_env_check("CIRCLECI"), _which_check("circleci")]
+    matched = all(check["matched"] for check in checks)
+    return checks, [], ["circleci", "version"] if matched else None
+
+
+# Each provider's detector, and the environment checks, HTTP endpoints and CLI
+# invocation to diagnose, in `detect_credential`'s order.
+_PROVIDERS: list[tuple[str, str, Callable[[str], tuple[list[Check], list[str], Any]]]] = [
+    ("File", "detect_file", _file),
+    ("GitHub", "detect_github", _github),
+    ("GCP", "detect_gcp", _gcp),
+    ("Buildkite", "detect_buildkite", _buildkite),
+    ("GitLab", "detect_gitlab", _gitlab),
+    ("CircleCI", "detect_circleci", _circleci),
+]
+
+
+def diagnose(audience: str) -> dict[str, Any]:
+    """
+    Run every detector for `audience`, recording which environment checks
+    matched, connection and subprocess timings, and the outcome, without
+    raising on failure.
+    """
+    providers = []
+    selected = None
+    for name, detector_name, inspect in _PROVIDERS:
+        checks, endpoints, spawn_argv = inspect(audience)
+        report: dict[str, Any] = {
+            "provider": name,
+            "checks": checks,
+            "probes": [_probe(url) for url in endpoints],
+        }
+        if spawn_argv is not None:
+            report["spawn"] = _spawn(spawn_argv)
+
+        events: list[dict[str, Any]] = []
+        reset = ambient._trace.set(events)
+        start = time.perf_counter()
+        try:
+            token = getattr(ambient, detector_name)(audience)
+        except Exception as e:
+            report["outcome"] = "error"
+            report["error"] = str(e)
+        else:
+            if token is None:
+                report["outcome"] = "not detected"
+            else:
+                report["outcome"] = "token"
+                report["token"] = _token_info(token)
+                selected = selected or name
+        finally:
+            report["seconds"] = time.perf_counter() - start
+            ambient._trace.reset(reset)
+        report["calls"] = events
+
+        providers.append(report)
+
+    return {"audience": audience, "selected": selected, "providers": providers}
+
+
+def _ms(seconds: float) -> str:
+    return f"{seconds * 1000:.1f} ms"
+
+
+def format_report(report: dict[str, Any]) -> str:
+    """
+    Render a `diagnose` report as human-readable text.
+    """
+    lines = [f"audience: {report['audience']}", f"selected: {report['selected'] or 'none'}"]
+    for provider in report["providers"]:
+        lines.append("")
+        lines.append(f"{provider['provider']}: {provider['outcome']} ({_ms(provider['seconds'])})")
+        for check in provider["checks"]:
+            detail = f" ({check['detail']})" if check.get("detail") else ""
+            lines.append(f"  [{'x' if check['matched'] else ' '}] {check['check']}{detail}")
+        for probe in provider["probes"]:
+            timings = [
+                f"{stage} {_ms(probe[f'{stage}_seconds'])}"
+                for stage in ("dns", "connect", "tls")
+                if f"{stage}_seconds" in probe
+            ]
+            if "error" in probe:
+                timings.append(probe["error"])
+            lines.append(f"  probe {probe['host']}:{probe['port']}: {', '.join(timings)}")
+        if "spawn" in provider:
+            spawn = provider["spawn"]
+            if "error" in spawn:
+                lines.append(f"  spawn `{spawn['command']}`: {spawn['error']}")
+            else:
+                lines.append(
+                    f"  spawn `{spawn['command']}`: started in {_ms(spawn['spawn_seconds'])}, "
+                    f"exited {spawn['returncode']} after {_ms(spawn['exit_seconds'])}"
+                )
+        for call in provider["calls"]:
+            target = call.get("url") or call.get("command")
+            result = call.get("error") or call.get("status", call.get("returncode"))
+            lines.append(f"  {call['kind']} {target}: {result} in {_ms(call['seconds'])}")
+        if "error" in provider:
+            lines.append(f"  error: {provider['error']}")
+        if "token" in provider:
+            token = provider["token"]
+            lifetime = f", expires in {token['expires_in']:.0f}s" if "expires_in" in token else ""
+            lines.append(f"  token: {token['size']} bytes, iss {token.get('iss')}{lifetime}")
+    return "\n".join(lines)
@@ -0,0 +1,256 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Hedged requests, to cut the tail latency of slow token endpoints.
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from contextvars import ContextVar, copy_context
+from queue import SimpleQueue
+from typing import Any, Callable, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Set once the attempt of a hedged request running in this context has lost
+# to the other attempt; see `lost`.
+_lost: ContextVar[threading.Event | None] = ContextVar("_lost", default=None)
+
+
+def lost() -> bool:
+    """
+    Whether the attempt of a hedged request running in the current context
+    has already lost, so that its response can be abandoned unread.
+    """
+    event = _lost.get()
+    return event is not None and event.is_set()
+
+
+class _Endpoint:
+    def __init__(self, window: int) -> None:
+        self.latencies: deque[float] = deque(maxlen=window)
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+
+class _Workers:
+    """
+    Up to `size` daemon threads, started as needed and reused. Work is never
+    queued: `submit` refuses it when every thread is busy.
+    """
+
+    def __init__(self, size: int) -> None:
+        self._size = size
+        self._lock = threading.Lock()
+        self._started = 0
+        self._idle: list[SimpleQueue[Callable[[], None]]] = []
+
+    def submit(self, fn: Callable[[], None]) -> bool:
+        with self._lock:
+            if self._idle:
+                tasks = self._idle.pop()
+            elif self._started < self._size:
+                self._started += 1
+                tasks = SimpleQueue()
+                threading.Thread(
+                    target=self._work, args=(tasks,), name="id-hedge", daemon=True
+                ).start()
+            else:
+                return False
+        tasks.put(fn)
+        return True
+
+    def _work(self, tasks: SimpleQueue[Callable[[], None]]) -> None:
+        while True:
+            tasks.get()()
+            with self._lock:
+                self._idle.append(tasks)
+
+
+class HedgingPolicy:
+    """
+    Sends a duplicate request when the first hasn't answered within a delay
+    derived from recently observed latencies, and takes whichever answers first.
+    """
+
+    def __init__(
+        self,
+        *,
+        percentile: float = 0.95,
+        initial_delay: float = 1.0,
+        min_delay: float = 0.05,
+        max_delay: float = 5.0,
+        window: int = 256,
+        min_samples: int = 10,
+        max_hedges: int = 8,
+        max_workers: int = 64,
+    ) -> None:
+        """
+        Create a new policy. The hedge delay for an endpoint is the
+        `percentile` of its last `window` successful request latencies, clamped
+        to `[min_delay, max_delay]`; until `min_samples` latencies have been
+        observed, `initial_delay` is used instead.
+
+        At most `max_hedges` hedged requests are in flight at once, across
+        every endpoint; past that, slow requests simply aren't hedged.
+
+        Attempts run on up to `max_workers` threads, shared by every request.
+        A request that finds them all busy is sent from the caller's own
+        thread, unhedged, rather than waiting for one.
+        """
+        if not 0 < percentile < 1:
+            raise ValueError("percentile must be between 0 and 1")
+
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.window = window
+        self.min_samples = min_samples
+        self.max_hedges = max_hedges
+        self.max_workers = max_workers
+
+        self._lock = threading.Lock()
+        self._endpoints: dict[str, _Endpoint] = {}
+        self._hedge_slots = threading.BoundedSemaphore(max_hedges)
+        self._workers = _Workers(max_workers)
+
+    def _endpoint(self, endpoint: str) -> _Endpoint:
+        # Callers must hold `self._lock`.
+        state = self._endpoints.get(endpoint)
+        if state is None:
+            state = self._endpoints[endpoint] = _Endpoint(self.window)
+        return state
+
+    def delay(self, endpoint: str) -> float:
+        """
+        The current hedge delay for `endpoint`, in seconds.
+        """
+        with self._lock:
+            latencies = sorted(self._endpoint(endpoint).latencies)
+        if len(latencies) < self.min_samples:
+            return self.initial_delay
+        observed = latencies[min(int(len(latencies) * self.percentile), len(latencies) - 1)]
+        return min(max(observed, self.min_delay), self.max_delay)
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        """
+        Per-endpoint counts of requests, hedges fired and hedges that won,
+        along with the current hedge delay.
+        """
+        with self._lock:
+            endpoints = list(self._endpoints.items())
+        return {
+            endpoint: {
+                "requests": state.requests,
+                "hedged": state.hedged,
+                "hedge_wins": state.hedge_wins,
+                "delay": self.delay(endpoint),
+            }
+            for endpoint, state in endpoints
+        }
+
+    def _timed(self, endpoint: str, fn: Callable[[], T]) -> T:
+        start = time.perf_counter()
+        result = fn()
+        with self._lock:
+            self._endpoint(endpoint).latencies.append(time.perf_counter() - start)
+        return result
+
+    def _start(
+        self, endpoint: str, fn: Callable[[], T], on_done: Callable[[], None] | None = None
+    ) -> tuple[Future[T], threading.Event] | None:
+        # Each attempt runs in its own copy of the caller's context, in which
+        # it can tell whether it has lost.
+        future: Future[T] = Future()
+        lost = threading.Event()
+        context = copy_context()
+
+        def attempt() -> None:
+            try:
+                _lost.set(lost)
+                future.set_result(self._timed(endpoint, fn))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                if on_done is not None:
+                    on_done()
+
+        if not self._workers.submit(lambda: context.run(attempt)):
+            return None
+        return future, lost
+
+    def run(self, endpoint: str, fn: Callable[[], T]) -> T:
+        """
+        Call `fn`, hedging it with a second call if the first is slower than
+        `endpoint`'s current hedge delay. Returns the first successful result,
+        or raises the first call's error if both fail.
+
+        A request in flight can't be interrupted: once one call has
+        succeeded, the other is marked as having `lost`, so that the request
+        it's waiting on is abandoned (its connection closed rather than its
+        response read) as soon as it answers.
+        """
+        delay = self.delay(endpoint)
+        with self._lock:
+            self._endpoint(endpoint).requests += 1
+
+        started = self._start(endpoint, fn)
+        if started is None:
+            logger.debug(f"{endpoint}: all {self.max_workers} hedging workers busy; not hedging")
+            return self._timed(endpoint, fn)
+        primary, primary_lost = started
+
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+
+        if not self._hedge_slots.acquire(blocking=False):
+            logger.debug(f"{endpoint}: {self.max_hedges} hedges already in flight; not hedging")
+            return primary.result()
+        started = self._start(endpoint, fn, on_done=self._hedge_slots.release)
+        if started is None:
+            self._hedge_slots.release()
+            logger.debug(f"{endpoint}: all {self.max_workers} hedging workers busy; not hedging")
+            return primary.result()
+        hedge, hedge_lost = started
+
+        logger.debug(f"{endpoint}: no response after {delay:.3f}s; sent a hedged request")
+        with self._lock:
+            self._endpoint(endpoint).hedged += 1
+
+        pending: set[Future[T]] = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        logger.debug(f"{endpoint}: hedged request won")
+                        with self._lock:
+                            self._endpoint(endpoint).hedge_wins += 1
+                        primary_lost.set()
+                    else:
+                        hedge_lost.set()
+                    return future.result()
+
+        return primary.result()
@@ -0,0 +1,379 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+An optional HTTP/2 transport, multiplexing concurrent requests to the same
+issuer over a single TLS connection.
+
+This requires the `h2` package (installable with `id[http2]`). Hosts that
+don't negotiate HTTP/2 via ALPN, and plain `http` URLs (such as the GCP
+metadata server), fall back to `urllib3` and HTTP/1.1.
+"""
+
+from __future__ import annotations
+
+import importlib.util
+import json
+import logging
+import os
+import socket
+import ssl
+import threading
+from typing import Any
+from urllib.parse import urlencode, urlparse
+
+import urllib3
+
+from .response import MAX_RESPONSE_SIZE, BufferedResponse
+
+logger = logging.getLogger(__name__)
+
+
+def enabled() -> bool:
+    """
+    Whether HTTP/2 has been enabled with `ID_HTTP2`, and `h2` is installed.
+    """
+    if os.getenv("ID_HTTP2", "").lower() not in {"1", "true", "yes"}:
+        return False
+    if importlib.util.find_spec("h2") is None:
+        logger.debug("HTTP/2: ID_HTTP2 is set, but h2 isn't installed; using HTTP/1.1")
+        return False
+    return True
+
+
+class _NotHttp2(Exception):
+    pass
+
+
+class _Stream:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.status = 0
+        self.headers = urllib3.HTTPHeaderDict()
+        self.data = bytearray()
+        self.error: Exception | None = None
+
+
+class _Connection:
+    """
+    A single HTTP/2 connection, shared by every in-flight request to its host.
+    Responses are read by a background thread and handed to waiting callers.
+    """
+
+    def __init__(self, host: str, port: int, ssl_context: ssl.SSLContext, timeout: float) -> None:
+        import h2.config
+        import h2.connection
+
+        self.host = host
+        sock = socket.create_connection((host, port), timeout=timeout)
+        try:
+            self._sock = ssl_context.wrap_socket(sock, server_hostname=host)
+        except Exception:
+            sock.close()
+            raise
+        if self._sock.selected_alpn_protocol() != "h2":
+            self._sock.close()
+            raise _NotHttp2(host)
+        self._sock.settimeout(None)
+
+        self._h2 = h2.connection.H2Connection(
+            config=h2.config.H2Configuration(client_side=True, header_encoding=None)
+        )
+        # Guards the h2 state machine and socket writes; the reader thread only
+        # holds it while processing a received chunk.
+        self._lock = threading.Condition()
+        self._streams: dict[int, _Stream] = {}
+        self.closed = False
+
+        with self._lock:
+            self._h2.initiate_connection()
+            self._flush()
+
+        self._reader = threading.Thread(target=self._read_loop, name=f"id-h2-{host}", daemon=True)
+        self._reader.start()
+
+    def close(self) -> None:
+        """
+        Close the connection, failing any requests in flight on it, and wait
+        for its reader thread to exit.
+        """
+        # Closing the socket alone doesn't wake the reader blocked in `recv`.
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            # Already closed by the reader, or by the server.
+            pass
+        if self._reader is not threading.current_thread():
+            self._reader.join()
+        self._sock.close()
+
+    def _flush(self) -> None:
+        data = self._h2.data_to_send()
+        if data:
+            self._sock.sendall(data)
+
+    def request(
+        self, method: str, path: str, headers: dict[str, str], body: bytes | None, timeout: float
+    ) -> BufferedResponse:
+        stream = _Stream()
+        with self._lock:
+            # Respect the server's concurrency limit by queueing for a free stream.
+            if not self._lock.wait_for(
+                lambda: (
+                    self.closed
+                    or self._h2.open_outbound_streams
+                    < self._h2.remote_settings.max_concurrent_streams
+                ),
+                timeout=timeout,
+            ):
+                raise TimeoutError(f"no free HTTP/2 stream to {self.host}")
+            if self.closed:
+                raise ConnectionError(f"HTTP/2 connection to {self.host} closed")
+
+            stream_id = self._h2.get_next_available_stream_id()
+            self._streams[stream_id] = stream
+            request_headers = [
+                (":method", method),
+                (":path", path),
+                (":scheme", "https"),
+                (":authority", self.host),
+                *((k.lower(), v) for k, v in headers.items()),
+            ]
+            self._h2.send_headers(stream_id, request_headers, end_stream=not body)
+            if body:
+                self._h2.send_data(stream_id, body, end_stream=True)
+            self._flush()
+
+        if not stream.done.wait(timeout):
+            with self._lock:
+                if self._streams.pop(stream_id, None) is not None and not self.closed:
+                    self._h2.reset_stream(stream_id)
+                    self._flush()
+            raise TimeoutError(f"HTTP/2 request to {self.host} timed out")
+        if stream.error is not None:
+            raise stream.error
+        return BufferedResponse(stream.status, stream.headers, bytes(stream.data))
+
+    def _reject_oversized(self, stream_id: int, stream: _Stream) -> None:
+        # Callers must hold `self._lock`.
+        import h2.exceptions
+
+        from ... import AmbientCredentialError
+
+        try:
+            self._h2.reset_stream(stream_id)
+        except h2.exceptions.StreamClosedError:
+            # The server already ended the stream, in the same read.
+            pass
+        self._streams.pop(stream_id, None)
+        stream.data = bytearray()
+        stream.error = AmbientCredentialError(
+            f"HTTP/2 response from {self.host} exceeds {MAX_RESPONSE_SIZE} bytes"
+        )
+        stream.done.set()
+        self._lock.notify_all()
+
+    def _read_loop(self) -> None:
+        import h2.events
+
+        error: Exception = ConnectionError(f"HTTP/2 connection to {self.host} closed")
+        try:
+            while True:
+                data = self._sock.recv(65535)
+                if not data:
+                    break
+                with self._lock:
+                    events = self._h2.receive_data(data)
+                    for event in events:
+                        stream = self._streams.get(getattr(event, "stream_id", 0) or 0)
+                        if isinstance(event, h2.events.ResponseReceived) and stream:
+                            for name, value in event.headers:
+                                if name == b":status":
+                                    stream.status = int(value)
+                                else:
+                                    stream.headers.add(name.decode(), value.decode())
+                        elif isinstance(event, h2.events.DataReceived):
+                            if stream:
+                                stream.data += event.data
+                                if len(stream.data) > MAX_RESPONSE_SIZE:
+                                    self._reject_oversized(event.stream_id, stream)
+                            self._h2.acknowledge_received_data(
+                                event.flow_controlled_length, event.stream_id
+                            )
+                        elif isinstance(event, (h2.events.StreamEnded, h2.events.StreamReset)):
+                            if isinstance(event, h2.events.StreamReset) and stream:
+                                stream.error = ConnectionError(
+                                    f"HTTP/2 stream reset by {self.host} (code={event.error_code})"
+                                )
+                            self._streams.pop(event.stream_id, None)
+                            if stream:
+                                stream.done.set()
+                            self._lock.notify_all()
+                        elif isinstance(event, h2.events.ConnectionTerminated):
+                            raise ConnectionError(f"HTTP/2 connection to {self.host} terminated")
+                    self._flush()
+        except Exception as e:
+            error = e
+        finally:
+            with self._lock:
+                self.closed = True
+                for stream in self._streams.values():
+                    stream.error = error
+                    stream.done.set()
+                self._streams.clear()
+                self._lock.notify_all()
+            self._sock.close()
+
+
+class Http2Transport:
+    """
+    A `urllib3.request`-compatible transport that sends `https` requests over
+    one multiplexed HTTP/2 connection per host, and everything else (including
+    hosts that don't support HTTP/2) over `urllib3`.
+    """
+
+    def __init__(
+        self, ssl_context: ssl.SSLContext | None = None, *, pool: urllib3.PoolManager | None = None
+    ) -> None:
+        """
+        Create a new transport. `ssl_context` defaults to the system's default
+        verified context. Requests that fall back to HTTP/1.1 are sent through
+        `pool`, or urllib3's module-level pool if it's `None`.
+        """
+        if ssl_context is None:
+            ssl_context = ssl.create_default_context()
+        ssl_context.set_alpn_protocols(["h2", "http/1.1"])
+        self._ssl_context = ssl_context
+        self._pool = pool
+        self._lock = threading.Lock()
+        self._connections: dict[tuple[str, int], _Connection] = {}
+        self._connecting: dict[tuple[str, int], threading.Lock] = {}
+        self._http1_hosts: set[tuple[str, int]] = set()
+
+    def _open_connection(self, key: tuple[str, int]) -> _Connection | None:
+        # Callers must hold `self._lock`.
+        if key in self._http1_hosts:
+            return None
+        conn = self._connections.get(key)
+        return conn if conn is not None and not conn.closed else None
+
+    def _connection(self, host: str, port: int, timeout: float) -> _Connection | None:
+        key = (host, port)
+        with self._lock:
+            conn = self._open_connection(key)
+            if conn is not None or key in self._http1_hosts:
+                return conn
+            connecting = self._connecting.setdefault(key, threading.Lock())
+
+        # Connect under a lock of the host's own, so that concurrent first
+        # requests to a host share one connection rather than racing to open
+        # several, without holding up requests to other hosts.
+        with connecting:
+            with self._lock:
+                conn = self._open_connection(key)
+                if conn is not None or key in self._http1_hosts:
+                    return conn
+            try:
+                conn = _Connection(host, port, self._ssl_context, timeout)
+            except _NotHttp2:
+                logger.debug(f"HTTP/2: {host} doesn't support HTTP/2; using HTTP/1.1")
+                with self._lock:
+                    self._http1_hosts.add(key)
+                return None
+            with self._lock:
+                self._connections[key] = conn
+            return conn
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        *,
+        fields: dict[str, str] | None = None,
+        headers: dict[str, str] | None = None,
+        json: Any = None,
+        timeout: float = 30,
+        preload_content: bool = True,
+        **kwargs: Any,
+    ) -> Any:
+        """
+        Perform a request, with the same calling convention as `urllib3.request`.
+
+        HTTP/2 responses are always read in full (up to `MAX_RESPONSE_SIZE`
+        bytes); `preload_content` only applies to requests that fall back to
+        `urllib3`.
+        """
+        parsed = urlparse(url)
+        if parsed.scheme != "https" or kwargs:
+            return self._http1(
+                method,
+                url,
+                fields=fields,
+                headers=headers,
+                json=json,
+                timeout=timeout,
+                preload_content=preload_content,
+                **kwargs,
+            )
+
+        headers = dict(headers or {})
+        body: bytes | None = None
+        if json is not None:
+            body = _json_dumps(json)
+            headers.setdefault("Content-Type", "application/json")
+        elif fields:
+            body = urlencode(fields).encode()
+            headers.setdefault("Content-Type", "application/x-www-form-urlencoded")
+
+        port = parsed.port or 443
+        path = parsed.path or "/"
+        if parsed.query:
+            path = f"{path}?{parsed.query}"
+
+        try:
+            conn = self._connection(parsed.hostname or "", port, timeout)
+            if conn is None:
+                return self._http1(
+                    method,
+                    url,
+                    fields=fields,
+                    headers=headers,
+                    json=json,
+                    timeout=timeout,
+                    preload_content=preload_content,
+                )
+            return conn.request(method, path, headers, body, timeout)
+        except (OSError, ssl.SSLError) as e:
+            # Surface transport failures the same way urllib3 does, so that the
+            # detectors' timeout handling applies unchanged.
+            raise urllib3.exceptions.MaxRetryError(None, url, e) from e  # type: ignore[arg-type]
+
+    def _http1(self, method: str, url: str, **kwargs: Any) -> Any:
+        if self._pool is not None:
+            return self._pool.request(method, url, **kwargs)
+        return urllib3.request(method, url, **kwargs)
+
+    def close(self) -> None:
+        """
+        Close every open HTTP/2 connection.
+        """
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for conn in connections:
+            conn.close()
+
+
+def _json_dumps(obj: Any) -> bytes:
+    return json.dumps(obj, separators=(",", ":")).encode()
@@ -0,0 +1,183 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Client-side rate limiting of requests to issuer endpoints.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import email.utils
+import hashlib
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+from collections.abc import Iterator
+from typing import Any, Callable
+
+# On Windows, buckets can still be shared between threads, but not processes.
+if sys.platform != "win32":
+    import fcntl
+
+logger = logging.getLogger(__name__)
+
+_STATE = struct.Struct("<d")
+
+
+def _retry_after(resp: Any) -> float | None:
+    """
+    Parse a response's `Retry-After` header (delay-seconds or an HTTP-date)
+    into a number of seconds from now, if present and valid.
+    """
+    headers = getattr(resp, "headers", None)
+    value = headers.get("Retry-After") if headers is not None else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(when.timestamp() - time.time(), 0.0)
+
+
+class RateLimiter:
+    """
+    A token bucket per endpoint, refilled at `rate` requests per second and
+    holding up to `burst` requests.
+
+    Callers that find the bucket empty wait their turn, in the order they
+    arrived. A `429` or `503` response with a `Retry-After` header holds back
+    every request to that endpoint until the issuer's deadline, and the
+    request is then retried.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        *,
+        burst: int = 1,
+        shared_dir: str | os.PathLike[str] | None = None,
+        max_retry_after: float = 60.0,
+        retries: int = 2,
+    ) -> None:
+        """
+        Create a new limiter allowing `rate` requests per second to each
+        endpoint, in bursts of up to `burst`.
+
+        With `shared_dir`, bucket state is kept in lock files in that
+        directory, so that every process on the host using the same directory
+        shares the same buckets. This is unavailable on Windows, where buckets
+        are shared between threads only.
+
+        Responses asking to retry after more than `max_retry_after` seconds
+        are returned to the caller as-is, as are responses after `retries`
+        retries.
+        """
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        if burst < 1:
+            raise ValueError("burst must be at least 1")
+
+        self.rate = rate
+        self.burst = burst
+        self.shared_dir = os.fspath(shared_dir) if shared_dir is not None else None
+        self.max_retry_after = max_retry_after
+        self.retries = retries
+
+        if self.shared_dir is not None and sys.platform == "win32":
+            logger.debug("rate limits can't be shared between processes on this platform")
+
+        # Each endpoint's "theoretical arrival time": when its bucket will next
+        # be full, as a wall-clock timestamp so that processes can share it.
+        self._lock = threading.Lock()
+        self._tat: dict[str, float] = {}
+
+    @contextlib.contextmanager
+    def _state(self, endpoint: str) -> Iterator[list[float]]:
+        """
+        Hold `endpoint`'s bucket exclusively, yielding its state as a
+        one-element list to be updated in place.
+        """
+        with self._lock:
+            if self.shared_dir is None or sys.platform == "win32":
+                state = [self._tat.get(endpoint, 0.0)]
+                yield state
+                self._tat[endpoint] = state[0]
+                return
+
+            name = hashlib.sha256(endpoint.encode()).hexdigest()[:32]
+            fd = os.open(os.path.join(self.shared_dir, f"{name}.bucket"), os.O_RDWR | os.O_CREAT)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                data = os.pread(fd, _STATE.size, 0)
+                state = [_STATE.unpack(data)[0] if len(data) == _STATE.size else 0.0]
+                yield state
+                os.pwrite(fd, _STATE.pack(state[0]), 0)
+            finally:
+                os.close(fd)
+
+    def acquire(self, endpoint: str) -> float:
+        """
+        Wait until a request to `endpoint` is allowed, returning how long
+        that took in seconds.
+        """
+        interval = 1 / self.rate
+        with self._state(endpoint) as state:
+            now = time.time()
+            tat = max(state[0], now)
+            # Reserving a slot before sleeping keeps callers in arrival order.
+            wait = max(tat - (self.burst - 1) * interval - now, 0.0)
+            state[0] = tat + interval
+
+        if wait > 0:
+            logger.debug(f"{endpoint}: rate limited; waiting {wait:.3f}s")
+            time.sleep(wait)
+        return wait
+
+    def defer(self, endpoint: str, seconds: float) -> None:
+        """
+        Hold back every request to `endpoint` for at least `seconds`.
+        """
+        with self._state(endpoint) as state:
+            # Offset by the burst tolerance, so that requests resume at `rate`
+            # once the deadline passes rather than all at once.
+            until = time.time() + seconds + (self.burst - 1) / self.rate
+            state[0] = max(state[0], until)
+
+    def call(self, endpoint: str, send: Callable[[], Any]) -> Any:
+        """
+        Send a request to `endpoint` with `send` once the bucket allows,
+        retrying it if the issuer asks to with `Retry-After`.
+        """
+        attempt = 0
+        while True:
+            self.acquire(endpoint)
+            resp = send()
+            retry_after = _retry_after(resp) if resp.status in (429, 503) else None
+            if retry_after is None:
+                return resp
+
+            self.defer(endpoint, retry_after)
+            if retry_after > self.max_retry_after or attempt >= self.retries:
+                return resp
+            attempt += 1
+            logger.debug(f"{endpoint}: throttled ({resp.status}); retrying after {retry_after}s")
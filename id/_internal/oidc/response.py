@@ -0,0 +1,105 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Size-capped reading of issuer responses.
+
+Issuer responses are a few kilobytes at most, but a misbehaving proxy or
+metadata endpoint can answer with anything; bodies are streamed and rejected
+once they pass `MAX_RESPONSE_SIZE`, rather than read into memory whole.
+"""
+
+from __future__ import annotations
+
+import json
+from typing import Any
+
+import urllib3
+
+# The most bytes of a (decoded) response body that are read.
+MAX_RESPONSE_SIZE = 1024 * 1024
+
+# The most bytes of a response body that are shown in error messages.
+MAX_ERROR_BODY = 512
+
+_CHUNK_SIZE = 64 * 1024
+
+
+class BufferedResponse:
+    """
+    A fully read response, shaped like the parts of `urllib3.BaseHTTPResponse`
+    that the detectors use.
+    """
+
+    def __init__(self, status: int, headers: urllib3.HTTPHeaderDict, data: bytes) -> None:
+        """
+        Create a new response from its status, headers and body.
+        """
+        self.status = status
+        self.headers = headers
+        self.data = data
+
+    def json(self) -> Any:
+        """
+        Parse the response body as JSON.
+        """
+        return json.loads(self.data.decode("utf-8"))
+
+
+def read_capped(
+    resp: urllib3.BaseHTTPResponse, endpoint: str, limit: int = MAX_RESPONSE_SIZE
+) -> BufferedResponse:
+    """
+    Read `resp`, sent with `preload_content=False`, into a `BufferedResponse`.
+
+    Raises `AmbientCredentialError` as soon as the body is known to be larger
+    than `limit` bytes, closing the connection rather than reading the rest.
+    """
+    from ... import AmbientCredentialError
+
+    try:
+        length = int(resp.headers.get("Content-Length", 0))
+    except ValueError:
+        length = 0
+
+    data = bytearray()
+    too_large = length > limit
+    if not too_large:
+        for chunk in resp.stream(_CHUNK_SIZE):
+            data += chunk
+            if len(data) > limit:
+                too_large = True
+                break
+
+    if too_large:
+        # The rest of the body is still on the wire, so the connection
+        # can't be reused.
+        resp.close()
+        resp.release_conn()
+        raise AmbientCredentialError(f"{endpoint}: response body exceeds {limit} bytes")
+
+    resp.release_conn()
+    return BufferedResponse(resp.status, resp.headers, bytes(data))
+
+
+def error_body(resp: BufferedResponse) -> str:
+    """
+    The start of `resp`'s body, for error messages: at most `MAX_ERROR_BODY`
+    bytes are decoded, and the number of bytes left out is noted.
+    """
+    body = repr(resp.data[:MAX_ERROR_BODY].decode(errors="replace"))
+    omitted = len(resp.data) - MAX_ERROR_BODY
+    if omitted > 0:
+        body += f" (and {omitted} more bytes)"
+    return body
@@ -0,0 +1,210 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Request timeouts learned from the latencies observed per issuer.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import deque
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+
+class _Endpoint:
+    def __init__(self, window: int) -> None:
+        self.latencies: deque[float] = deque(maxlen=window)
+        self.requests = 0
+        self.timeouts = 0
+
+
+class AdaptiveTimeouts:
+    """
+    Derives the read timeout for requests to each issuer from the latencies
+    recently observed for it, rather than using a fixed timeout: short enough
+    to detect failures quickly on a healthy network, and long enough to avoid
+    spurious timeouts on a congested one.
+    """
+
+    def __init__(
+        self,
+        *,
+        percentile: float = 0.99,
+        multiplier: float = 2.0,
+        connect: float | None = None,
+        min_read: float = 1.0,
+        max_read: float = 60.0,
+        window: int = 256,
+        min_samples: int = 10,
+        path: str | os.PathLike[str] | None = None,
+        save_interval: float = 10.0,
+    ) -> None:
+        """
+        Create a new policy. The read timeout for an endpoint (an issuer's
+        scheme and host) is `multiplier` times the `percentile` of its last
+        `window` latencies, clamped to `[min_read, max_read]`. Until
+        `min_samples` latencies have been observed, the request's own timeout
+        is used instead.
+
+        A latency is the time from sending a request to receiving its
+        response headers. A request that times out counts as a latency of
+        its whole timeout, so that timeouts grow on a slow network.
+
+        Connecting takes `connect` seconds at most, or the request's own
+        timeout by default: how long connecting takes isn't measured apart
+        from the response, so it isn't learned.
+
+        With `path`, latencies are loaded from that file, and saved back to it
+        in the background `save_interval` seconds after the first latency
+        observed since the last save, so that they carry over between runs.
+        `save` writes them out immediately; call it before exiting.
+        """
+        if not 0 < percentile < 1:
+            raise ValueError("percentile must be between 0 and 1")
+        if min_read > max_read:
+            raise ValueError("min_read must not exceed max_read")
+
+        self.percentile = percentile
+        self.multiplier = multiplier
+        self.connect = connect
+        self.min_read = min_read
+        self.max_read = max_read
+        self.window = window
+        self.min_samples = min_samples
+        self.path = os.fspath(path) if path is not None else None
+        self.save_interval = save_interval
+
+        self._lock = threading.Lock()
+        self._endpoints: dict[str, _Endpoint] = {}
+        self._saving: threading.Timer | None = None
+        if self.path is not None:
+            self._load(self.path)
+
+    def _endpoint(self, endpoint: str) -> _Endpoint:
+        # Callers must hold `self._lock`.
+        state = self._endpoints.get(endpoint)
+        if state is None:
+            state = self._endpoints[endpoint] = _Endpoint(self.window)
+        return state
+
+    def _load(self, path: str) -> None:
+        try:
+            with open(path) as f:
+                saved = json.load(f)["endpoints"]
+            for endpoint, latencies in saved.items():
+                self._endpoint(endpoint).latencies.extend(float(latency) for latency in latencies)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.warning(f"Timeouts: ignoring unreadable latencies in {path}: {e}")
+
+    def save(self) -> None:
+        """
+        Write the observed latencies to `path`, replacing it atomically.
+        """
+        if self.path is None:
+            return
+        with self._lock:
+            saved = {endpoint: list(state.latencies) for endpoint, state in self._endpoints.items()}
+            if self._saving is not None:
+                self._saving.cancel()
+                self._saving = None
+
+        # Not held across the write: a concurrent save may land first, and
+        # only costs the latencies observed in between.
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path) or ".", prefix=".id-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({"endpoints": saved}, f)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def _percentile(self, latencies: list[float]) -> float:
+        # `latencies` must be sorted and non-empty.
+        return latencies[min(int(len(latencies) * self.percentile), len(latencies) - 1)]
+
+    def _derive(self, latencies: list[float]) -> float | None:
+        if len(latencies) < self.min_samples:
+            return None
+        timeout = self._percentile(latencies) * self.multiplier
+        return min(max(timeout, self.min_read), self.max_read)
+
+    def timeouts(self, endpoint: str, default: float) -> tuple[float, float]:
+        """
+        The current connect and read timeouts for `endpoint`, in seconds.
+        `default` is used for connecting (unless `connect` was given), and
+        for reading while too few latencies have been observed.
+        """
+        with self._lock:
+            latencies = sorted(self._endpoint(endpoint).latencies)
+        read = self._derive(latencies)
+        return (
+            self.connect if self.connect is not None else default,
+            read if read is not None else default,
+        )
+
+    def observe(self, endpoint: str, latency: float, *, timed_out: bool = False) -> None:
+        """
+        Record a request to `endpoint` that got its response headers after
+        `latency` seconds or, if `timed_out`, that timed out after that long.
+        """
+        with self._lock:
+            state = self._endpoint(endpoint)
+            state.requests += 1
+            state.timeouts += timed_out
+            state.latencies.append(latency)
+            # Saved off the request's path, batching what's observed until then.
+            if self.path is not None and self._saving is None:
+                self._saving = threading.Timer(self.save_interval, self._save_in_background)
+                self._saving.daemon = True
+                self._saving.start()
+
+    def _save_in_background(self) -> None:
+        try:
+            self.save()
+        except OSError as e:
+            logger.warning(f"Timeouts: couldn't save latencies to {self.path}: {e}")
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        """
+        Per-endpoint counts of requests and timeouts, the median and
+        `percentile` of the observed latencies, and the current read timeout
+        (`None` until enough latencies have been observed).
+        """
+        with self._lock:
+            endpoints = {
+                endpoint: (state.requests, state.timeouts, sorted(state.latencies))
+                for endpoint, state in self._endpoints.items()
+            }
+
+        stats = {}
+        for endpoint, (requests, timeouts, latencies) in endpoints.items():
+            stats[endpoint] = {
+                "requests": requests,
+                "timeouts": timeouts,
+                "samples": len(latencies),
+                "p50": latencies[len(latencies) // 2] if latencies else None,
+                "percentile": self._percentile(latencies) if latencies else None,
+                "read": self._derive(latencies),
+            }
+        return stats
@@ -0,0 +1,145 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Profiling of `id` calls and CLI invocations, with `cProfile` and optionally
+`tracemalloc`.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import sys
+import threading
+from collections.abc import Iterator
+from contextvars import ContextVar
+from typing import TYPE_CHECKING, Any, Callable, TextIO, TypeVar
+
+if TYPE_CHECKING:
+    import cProfile  # pragma: no cover
+
+_T = TypeVar("_T")
+
+
+class _Profile:
+    """
+    The profile being taken on a thread, and the profiles of the tasks run on
+    other threads on its behalf (see `profiled`).
+    """
+
+    def __init__(self) -> None:
+        self.thread = threading.get_ident()
+        self.lock = threading.Lock()
+        self.tasks: list[cProfile.Profile] = []
+
+
+# The profile being taken in this context, if any; `id exec` runs its command
+# as a child rather than exec'ing it then, so the profile is still written.
+_active: ContextVar[_Profile | None] = ContextVar("_active", default=None)
+
+
+def active() -> bool:
+    """
+    Whether a `profile` is being taken in the current context.
+    """
+    return _active.get() is not None
+
+
+def profiled(fn: Callable[..., _T], *args: Any) -> _T:
+    """
+    Call `fn(*args)`, profiling it as part of the `profile` being taken in the
+    current context, if that's on another thread.
+
+    `cProfile` only sees the thread it's enabled on, so the tasks that
+    sessions hand to their pools (run in a copy of the submitter's context)
+    go through this.
+    """
+    current = _active.get()
+    if current is None or current.thread == threading.get_ident():
+        return fn(*args)
+
+    import cProfile
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Since Python 3.12, only one profiler can be enabled at a time, and
+        # it sees every thread.
+        return fn(*args)
+    try:
+        return fn(*args)
+    finally:
+        profiler.disable()
+        with current.lock:
+            current.tasks.append(profiler)
+
+
+@contextlib.contextmanager
+def profile(
+    path: str | None = None,
+    *,
+    memory: bool = False,
+    top: int = 10,
+    stream: TextIO | None = None,
+) -> Iterator[cProfile.Profile]:
+    """
+    Profile the calls made in the body, on the current thread, and those
+    made on behalf of it by sessions' threads (see `Session.prefetch`).
+
+    On exit, the profile is written to `path` as a `pstats` file (if given),
+    and the `top` functions by cumulative time are summarized on `stream`
+    (stderr by default). With `memory`, allocations are traced with
+    `tracemalloc` too, and the `top` allocation sites are summarized as well.
+    """
+    import cProfile
+    import pstats
+    import tracemalloc
+
+    stream = stream if stream is not None else sys.stderr
+    # Don't stop tracing that someone else started.
+    trace_memory = memory and not tracemalloc.is_tracing()
+    if trace_memory:
+        tracemalloc.start()
+
+    current = _Profile()
+    profiler = cProfile.Profile()
+    token = _active.set(current)
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        _active.reset(token)
+
+        snapshot = None
+        if memory:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            if trace_memory:
+                tracemalloc.stop()
+
+        stats = pstats.Stats(profiler, stream=stream)
+        with current.lock:
+            if current.tasks:
+                stats.add(*current.tasks)
+        if path is not None:
+            stats.dump_stats(path)
+            print(f"id: profile written to {path}", file=stream)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top)
+
+        if snapshot is not None:
+            print(f"id: top {top} allocation sites (peak {peak / 1024:.1f} KiB):", file=stream)
+            for stat in snapshot.statistics("lineno")[:top]:
+                print(f"  {stat}", file=stream)
@@ -0,0 +1,404 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Sessions, which own the resources used to detect credentials.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import contextvars
+import logging
+import threading
+import time
+from collections.abc import Iterable, Iterator, Mapping
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable
+
+import urllib3
+
+from .cache import CacheBackend, RefreshPolicy, TokenCache
+from .oidc import http2
+from .oidc.breaker import CircuitBreaker
+from .oidc.config import Config, _active
+from .oidc.hedging import HedgingPolicy
+from .oidc.ratelimit import RateLimiter
+from .oidc.timeouts import AdaptiveTimeouts
+from .profile import profiled
+
+logger = logging.getLogger(__name__)
+
+_UNSET: Any = object()
+
+
+class Session:
+    """
+    Owns the resources used to detect credentials: an HTTP connection pool,
+    a credential cache, the threads that prefetch credentials, and the
+    policies for contacting issuers.
+
+    Sessions are isolated from each other, and the module-level API uses a
+    default session of its own. A session can be used as a context manager,
+    which closes it on exit.
+    """
+
+    def __init__(
+        self,
+        *,
+        hedging: HedgingPolicy | None = None,
+        circuit_breaker: CircuitBreaker | None = None,
+        rate_limits: Mapping[str, RateLimiter] | None = None,
+        timeouts: AdaptiveTimeouts | None = None,
+        cache: CacheBackend | None = None,
+        refresh: RefreshPolicy | None = None,
+        pool_maxsize: int = 10,
+        max_workers: int | None = None,
+    ) -> None:
+        """
+        Create a new session. `pool_maxsize` is the number of connections
+        kept alive per issuer, and `max_workers` the number of threads used by
+        `prefetch`. See `configure` for the other options.
+
+        By default, only prefetched credentials are cached, in memory. With
+        `cache`, every credential the session mints is cached in that backend
+        until shortly before it expires, and served from it by
+        `detect_credential`; a backend shared between processes or hosts lets
+        them share credentials.
+        """
+        self._lock = threading.Lock()
+        pool = self._new_pool(pool_maxsize)
+        self._config = Config(
+            pool=pool,
+            http2=http2.Http2Transport(pool=pool) if http2.enabled() else None,
+            hedging=hedging,
+            circuit_breaker=circuit_breaker,
+            rate_limits=dict(rate_limits or {}),
+            timeouts=timeouts,
+        )
+        self._refresh = refresh
+        self._max_workers = max_workers
+        self._closed = False
+
+        # Cached credentials, and the prefetches still in flight.
+        self._cache = cache if cache is not None else TokenCache()
+        self._cache_minted = cache is not None
+        self._prefetching: dict[str, Future[str | None]] = {}
+
+        # The last credential minted for each audience and its expiry, served
+        # by the `refresh` policy.
+        self._last_good: dict[str, tuple[str, float]] = {}
+        self._executor: ThreadPoolExecutor | None = None
+
+    def _new_pool(self, maxsize: int) -> urllib3.PoolManager | None:
+        return urllib3.PoolManager(maxsize=maxsize)
+
+    def __enter__(self) -> Session:
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.close()
+
+    def configure(
+        self,
+        *,
+        hedging: HedgingPolicy | None = _UNSET,
+        circuit_breaker: CircuitBreaker | None = _UNSET,
+        rate_limits: Mapping[str, RateLimiter] | None = _UNSET,
+        timeouts: AdaptiveTimeouts | None = _UNSET,
+        refresh: RefreshPolicy | None = _UNSET,
+    ) -> None:
+        """
+        Configure how this session contacts credential issuers, and serves the
+        credentials they mint. Options that aren't passed are left unchanged;
+        `None` disables an option.
+
+        `hedging` enables hedged requests to the GitHub Actions and GCP identity
+        token endpoints with the given `HedgingPolicy`.
+
+        `circuit_breaker` makes requests to every issuer endpoint fail fast while
+        the `CircuitBreaker` considers that endpoint down.
+
+        `rate_limits` maps provider names (`"GitHub"` or `"GCP"`) to the
+        `RateLimiter` for requests to that provider's endpoints.
+
+        `timeouts` replaces the fixed timeouts of requests to the GitHub
+        Actions and GCP token endpoints with ones learned by the
+        `AdaptiveTimeouts` from the latencies observed for each issuer.
+
+        `refresh` serves the last credential minted for an audience while it's
+        still valid, refreshing it in the background, as the `RefreshPolicy`
+        allows.
+        """
+        changes: dict[str, Any] = {}
+        if hedging is not _UNSET:
+            changes["hedging"] = hedging
+        if circuit_breaker is not _UNSET:
+            changes["circuit_breaker"] = circuit_breaker
+        if rate_limits is not _UNSET:
+            changes["rate_limits"] = dict(rate_limits or {})
+        if timeouts is not _UNSET:
+            changes["timeouts"] = timeouts
+
+        with self._lock:
+            self._config = self._config._replace(**changes)
+            if refresh is not _UNSET:
+                self._refresh = refresh
+
+    def detect_credential(
+        self,
+        audience: str,
+        *,
+        claims: Mapping[str, Any] | None = None,
+        circleci_root_issuer: bool = True,
+        env: Mapping[str, str] | None = None,
+    ) -> str | None:
+        """
+        Try each ambient credential detector, returning the first one to
+        succeed or `None` if all fail.
+
+        If `audience` has been passed to `prefetch`, the prefetched credential
+        is returned instead (waiting for the prefetch to finish, if necessary).
+
+        With a `refresh` policy, the last credential minted for `audience` is
+        returned as long as the policy allows, and refreshed in the background.
+
+        On CircleCI, the credential is minted with the custom `claims`, by the
+        root issuer or (without `circleci_root_issuer`) the organization's;
+        other environments ignore these. Minting each claim set spawns the
+        `circleci` CLI, so such credentials are always cached, under the
+        canonicalized claims, until shortly before they expire.
+
+        With `env`, detectors read environment variables from that mapping
+        instead of the process environment, and subprocesses (like the
+        Buildkite agent) are spawned with exactly that environment. One
+        session can then mint credentials for many tenants concurrently, each
+        with an environment of its own. Prefetches and the `refresh` policy
+        only apply to the process environment, and so are bypassed.
+
+        Raises `AmbientCredentialError` if any detector fails internally (i.e.
+        detects a credential, but cannot retrieve it).
+        """
+        self._check_open()
+
+        if claims or not circleci_root_issuer or env is not None:
+            return self._detect_scoped(audience, claims or {}, circleci_root_issuer, env)
+
+        credential = self._serve_last_good(audience)
+        if credential is not None:
+            return credential
+
+        credential = self._cache.get(self._key(audience))
+        if credential is not None:
+            return credential
+
+        with self._lock:
+            pending = self._prefetching.get(audience)
+        if pending is not None:
+            return pending.result()
+
+        credential = self._detect(audience)
+        if self._cache_minted:
+            self._store(audience, credential)
+        return credential
+
+    @contextlib.contextmanager
+    def _activated(self) -> Iterator[None]:
+        """
+        Make this session's configuration apply to requests in this context.
+        """
+        reset = _active.set(self._config)
+        try:
+            yield
+        finally:
+            _active.reset(reset)
+
+    def _serve_last_good(self, audience: str) -> str | None:
+        with self._lock:
+            refresh = self._refresh
+            entry = self._last_good.get(audience)
+        if refresh is None or entry is None:
+            return None
+
+        credential, expires_at = entry
+        remaining = expires_at - time.time()
+        if remaining <= refresh.hard:
+            return None
+        if remaining <= refresh.soft:
+            self._revalidate(audience)
+        return credential
+
+    def _revalidate(self, audience: str) -> None:
+        with self._lock:
+            if audience in self._prefetching or self._closed:
+                return
+            logger.debug(f"Session: refreshing credential for {audience!r} in the background")
+            future = self._prefetching[audience] = self._submit(self._prefetch, audience)
+
+        def _log_failure(future: Future[str | None]) -> None:
+            error = future.exception()
+            if error is not None:
+                logger.warning(
+                    f"Session: background refresh for {audience!r} failed; "
+                    f"serving the previous credential: {error}"
+                )
+
+        future.add_done_callback(_log_failure)
+
+    def _detect(self, audience: str) -> str | None:
+        from .. import _detect_credential, _expiry
+
+        with self._activated():
+            credential = _detect_credential(audience)
+
+        if credential is not None and self._refresh is not None:
+            expires_at = _expiry(credential)
+            if expires_at is not None:
+                with self._lock:
+                    self._last_good[audience] = (credential, expires_at)
+        return credential
+
+    def _detect_scoped(
+        self,
+        audience: str,
+        claims: Mapping[str, Any],
+        root_issuer: bool,
+        env: Mapping[str, str] | None,
+    ) -> str | None:
+        from .. import _detect_credential, _expiry
+        from .oidc.ambient import _cache_key, _claims_variant
+
+        # Prefetches and the refresh policy are per audience, so they're
+        # bypassed; the cache is keyed on the claims and the identity in
+        # `env` as well. Custom claims are always cached, as for
+        # `detect_credential`; other credentials only with a `cache` backend.
+        custom = bool(claims) or not root_issuer
+        variant = _claims_variant(claims, root_issuer) if custom else ""
+        key = _cache_key(audience, variant, env)
+        credential = self._cache.get(key)
+        if credential is not None:
+            return credential
+
+        options = {} if env is None else {"env": env}
+        with self._activated():
+            credential = _detect_credential(
+                audience, claims=claims, circleci_root_issuer=root_issuer, **options
+            )
+        if credential is not None and (custom or self._cache_minted):
+            expires_at = _expiry(credential)
+            if expires_at is not None:
+                self._cache.put(key, credential, expires_at)
+        return credential
+
+    def _key(self, audience: str) -> str:
+        from .oidc.ambient import _cache_key
+
+        return _cache_key(audience)
+
+    def _store(self, audience: str, credential: str | None) -> None:
+        from .. import _expiry
+
+        if credential is not None:
+            expires_at = _expiry(credential)
+            if expires_at is not None:
+                self._cache.put(self._key(audience), credential, expires_at)
+
+    def _prefetch(self, audience: str) -> str | None:
+        try:
+            credential = self._detect(audience)
+            self._store(audience, credential)
+            return credential
+        finally:
+            with self._lock:
+                self._prefetching.pop(audience, None)
+
+    def prefetch(self, audiences: Iterable[str]) -> dict[str, Future[str | None]]:
+        """
+        Start detecting and minting credentials for each of `audiences` in the
+        background, so that later `detect_credential` calls for them return
+        immediately.
+
+        Minting in the background also performs DNS resolution and connection
+        setup to the credential issuer ahead of time; established connections
+        are kept alive and reused by later requests to the same issuer.
+
+        Returns a mapping of each audience to a `Future` for its credential.
+        Errors are raised from the `Future`, and again from `detect_credential`
+        calls that wait on an in-flight prefetch.
+        """
+        self._check_open()
+
+        futures: dict[str, Future[str | None]] = {}
+        for audience in audiences:
+            # The cache may be on the network, so it's read without the lock.
+            credential = self._cache.get(self._key(audience))
+            if credential is not None:
+                futures[audience] = Future()
+                futures[audience].set_result(credential)
+                continue
+
+            with self._lock:
+                # `close` may have run since the check above; submitting now
+                # would start an executor that nothing shuts down.
+                self._check_open()
+                future = self._prefetching.get(audience)
+                if future is None:
+                    future = self._prefetching[audience] = self._submit(self._prefetch, audience)
+            futures[audience] = future
+
+        return futures
+
+    def _submit(self, fn: Callable[[str], str | None], audience: str) -> Future[str | None]:
+        # Callers must hold `self._lock`.
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self._max_workers, thread_name_prefix="id-prefetch")
+        # In a copy of the caller's context, so that a cassette being recorded
+        # or replayed (see `cassette.py`) applies to the prefetch too, and a
+        # profile being taken (see `profile.py`) includes it.
+        return self._executor.submit(contextvars.copy_context().run, profiled, fn, audience)
+
+    def _check_open(self) -> None:
+        if self._closed:
+            raise RuntimeError("session is closed")
+
+    def close(self) -> None:
+        """
+        Wait for in-flight prefetches, then release the session's threads,
+        connections and in-memory cached credentials. A `cache` backend passed
+        to the session is left as is. The session can't be used again.
+        """
+        with self._lock:
+            self._closed = True
+            executor, self._executor = self._executor, None
+
+        if executor is not None:
+            executor.shutdown(wait=True)
+        if self._config.http2 is not None:
+            self._config.http2.close()
+        if self._config.pool is not None:
+            self._config.pool.clear()
+        if not self._cache_minted:
+            self._cache.clear()
+        with self._lock:
+            self._last_good.clear()
+
+
+class _DefaultSession(Session):
+    """
+    The session behind the module-level API. It sends requests through
+    urllib3's module-level pool, like `id` always has.
+    """
+
+    def _new_pool(self, maxsize: int) -> urllib3.PoolManager | None:
+        return None
@@ -0,0 +1,163 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A sidecar that keeps token files up to date, for consumers that read their
+credential from a path (like Kubernetes projected service account tokens).
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .session import Session
+
+logger = logging.getLogger(__name__)
+
+
+def _write_private(path: str, data: str) -> None:
+    """
+    Atomically replace `path` with `data`, readable only by its owner.
+
+    Readers see either the old file or the new one, never a partial write.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".id-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class Sidecar:
+    """
+    Keeps one token file per audience up to date, re-minting each credential
+    before it expires and atomically rewriting its file with mode 0600.
+    """
+
+    def __init__(
+        self,
+        files: Mapping[str, str],
+        *,
+        heartbeat: str | None = None,
+        refresh_at: float = 0.8,
+        interval: float = 300.0,
+        retry: float = 10.0,
+        session: Session | None = None,
+    ) -> None:
+        """
+        Create a sidecar writing the token for each audience in `files` to
+        its path.
+
+        Each token is re-minted once `refresh_at` of its lifetime has passed,
+        as the kubelet does for projected tokens, or every `interval` seconds
+        if it has no `exp` claim. Failed mints are retried every `retry`
+        seconds, while the previous token is still valid.
+
+        After every round in which each file holds an unexpired token, the
+        current UNIX time is written to `heartbeat`, if given. Credentials are
+        detected with `session`, or the default session.
+        """
+        if not 0 < refresh_at < 1:
+            raise ValueError("refresh_at must be between 0 and 1")
+
+        self.files = dict(files)
+        self.heartbeat = heartbeat
+        self.refresh_at = refresh_at
+        self.interval = interval
+        self.retry = retry
+        self._session = session
+
+        # When each audience is next due for minting, and when its current
+        # token (if any) expires.
+        self._due = dict.fromkeys(self.files, 0.0)
+        self._expires: dict[str, float] = {}
+
+    def _mint(self, audience: str) -> str | None:
+        from .. import _expiry, _get_default_session
+
+        session = self._session if self._session is not None else _get_default_session()
+        try:
+            token = session.detect_credential(audience)
+        except Exception as e:
+            logger.warning(f"Sidecar: minting a credential for {audience!r} failed: {e}")
+            return None
+        if token is None:
+            logger.warning(f"Sidecar: no credential available for {audience!r}")
+            return None
+
+        now = time.time()
+        exp = _expiry(token)
+        _write_private(self.files[audience], token)
+        if exp is None:
+            self._expires[audience] = float("inf")
+            self._due[audience] = now + self.interval
+        else:
+            self._expires[audience] = exp
+            self._due[audience] = now + (exp - now) * self.refresh_at
+        logger.debug(f"Sidecar: wrote {self.files[audience]}; next refresh in {self.delay():.0f}s")
+        return token
+
+    def refresh(self) -> bool:
+        """
+        Mint, concurrently, every credential that's due, and rewrite its file.
+
+        Returns whether every file now holds an unexpired token.
+        """
+        now = time.time()
+        due = [audience for audience, at in self._due.items() if at <= now]
+        if due:
+            with ThreadPoolExecutor(len(due), thread_name_prefix="id-sidecar") as pool:
+                minted = dict(zip(due, pool.map(self._mint, due)))
+            for audience, token in minted.items():
+                if token is None:
+                    self._due[audience] = now + self.retry
+
+        now = time.time()
+        healthy = all(self._expires.get(audience, 0) > now for audience in self.files)
+        if healthy and self.heartbeat is not None:
+            _write_private(self.heartbeat, f"{int(now)}\n")
+        return healthy
+
+    def delay(self) -> float:
+        """
+        The number of seconds until the next credential is due.
+        """
+        return max(min(self._due.values()) - time.time(), 0.0)
+
+    def run(self, stop: threading.Event | None = None) -> bool:
+        """
+        Refresh credentials until `stop` is set, returning `True`, or until
+        a token file can't be kept valid, returning `False`.
+        """
+        stop = stop if stop is not None else threading.Event()
+        while True:
+            if not self.refresh():
+                expired = [a for a in self.files if self._expires.get(a, 0) <= time.time()]
+                logger.error(f"Sidecar: no valid credential for {', '.join(map(repr, expired))}")
+                return False
+            if stop.wait(self.delay()):
+                return True
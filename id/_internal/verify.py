@@ -0,0 +1,138 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Relying-party verification of presented OIDC tokens, with a cache of
+verified claims.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Iterable, Mapping
+from types import MappingProxyType
+from typing import Any, Callable
+
+
+class TokenVerifier:
+    """
+    Checks presented tokens against a fixed set of allowed audiences and
+    issuers, caching the claims of verified tokens until they expire.
+
+    `id` does not verify token signatures itself: `verify_signature` plugs in
+    a JWS verifier, which is called once per distinct token. It's required,
+    since claims alone are trivially forged.
+    """
+
+    def __init__(
+        self,
+        *,
+        audiences: Iterable[str],
+        issuers: Iterable[str],
+        verify_signature: Callable[[str], None],
+        maxsize: int = 1024,
+        leeway: float = 0,
+    ) -> None:
+        """
+        Create a new verifier accepting tokens for any of `audiences`, issued
+        by any of `issuers`. Up to `maxsize` verified tokens are cached, least
+        recently used first out.
+
+        `verify_signature` is called with each token before its claims are
+        checked, and should raise to reject it. `leeway` is the allowed clock
+        skew, in seconds, when checking `exp`, `nbf` and `iat`.
+        """
+        if not callable(verify_signature):
+            raise TypeError("verify_signature must be a callable that verifies a token")
+        self.audiences = frozenset(audiences)
+        self.issuers = frozenset(issuers)
+        self.maxsize = maxsize
+        self.leeway = leeway
+        self.verify_signature = verify_signature
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._cache: OrderedDict[bytes, tuple[Mapping[str, Any], float]] = OrderedDict()
+
+    def verify(self, token: str) -> Mapping[str, Any]:
+        """
+        Verify `token`, returning a read-only mapping of its claims.
+
+        Raises `IdentityError` if the token is malformed, has expired or is not
+        yet valid, or has a disallowed issuer or audience.
+        """
+        key = hashlib.sha256(token.encode()).digest()
+        now = time.time()
+
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                claims, exp = entry
+                if now < exp + self.leeway:
+                    self._cache.move_to_end(key)
+                    self.hits += 1
+                    return claims
+                del self._cache[key]
+            self.misses += 1
+
+        from .. import IdentityError, _b64decode
+
+        try:
+            _, payload, _ = token.split(".")
+            payload_json = json.loads(_b64decode(payload))
+        except ValueError as e:
+            raise IdentityError("Malformed token") from e
+        if not isinstance(payload_json, dict):
+            raise IdentityError("Malformed token payload (JWT is not a JSON object)")
+
+        self.verify_signature(token)
+
+        iss = payload_json.get("iss")
+        if not isinstance(iss, str) or iss not in self.issuers:
+            raise IdentityError(f"Token issuer not allowed ({iss!r})")
+
+        aud = payload_json.get("aud")
+        auds = aud if isinstance(aud, list) else [aud]
+        if not any(isinstance(a, str) and a in self.audiences for a in auds):
+            raise IdentityError(f"Token audience not allowed ({aud!r})")
+
+        exp = payload_json.get("exp")
+        if not isinstance(exp, (int, float)) or isinstance(exp, bool):
+            raise IdentityError("Malformed token payload (expiry claim is missing)")
+        if now >= exp + self.leeway:
+            raise IdentityError("Token has expired")
+        for claim in ("nbf", "iat"):
+            value = payload_json.get(claim)
+            if isinstance(value, (int, float)) and now < value - self.leeway:
+                raise IdentityError(f"Token is not yet valid ({claim} is in the future)")
+
+        claims = MappingProxyType(payload_json)
+        with self._lock:
+            self._cache[key] = (claims, exp)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return claims
+
+    def clear(self) -> None:
+        """
+        Drop every cached verification.
+        """
+        with self._lock:
+            self._cache.clear()
@@ -0,0 +1,34 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import json
+
+import pytest
+
+
+@pytest.fixture
+def make_token():
+    def _token(audience, exp):
+        payload = base64.urlsafe_b64encode(json.dumps({"aud": audience, "exp": exp}).encode())
+        return f"e30.{payload.decode().rstrip('=')}.sig"
+
+    return _token
+
+
+@pytest.fixture
+def github(monkeypatch):
+    monkeypatch.setenv("GITHUB_ACTIONS", "true")
+    monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_TOKEN", "faketoken")
+    monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_URL", "https://fakeurl/token")
@@ -12,11 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import io
 import json
+import os
 from pathlib import Path
 
 import pretend
 import pytest
+import urllib3
 
 from id import detect_credential
 from id._internal.oidc import ambient
@@ -30,6 +33,22 @@ _GHA_TOKEN = (HERE / "gha_token.txt").read_text().strip()
 _GHA_TOKEN_REQUEST_URL = "https://run-actions-3-azure-eastus.actions.githubusercontent.com/64//idtoken/918f5315-f823-4b74-ae16-8fc423e48661/0b77e920-7dce-5419-aca2-996d3c2116b7?api-version=2.0"
 
 
+@pytest.fixture(autouse=True)
+def no_gcp_runtime(monkeypatch):
+    # Keep the GCP detector from probing for a metadata server for real.
+    for var in ("GCE_METADATA_HOST", *ambient._GCP_RUNTIME_ENV_VARS):
+        monkeypatch.delenv(var, raising=False)
+    monkeypatch.setattr(ambient, "_gcp_probes", {})
+    monkeypatch.setattr(ambient, "_gcp_accounts", {})
+
+
+def _response(status, data=b""):
+    """
+    A response to a streamed request, as `urllib3.request` returns it.
+    """
+    return urllib3.HTTPResponse(body=io.BytesIO(data), status=status, preload_content=False)
+
+
 def test_detect_credential_none(monkeypatch):
     detect_none = pretend.call_recorder(lambda audience: None)
     monkeypatch.setattr(ambient, "detect_github", detect_none)
@@ -67,6 +86,69 @@ def test_detect_credential_malformed_token(monkeypatch):
         detect_credential("my-audience")
 
 
+def test_detect_credential_file_first(monkeypatch, tmp_path):
+    token_file = tmp_path / "token"
+    token_file.write_text(f"{_GHA_TOKEN}\n")
+    monkeypatch.setenv("SIGSTORE_ID_TOKEN_FILE", str(token_file))
+
+    detect_github = pretend.call_recorder(lambda audience: None)
+    monkeypatch.setattr(ambient, "detect_github", detect_github)
+
+    assert detect_credential("sigstore") == _GHA_TOKEN
+    assert detect_github.calls == []
+
+
+def test_detect_file_bad_env(monkeypatch):
+    monkeypatch.delenv("SOME_AUDIENCE_ID_TOKEN_FILE", False)
+
+    logger = pretend.stub(debug=pretend.call_recorder(lambda s: None))
+    monkeypatch.setattr(ambient, "logger", logger)
+
+    assert ambient.detect_file("some-audience") is None
+    assert logger.debug.calls == [
+        pretend.call("File: looking for OIDC credentials"),
+        pretend.call("File: environment variable SOME_AUDIENCE_ID_TOKEN_FILE not set; giving up"),
+    ]
+
+
+def test_detect_file_missing(monkeypatch, tmp_path):
+    monkeypatch.setenv("SOME_AUDIENCE_ID_TOKEN_FILE", str(tmp_path / "missing"))
+
+    with pytest.raises(ambient.AmbientCredentialError, match="File: could not read token file"):
+        ambient.detect_file("some-audience")
+
+
+def test_detect_file_empty(monkeypatch, tmp_path):
+    token_file = tmp_path / "token"
+    token_file.write_text("\n")
+    monkeypatch.setenv("SOME_AUDIENCE_ID_TOKEN_FILE", str(token_file))
+
+    with pytest.raises(ambient.AmbientCredentialError, match="File: token file .* is empty"):
+        ambient.detect_file("some-audience")
+
+
+def test_detect_file_rereads_only_on_change(monkeypatch, tmp_path):
+    token_file = tmp_path / "token"
+    token_file.write_text("fakejwt\n")
+    monkeypatch.setenv("SOME_AUDIENCE_ID_TOKEN_FILE", str(token_file))
+
+    _open = pretend.call_recorder(open)
+    monkeypatch.setattr(ambient, "_open", _open)
+
+    assert ambient.detect_file("some-audience") == "fakejwt"
+    assert ambient.detect_file("some-audience") == "fakejwt"
+    assert len(_open.calls) == 1
+
+    # Simulate a kubelet rotation, which replaces the file with a new inode.
+    rotated = tmp_path / "token.new"
+    rotated.write_text("fakejwt2\n")
+    rotated.replace(token_file)
+
+    assert ambient.detect_file("some-audience") == "fakejwt2"
+    assert ambient.detect_file("some-audience") == "fakejwt2"
+    assert len(_open.calls) == 2
+
+
 def test_detect_github_bad_env(monkeypatch):
     # We might actually be running in a CI, so explicitly remove this.
     monkeypatch.delenv("GITHUB_ACTIONS", raising=False)
@@ -122,10 +204,7 @@ def test_detect_github_request_fails(monkeypatch):
     monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_TOKEN", "faketoken")
     monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_URL", _GHA_TOKEN_REQUEST_URL)
 
-    resp = pretend.stub(
-        status=999,
-        data=b"something",
-    )
+    resp = _response(999, b"something")
     u3 = pretend.stub(request=pretend.call_recorder(lambda meth, url, **kw: resp))
     monkeypatch.setattr(ambient, "urllib3", u3)
 
@@ -141,6 +220,7 @@ def test_detect_github_request_fails(monkeypatch):
             fields=None,
             headers={"Authorization": "bearer faketoken"},
             timeout=30,
+            preload_content=False,
         )
     ]
 
@@ -168,7 +248,7 @@ def test_detect_github_invalid_json_payload(monkeypatch):
     monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_TOKEN", "faketoken")
     monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_URL", _GHA_TOKEN_REQUEST_URL)
 
-    resp = pretend.stub(status=200, json=pretend.raiser(json.JSONDecodeError))
+    resp = _response(200, b"{not json")
     request = pretend.call_recorder(lambda meth, url, **kw: resp)
     monkeypatch.setattr(ambient.urllib3, "request", request)
 
@@ -184,6 +264,7 @@ def test_detect_github_invalid_json_payload(monkeypatch):
             fields=None,
             headers={"Authorization": "bearer faketoken"},
             timeout=30,
+            preload_content=False,
         )
     ]
 
@@ -194,7 +275,7 @@ def test_detect_github_bad_payload(monkeypatch, payload):
     monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_TOKEN", "faketoken")
     monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_URL", _GHA_TOKEN_REQUEST_URL)
 
-    resp = pretend.stub(status=200, json=pretend.call_recorder(lambda: payload))
+    resp = _response(200, json.dumps(payload).encode())
     u3 = pretend.stub(request=pretend.call_recorder(lambda meth, url, **kw: resp))
     monkeypatch.setattr(ambient, "urllib3", u3)
 
@@ -210,9 +291,9 @@ def test_detect_github_bad_payload(monkeypatch, payload):
             fields=None,
             headers={"Authorization": "bearer faketoken"},
             timeout=30,
+            preload_content=False,
         )
     ]
-    assert resp.json.calls == [pretend.call()]
 
 
 def test_detect_github(monkeypatch):
@@ -220,10 +301,7 @@ def test_detect_github(monkeypatch):
     monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_TOKEN", "faketoken")
     monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_URL", _GHA_TOKEN_REQUEST_URL)
 
-    resp = pretend.stub(
-        status=200,
-        json=pretend.call_recorder(lambda: {"value": "fakejwt"}),
-    )
+    resp = _response(200, b'{"value": "fakejwt"}')
     u3 = pretend.stub(request=pretend.call_recorder(lambda meth, url, **kw: resp))
     monkeypatch.setattr(ambient, "urllib3", u3)
 
@@ -235,9 +313,9 @@ def test_detect_github(monkeypatch):
             fields=None,
             headers={"Authorization": "bearer faketoken"},
             timeout=30,
+            preload_content=False,
         )
     ]
-    assert resp.json.calls == [pretend.call()]
 
 
 def test_gcp_impersonation_access_token_request_fail(monkeypatch):
@@ -246,7 +324,7 @@ def test_gcp_impersonation_access_token_request_fail(monkeypatch):
     logger = pretend.stub(debug=pretend.call_recorder(lambda s: None))
     monkeypatch.setattr(ambient, "logger", logger)
 
-    resp = pretend.stub(status=999, data=b"something")
+    resp = _response(999, b"something")
     u3 = pretend.stub(request=pretend.call_recorder(lambda meth, url, **kw: resp))
     monkeypatch.setattr(ambient, "urllib3", u3)
 
@@ -294,7 +372,7 @@ def test_gcp_impersonation_access_token_missing(monkeypatch):
     logger = pretend.stub(debug=pretend.call_recorder(lambda s: None))
     monkeypatch.setattr(ambient, "logger", logger)
 
-    resp = pretend.stub(status=200, json=lambda: {})
+    resp = _response(200, json.dumps({}).encode())
     u3 = pretend.stub(request=pretend.call_recorder(lambda meth, url, **kw: resp))
     monkeypatch.setattr(ambient, "urllib3", u3)
 
@@ -317,12 +395,9 @@ def test_gcp_impersonation_identity_token_request_fail(monkeypatch):
     logger = pretend.stub(debug=pretend.call_recorder(lambda s: None))
     monkeypatch.setattr(ambient, "logger", logger)
 
-    access_token = pretend.stub()
-    get_resp = pretend.stub(status=200, json=lambda: {"access_token": access_token})
-    post_resp = pretend.stub(
-        status=999,
-        data=b"something",
-    )
+    access_token = "fake-access-token"
+    get_resp = _response(200, json.dumps({"access_token": access_token}).encode())
+    post_resp = _response(999, b"something")
 
     def _request(meth, *a, **kw):
         if meth == "GET":
@@ -355,8 +430,8 @@ def test_gcp_impersonation_identity_token_request_timeout(monkeypatch):
     logger = pretend.stub(debug=pretend.call_recorder(lambda s: None))
     monkeypatch.setattr(ambient, "logger", logger)
 
-    access_token = pretend.stub()
-    get_resp = pretend.stub(status=200, json=lambda: {"access_token": access_token})
+    access_token = "fake-access-token"
+    get_resp = _response(200, json.dumps({"access_token": access_token}).encode())
 
     def _request(meth, *a, **kw):
         if meth == "GET":
@@ -389,9 +464,9 @@ def test_gcp_impersonation_identity_token_missing(monkeypatch):
     logger = pretend.stub(debug=pretend.call_recorder(lambda s: None))
     monkeypatch.setattr(ambient, "logger", logger)
 
-    access_token = pretend.stub()
-    get_resp = pretend.stub(status=200, json=lambda: {"access_token": access_token})
-    post_resp = pretend.stub(status=200, json=lambda: {})
+    access_token = "fake-access-token"
+    get_resp = _response(200, json.dumps({"access_token": access_token}).encode())
+    post_resp = _response(200, json.dumps({}).encode())
 
     def _request(meth, *a, **kw):
         if meth == "GET":
@@ -424,10 +499,10 @@ def test_gcp_impersonation_succeeds(monkeypatch):
     logger = pretend.stub(debug=pretend.call_recorder(lambda s: None))
     monkeypatch.setattr(ambient, "logger", logger)
 
-    access_token = pretend.stub()
-    oidc_token = pretend.stub()
-    get_resp = pretend.stub(status=200, json=lambda: {"access_token": access_token})
-    post_resp = pretend.stub(status=200, json=lambda: {"token": oidc_token})
+    access_token = "fake-access-token"
+    oidc_token = "fake-oidc-token"
+    get_resp = _response(200, json.dumps({"access_token": access_token}).encode())
+    post_resp = _response(200, json.dumps({"token": oidc_token}).encode())
 
     def _request(meth, *a, **kw):
         if meth == "GET":
@@ -494,10 +569,7 @@ def test_detect_gcp_request_fails(monkeypatch):
     )
     monkeypatch.setattr(ambient, "_open", lambda fn: stub_file)  # type: ignore
 
-    resp = pretend.stub(
-        status=999,
-        data=b"something",
-    )
+    resp = _response(999, b"something")
     u3 = pretend.stub(request=pretend.call_recorder(lambda meth, url, **kw: resp))
     monkeypatch.setattr(ambient, "urllib3", u3)
 
@@ -509,10 +581,11 @@ def test_detect_gcp_request_fails(monkeypatch):
     assert u3.request.calls == [
         pretend.call(
             "GET",
-            f"{ambient._GCP_IDENTITY_REQUEST_URL}?audience=some-audience&format=full",
+            f"http://169.254.169.254{ambient._GCP_IDENTITY_REQUEST_PATH}?audience=some-audience&format=full",
             fields=None,
             headers={"Metadata-Flavor": "Google"},
             timeout=30,
+            preload_content=False,
         )
     ]
 
@@ -547,10 +620,7 @@ def test_detect_gcp(monkeypatch, product_name):
     logger = pretend.stub(debug=pretend.call_recorder(lambda s: None))
     monkeypatch.setattr(ambient, "logger", logger)
 
-    resp = pretend.stub(
-        status=200,
-        data=b"fakejwt",
-    )
+    resp = _response(200, b"fakejwt")
     u3 = pretend.stub(request=pretend.call_recorder(lambda meth, url, **kw: resp))
     monkeypatch.setattr(ambient, "urllib3", u3)
 
@@ -558,10 +628,11 @@ def test_detect_gcp(monkeypatch, product_name):
     assert u3.request.calls == [
         pretend.call(
             "GET",
-            f"{ambient._GCP_IDENTITY_REQUEST_URL}?audience=some-audience&format=full",
+            f"http://169.254.169.254{ambient._GCP_IDENTITY_REQUEST_PATH}?audience=some-audience&format=full",
             fields=None,
             headers={"Metadata-Flavor": "Google"},
             timeout=30,
+            preload_content=False,
         )
     ]
     assert logger.debug.calls == [
@@ -572,6 +643,106 @@ def test_detect_gcp(monkeypatch, product_name):
     ]
 
 
+@pytest.fixture
+def gcp_runtime(monkeypatch):
+    # Cloud Run, without a DMI product name file.
+    monkeypatch.setattr(ambient, "_open", pretend.raiser(OSError))
+    monkeypatch.setenv("K_SERVICE", "some-service")
+
+
+def test_detect_gcp_probes_metadata_server(monkeypatch, gcp_runtime):
+    probe = urllib3.HTTPResponse(
+        body=io.BytesIO(b""),
+        status=200,
+        headers={"Metadata-Flavor": "Google"},
+        preload_content=False,
+    )
+    responses = iter([probe, _response(200, b"fakejwt"), _response(200, b"fakejwt")])
+    request = pretend.call_recorder(lambda meth, url, **kw: next(responses))
+    monkeypatch.setattr(ambient.urllib3, "request", request)
+
+    assert ambient.detect_gcp("some-audience") == "fakejwt"
+    assert ambient.detect_gcp("some-audience") == "fakejwt"
+
+    # The metadata server is only probed once, with a tight timeout.
+    probe_call, *token_calls = request.calls
+    assert probe_call.args == ("GET", "http://169.254.169.254/")
+    assert probe_call.kwargs["timeout"] is ambient._GCP_PROBE_TIMEOUT
+    assert probe_call.kwargs["retries"].total == 0
+    assert [call.args[1] for call in token_calls] == [
+        f"http://169.254.169.254{ambient._GCP_IDENTITY_REQUEST_PATH}"
+        "?audience=some-audience&format=full"
+    ] * 2
+
+
+def test_detect_gcp_probe_fails_fast(monkeypatch, gcp_runtime):
+    request = pretend.call_recorder(
+        pretend.raiser(urllib3.exceptions.MaxRetryError(None, "http://169.254.169.254/"))
+    )
+    monkeypatch.setattr(ambient.urllib3, "request", request)
+
+    assert ambient.detect_gcp("some-audience") is None
+    assert ambient.detect_gcp("some-audience") is None
+    assert len(request.calls) == 1
+
+
+def test_detect_gcp_probe_not_metadata_server(monkeypatch, gcp_runtime):
+    # Something else answering on the link-local address, like another
+    # cloud's metadata service.
+    monkeypatch.setattr(
+        ambient.urllib3, "request", lambda meth, url, **kw: _response(404, b"not found")
+    )
+
+    assert ambient.detect_gcp("some-audience") is None
+
+
+def test_detect_gcp_no_runtime_doesnt_probe(monkeypatch, gcp_runtime):
+    monkeypatch.delenv("K_SERVICE")
+    monkeypatch.setattr(ambient.urllib3, "request", pretend.raiser(AssertionError("probed")))
+
+    assert ambient.detect_gcp("some-audience") is None
+
+
+def test_detect_gcp_metadata_host(monkeypatch):
+    monkeypatch.setenv("GCE_METADATA_HOST", "127.0.0.1:8080")
+    stub_file = pretend.stub(
+        __enter__=lambda *a: pretend.stub(read=lambda: "Google"),
+        __exit__=lambda *a: None,
+    )
+    monkeypatch.setattr(ambient, "_open", lambda fn: stub_file)  # type: ignore
+    request = pretend.call_recorder(lambda meth, url, **kw: _response(200, b"fakejwt"))
+    monkeypatch.setattr(ambient.urllib3, "request", request)
+
+    assert ambient.detect_gcp("some-audience") == "fakejwt"
+    assert (
+        request.calls[0]
+        .args[1]
+        .startswith(f"http://127.0.0.1:8080{ambient._GCP_IDENTITY_REQUEST_PATH}?")
+    )
+
+
+def test_detect_gcp_impersonation_metadata_host(monkeypatch):
+    monkeypatch.setenv("GCE_METADATA_HOST", "127.0.0.1:8080")
+    monkeypatch.setenv("GOOGLE_SERVICE_ACCOUNT_NAME", "identity@project.iam.gserviceaccount.com")
+
+    def _request(meth, url, **kw):
+        if meth == "GET":
+            return _response(200, json.dumps({"access_token": "fake-access-token"}).encode())
+        return _response(200, json.dumps({"token": "fakejwt"}).encode())
+
+    request = pretend.call_recorder(_request)
+    monkeypatch.setattr(ambient.urllib3, "request", request)
+
+    assert ambient.detect_gcp("some-audience") == "fakejwt"
+    token_url, id_token_url = (call.args[1] for call in request.calls)
+    # The access token comes from the overridden metadata server; the ID token
+    # still comes from the IAM credentials API.
+    assert token_url.startswith(f"http://127.0.0.1:8080{ambient._GCP_TOKEN_REQUEST_PATH}?")
+    assert id_token_url == ambient._GCP_GENERATEIDTOKEN_REQUEST_URL.format(
+        "identity@project.iam.gserviceaccount.com"
+    )
+
+
 def test_buildkite_no_agent(monkeypatch):
     monkeypatch.setenv("BUILDKITE", "true")
 
@@ -804,3 +975,144 @@ def test_circleci(monkeypatch, root_issuer):
             text=True,
         )
     ]
+
+
+def test_circleci_custom_claims(monkeypatch):
+    monkeypatch.setenv("CIRCLECI", "true")
+    monkeypatch.setattr(ambient.shutil, "which", lambda bin: "/usr/bin/circleci")
+    resp = pretend.stub(returncode=0, stdout="fakejwt")
+    run = pretend.call_recorder(lambda run_args, **kw: resp)
+    monkeypatch.setattr(ambient.subprocess, "run", run)
+
+    claims = {"repo": "example/repo", "n": 1}
+    assert ambient.detect_circleci("some-audience", False, claims) == "fakejwt"
+    (call,) = run.calls
+    assert call.args[0][:5] == ["circleci", "run", "oidc", "get", "--claims"]
+    assert json.loads(call.args[0][5]) == {"aud": "some-audience", **claims}
+    assert "--root-issuer" not in call.args[0]
+
+
+def test_claims_variant():
+    assert ambient._claims_variant({"a": 1, "b": [2]}, True) == ambient._claims_variant(
+        {"b": [2], "a": 1}, True
+    )
+    assert ambient._claims_variant({"a": 1}, True) != ambient._claims_variant({"a": 1}, False)
+    assert ambient._cache_key("aud") != ambient._cache_key(
+        "aud", ambient._claims_variant({}, False)
+    )
+
+    with pytest.raises(ValueError, match="can't include `aud`"):
+        ambient._claims_variant({"aud": "other"}, True)
+
+
+def test_detectors_read_explicit_env(monkeypatch, tmp_path):
+    # The process environment looks like GitLab; the explicit one doesn't.
+    monkeypatch.setenv("GITLAB_CI", "true")
+    monkeypatch.setenv("SOME_AUDIENCE_ID_TOKEN", "process-jwt")
+    assert ambient.detect_gitlab("some-audience", env={}) is None
+
+    env = {"GITLAB_CI": "true", "SOME_AUDIENCE_ID_TOKEN": "tenant-jwt"}
+    assert ambient.detect_gitlab("some-audience", env=env) == "tenant-jwt"
+
+    token_file = tmp_path / "token"
+    token_file.write_text("file-jwt")
+    assert ambient.detect_file("some-audience", env={}) is None
+    env = {"SOME_AUDIENCE_ID_TOKEN_FILE": str(token_file)}
+    assert ambient.detect_file("some-audience", env=env) == "file-jwt"
+
+    monkeypatch.setenv("GCE_METADATA_HOST", "metadata.process")
+    url = ambient._gcp_metadata_url("/", {"GCE_METADATA_HOST": "metadata.tenant"})
+    assert url == "http://metadata.tenant/"
+
+
+def test_github_explicit_env(monkeypatch):
+    monkeypatch.delenv("GITHUB_ACTIONS", raising=False)
+    request = pretend.call_recorder(
+        lambda *a, **kw: _response(200, json.dumps({"value": "fakejwt"}).encode())
+    )
+    monkeypatch.setattr(ambient.urllib3, "request", request)
+
+    env = {
+        "GITHUB_ACTIONS": "true",
+        "ACTIONS_ID_TOKEN_REQUEST_TOKEN": "tenant-token",
+        "ACTIONS_ID_TOKEN_REQUEST_URL": "https://tenant.example/token",
+    }
+    assert ambient.detect_github("aud", env=env) == "fakejwt"
+    (call,) = request.calls
+    assert call.args == ("GET", "https://tenant.example/token?audience=aud")
+    assert call.kwargs["headers"] == {"Authorization": "bearer tenant-token"}
+
+
+@pytest.mark.parametrize(
+    ("detect", "var", "binary"),
+    [
+        (ambient.detect_buildkite, "BUILDKITE", "buildkite-agent"),
+        (ambient.detect_circleci, "CIRCLECI", "circleci"),
+    ],
+)
+def test_subprocess_explicit_env(monkeypatch, detect, var, binary):
+    monkeypatch.delenv(var, raising=False)
+    monkeypatch.setattr(ambient.shutil, "which", lambda bin: f"/usr/bin/{binary}")
+    resp = pretend.stub(returncode=0, stdout="fakejwt")
+    run = pretend.call_recorder(lambda run_args, **kw: resp)
+    monkeypatch.setattr(ambient.subprocess, "run", run)
+
+    # Children see exactly the tenant's environment.
+    env = {var: "true", "TENANT_SECRET": "s3cret"}
+    assert detect("aud", env=env) == "fakejwt"
+    (call,) = run.calls
+    assert call.kwargs["env"] == env
+
+
+def test_cache_key_explicit_env(monkeypatch):
+    monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_URL", "https://example.com/run/1")
+    process = ambient._cache_key("aud")
+    assert ambient._cache_key("aud", env=dict(os.environ)) == process
+    assert ambient._cache_key("aud", env={}) != process
+    assert ambient._cache_key(
+        "aud", env={"ACTIONS_ID_TOKEN_REQUEST_URL": "https://example.com/run/2"}
+    ) not in {process, ambient._cache_key("aud", env={})}
+
+
+def test_cache_key_gcp_default_account(monkeypatch):
+    stub_file = pretend.stub(
+        __enter__=lambda *a: pretend.stub(read=lambda: "Google"),
+        __exit__=lambda *a: None,
+    )
+    monkeypatch.setattr(ambient, "_open", lambda fn: stub_file)  # type: ignore
+    account = "a@project.iam.gserviceaccount.com"
+    request = pretend.call_recorder(lambda method, url, **kw: _response(200, account.encode()))
+    monkeypatch.setattr(ambient.urllib3, "request", request)
+
+    first = ambient._cache_key("aud")
+    assert ambient._cache_key("aud") == first
+    # The account is looked up once per metadata server.
+    (call,) = request.calls
+    assert call.args[1] == f"http://{ambient._GCP_METADATA_HOST}{ambient._GCP_EMAIL_REQUEST_PATH}"
+
+    # Another host, with another default service account.
+    monkeypatch.setattr(ambient, "_gcp_accounts", {})
+    account = "b@project.iam.gserviceaccount.com"
+    assert ambient._cache_key("aud") != first
+
+    # An account that can't be looked up is never shared between processes.
+    monkeypatch.setattr(ambient, "_gcp_accounts", {})
+    monkeypatch.setattr(ambient.urllib3, "request", lambda method, url, **kw: _response(404))
+    assert ambient._gcp_default_account({}) == ambient._UNKNOWN_GCP_ACCOUNT
+
+    # Impersonated service accounts are keyed by name instead.
+    assert ambient._gcp_default_account({"GOOGLE_SERVICE_ACCOUNT_NAME": "sa"}) == ""
+
+
+def test_cache_key_off_gcp(monkeypatch):
+    monkeypatch.setattr(ambient, "_open", pretend.raiser(OSError))
+    monkeypatch.setattr(ambient.urllib3, "request", pretend.raiser(AssertionError("requested")))
+    assert ambient._gcp_default_account({}) == ""
+
+
+def test_detect_credential_explicit_env(monkeypatch, make_token):
+    monkeypatch.delenv("GITLAB_CI", raising=False)
+    token = make_token("sigstore", 2**31)
+    env = {"GITLAB_CI": "true", "SIGSTORE_ID_TOKEN": token}
+
+    assert detect_credential("sigstore", env=env) == token
@@ -0,0 +1,151 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+
+import pretend
+import pytest
+import urllib3
+
+import id
+from id import AmbientCredentialError
+from id._internal.oidc import ambient, breaker
+from id._internal.oidc.breaker import CircuitBreaker
+
+
+@pytest.fixture(autouse=True)
+def no_breaker():
+    yield
+    id.configure(circuit_breaker=None)
+
+
+def _fail():
+    raise OSError("down")
+
+
+def _never(result):
+    return False
+
+
+def test_breaker_opens_after_threshold():
+    cb = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+
+    for _ in range(2):
+        with pytest.raises(OSError):
+            cb.call("e", _fail, _never)
+    assert cb.state("e") == "open"
+
+    fn = pretend.call_recorder(lambda: "ok")
+    with pytest.raises(AmbientCredentialError, match="circuit open after 2 consecutive failures"):
+        cb.call("e", fn, _never)
+    assert fn.calls == []
+    assert cb.states() == {"e": "open"}
+
+
+def test_breaker_success_resets_failures():
+    cb = CircuitBreaker(failure_threshold=2)
+
+    with pytest.raises(OSError):
+        cb.call("e", _fail, _never)
+    assert cb.call("e", lambda: "ok", _never) == "ok"
+    with pytest.raises(OSError):
+        cb.call("e", _fail, _never)
+    assert cb.state("e") == "closed"
+
+
+def test_breaker_failed_results_count():
+    cb = CircuitBreaker(failure_threshold=1)
+
+    assert cb.call("e", lambda: 503, lambda status: status >= 500) == 503
+    assert cb.state("e") == "open"
+
+
+def test_breaker_half_open_probe(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(breaker.time, "monotonic", lambda: now[0])
+    cb = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+
+    with pytest.raises(OSError):
+        cb.call("e", _fail, _never)
+    now[0] += 31
+
+    # A failed probe re-opens the circuit for another `reset_timeout`.
+    with pytest.raises(OSError):
+        cb.call("e", _fail, _never)
+    assert cb.state("e") == "open"
+    with pytest.raises(AmbientCredentialError):
+        cb.call("e", lambda: "ok", _never)
+
+    now[0] += 31
+
+    # Only one probe is let through at a time.
+    def probe():
+        assert cb.state("e") == "half-open"
+        with pytest.raises(AmbientCredentialError, match="probe is in flight"):
+            cb.call("e", lambda: "ok", _never)
+        return "ok"
+
+    assert cb.call("e", probe, _never) == "ok"
+    assert cb.state("e") == "closed"
+
+
+def test_breaker_interrupt_not_a_failure(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(breaker.time, "monotonic", lambda: now[0])
+    cb = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+
+    with pytest.raises(KeyboardInterrupt):
+        cb.call("e", pretend.raiser(KeyboardInterrupt), _never)
+    assert cb.state("e") == "closed"
+
+    with pytest.raises(OSError):
+        cb.call("e", _fail, _never)
+    now[0] += 31
+
+    # An interrupted probe isn't left in flight: the next call probes again.
+    with pytest.raises(KeyboardInterrupt):
+        cb.call("e", pretend.raiser(KeyboardInterrupt), _never)
+    assert cb.state("e") == "open"
+    assert cb.call("e", lambda: "ok", _never) == "ok"
+    assert cb.state("e") == "closed"
+
+
+def test_breaker_invalid_threshold():
+    with pytest.raises(ValueError, match="failure_threshold"):
+        CircuitBreaker(failure_threshold=0)
+
+
+def test_detect_github_fails_fast(monkeypatch):
+    monkeypatch.setenv("GITHUB_ACTIONS", "true")
+    monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_TOKEN", "faketoken")
+    monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_URL", "https://fakeurl/token?api-version=1")
+
+    request = pretend.call_recorder(
+        lambda *a, **kw: urllib3.HTTPResponse(
+            body=io.BytesIO(b"unavailable"), status=503, preload_content=False
+        )
+    )
+    monkeypatch.setattr(ambient.urllib3, "request", request)
+
+    cb = CircuitBreaker(failure_threshold=3)
+    id.configure(circuit_breaker=cb)
+
+    for _ in range(3):
+        with pytest.raises(AmbientCredentialError, match="code=503"):
+            ambient.detect_github("some-audience")
+
+    with pytest.raises(AmbientCredentialError, match="https://fakeurl/token: circuit open"):
+        ambient.detect_github("some-audience")
+    assert len(request.calls) == 3
+    assert cb.states() == {"https://fakeurl/token": "open"}
@@ -0,0 +1,185 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import json
+
+import pretend
+import pytest
+import urllib3
+
+import id
+from id._internal.oidc import ambient, cassette
+
+
+def _response(status, data=b""):
+    return urllib3.HTTPResponse(body=io.BytesIO(data), status=status, preload_content=False)
+
+
+def _offline(monkeypatch):
+    # Anything that reaches for the environment while replaying fails.
+    for var in ("GITHUB_ACTIONS", "ACTIONS_ID_TOKEN_REQUEST_TOKEN", "ACTIONS_ID_TOKEN_REQUEST_URL"):
+        monkeypatch.delenv(var, raising=False)
+    monkeypatch.setattr(ambient.urllib3, "request", pretend.raiser(AssertionError("online")))
+    monkeypatch.setattr(ambient, "_open", pretend.raiser(AssertionError("online")))
+    monkeypatch.setattr(ambient, "shutil", pretend.stub(which=pretend.raiser(AssertionError)))
+    monkeypatch.setattr(ambient.subprocess, "run", pretend.raiser(AssertionError("online")))
+
+
+def test_record_replay_github(monkeypatch, tmp_path, github):
+    path = tmp_path / "github.json"
+    request = pretend.call_recorder(
+        lambda method, url, **kw: _response(200, json.dumps({"value": "fakejwt"}).encode())
+    )
+    monkeypatch.setattr(ambient.urllib3, "request", request)
+
+    with id.record(path):
+        assert ambient.detect_github("aud") == "fakejwt"
+    assert len(request.calls) == 1
+
+    saved = json.loads(path.read_text())
+    assert saved["environ"] == {
+        "GITHUB_ACTIONS": "true",
+        "ACTIONS_ID_TOKEN_REQUEST_TOKEN": "faketoken",
+        "ACTIONS_ID_TOKEN_REQUEST_URL": "https://fakeurl/token",
+    }
+    (interaction,) = saved["interactions"]
+    assert interaction["request"] == "GET https://fakeurl/token?audience=aud"
+    # Request headers, which carry credentials, aren't recorded.
+    assert "faketoken" not in json.dumps(interaction)
+
+    _offline(monkeypatch)
+    with id.replay(path):
+        assert ambient.detect_github("aud") == "fakejwt"
+        assert ambient.detect_github("aud") == "fakejwt"
+    assert ambient.detect_github("aud") is None
+
+
+def test_record_replay_subprocess(monkeypatch, tmp_path):
+    monkeypatch.setenv("BUILDKITE", "true")
+    monkeypatch.setattr(ambient.shutil, "which", lambda bin: "/usr/bin/buildkite-agent")
+    process = pretend.stub(args=["buildkite-agent"], returncode=0, stdout="fakejwt\n", stderr="")
+    monkeypatch.setattr(ambient.subprocess, "run", lambda cmd, **kw: process)
+
+    path = tmp_path / "buildkite.json"
+    with id.record(path):
+        assert ambient.detect_buildkite("aud") == "fakejwt"
+
+    kinds = [(i["kind"], i["request"]) for i in json.loads(path.read_text())["interactions"]]
+    assert kinds == [
+        ("which", "buildkite-agent"),
+        ("subprocess", "buildkite-agent oidc request-token --audience aud"),
+    ]
+
+    monkeypatch.delenv("BUILDKITE")
+    _offline(monkeypatch)
+    with id.replay(path):
+        assert ambient.detect_buildkite("aud") == "fakejwt"
+
+
+def test_record_replay_errors(monkeypatch, tmp_path, github):
+    monkeypatch.setattr(ambient, "_open", pretend.raiser(FileNotFoundError(2, "No such file")))
+    monkeypatch.setattr(
+        ambient.urllib3,
+        "request",
+        pretend.raiser(urllib3.exceptions.MaxRetryError(None, "https://fakeurl/token")),
+    )
+
+    path = tmp_path / "errors.json"
+    with id.record(path):
+        assert ambient.detect_gcp("aud") is None
+        with pytest.raises(id.AmbientCredentialError, match="request timed out"):
+            ambient.detect_github("aud")
+
+    _offline(monkeypatch)
+    with id.replay(path):
+        assert ambient.detect_gcp("aud") is None
+        with pytest.raises(id.AmbientCredentialError, match="request timed out"):
+            ambient.detect_github("aud")
+
+
+def test_replay_in_order_then_repeats(tmp_path):
+    path = tmp_path / "files.json"
+    texts = iter(["one", "two"])
+    with id.record(path) as recording:
+        for _ in range(2):
+            recording.interact("file", "/token", lambda: next(texts))
+
+    with id.replay(path) as replaying:
+        read = [replaying.interact("file", "/token", pretend.raiser(AssertionError)) for _ in "123"]
+    assert read == ["one", "two", "two"]
+
+
+def test_replay_binary_body(tmp_path):
+    path = tmp_path / "binary.json"
+    resp = ambient.BufferedResponse(200, urllib3.HTTPHeaderDict({"X": "y"}), b"\xff\x00ok")
+    with id.record(path) as recording:
+        recording.interact("http", "GET https://example.com", lambda: resp)
+
+    with id.replay(path) as replaying:
+        replayed = replaying.interact(
+            "http", "GET https://example.com", pretend.raiser(AssertionError)
+        )
+    assert (replayed.status, replayed.headers["X"], replayed.data) == (200, "y", b"\xff\x00ok")
+
+
+def test_replay_latency(monkeypatch, tmp_path):
+    path = tmp_path / "slow.json"
+    interaction = {"kind": "which", "request": "circleci", "path": None, "seconds": 0.5}
+    path.write_text(json.dumps({"version": 1, "environ": {}, "interactions": [interaction]}))
+    sleep = pretend.call_recorder(lambda seconds: None)
+    monkeypatch.setattr(cassette.time, "sleep", sleep)
+
+    with id.replay(path) as replaying:
+        assert replaying.interact("which", "circleci", pretend.raiser(AssertionError)) is None
+    with id.replay(path, latency=2.0) as replaying:
+        assert replaying.interact("which", "circleci", pretend.raiser(AssertionError)) is None
+    assert sleep.calls == [pretend.call(1.0)]
+
+
+def test_replay_unrecorded(tmp_path):
+    path = tmp_path / "empty.json"
+    with id.record(path):
+        pass
+
+    with id.replay(path) as replaying:
+        with pytest.raises(id.IdentityError, match="no which interaction 'circleci'"):
+            replaying.interact("which", "circleci", pretend.raiser(AssertionError))
+
+
+@pytest.mark.parametrize("contents", ["", "{}", '{"version": 2}', '{"version": 1}'])
+def test_replay_unreadable(tmp_path, contents):
+    path = tmp_path / "bad.json"
+    path.write_text(contents)
+    with pytest.raises(id.IdentityError, match="can't replay"):
+        with id.replay(path):
+            pass
+
+
+def test_replay_explicit_env(monkeypatch, tmp_path):
+    path = tmp_path / "gitlab.json"
+    path.write_text(
+        json.dumps(
+            {
+                "version": 1,
+                "environ": {"GITLAB_CI": "true", "AUD_ID_TOKEN": "recorded"},
+                "interactions": [],
+            }
+        )
+    )
+
+    with id.replay(path):
+        assert ambient.detect_gitlab("aud") == "recorded"
+        env = {"GITLAB_CI": "true", "AUD_ID_TOKEN": "explicit"}
+        assert ambient.detect_gitlab("aud", env=env) == "explicit"
@@ -0,0 +1,149 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import io
+import json
+import subprocess
+import time
+
+import pretend
+import pytest
+import urllib3
+
+from id._internal.oidc import ambient, doctor
+
+
+@pytest.fixture(autouse=True)
+def clean_env(monkeypatch):
+    for var in (
+        "GITHUB_ACTIONS",
+        "GOOGLE_SERVICE_ACCOUNT_NAME",
+        "BUILDKITE",
+        "GITLAB_CI",
+        "CIRCLECI",
+        "SOME_AUDIENCE_ID_TOKEN_FILE",
+    ):
+        monkeypatch.delenv(var, False)
+    monkeypatch.setattr(ambient, "_open", pretend.raiser(FileNotFoundError))
+    monkeypatch.setattr(doctor.shutil, "which", lambda cmd: None)
+
+
+def _token(exp):
+    payload = json.dumps({"iss": "https://gitlab.com", "aud": "some-audience", "exp": exp})
+    return f"e30.{base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')}.sig"
+
+
+def _provider(report, name):
+    (provider,) = [p for p in report["providers"] if p["provider"] == name]
+    return provider
+
+
+def test_diagnose_nothing_detected():
+    report = doctor.diagnose("some-audience")
+
+    assert report["selected"] is None
+    assert [p["outcome"] for p in report["providers"]] == ["not detected"] * 6
+    assert not any(check["matched"] for p in report["providers"] for check in p["checks"])
+    assert "selected: none" in doctor.format_report(report)
+
+
+def test_diagnose_gitlab_token(monkeypatch):
+    monkeypatch.setenv("GITLAB_CI", "true")
+    monkeypatch.setenv("SOME_AUDIENCE_ID_TOKEN", _token(time.time() + 300))
+
+    report = doctor.diagnose("some-audience")
+    gitlab = _provider(report, "GitLab")
+
+    assert report["selected"] == "GitLab"
+    assert gitlab["outcome"] == "token"
+    assert gitlab["token"]["iss"] == "https://gitlab.com"
+    assert 290 < gitlab["token"]["expires_in"] <= 300
+    assert "GitLab: token" in doctor.format_report(report)
+
+
+def test_diagnose_github_error_and_calls(monkeypatch):
+    monkeypatch.setenv("GITHUB_ACTIONS", "true")
+    monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_TOKEN", "faketoken")
+    monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_URL", "https://example.com/token?secret=1")
+
+    probe = pretend.call_recorder(lambda url: {"host": "example.com", "port": 443})
+    monkeypatch.setattr(doctor, "_probe", probe)
+    resp = urllib3.HTTPResponse(body=io.BytesIO(b"oops"), status=500, preload_content=False)
+    monkeypatch.setattr(ambient.urllib3, "request", lambda meth, url, **kw: resp)
+
+    report = doctor.diagnose("some-audience")
+    github = _provider(report, "GitHub")
+
+    assert report["selected"] is None
+    assert github["outcome"] == "error"
+    assert "OIDC token request failed" in github["error"]
+    assert probe.calls == [pretend.call("https://example.com/token?secret=1")]
+
+    (call,) = github["calls"]
+    assert call["url"] == "https://example.com/token"
+    assert call["status"] == 500
+    assert call["seconds"] >= 0
+
+    text = doctor.format_report(report)
+    assert "http https://example.com/token: 500" in text
+    assert "secret" not in text
+
+
+def test_diagnose_buildkite_spawn(monkeypatch):
+    monkeypatch.setenv("BUILDKITE", "true")
+    monkeypatch.setattr(doctor.shutil, "which", lambda cmd: f"/usr/bin/{cmd}")
+    monkeypatch.setattr(ambient.shutil, "which", lambda cmd: f"/usr/bin/{cmd}")
+    popen = pretend.call_recorder(lambda argv, **kw: pretend.stub(wait=lambda timeout: 0))
+    monkeypatch.setattr(doctor.subprocess, "Popen", popen)
+    process = pretend.stub(returncode=1, stdout="no agent")
+    monkeypatch.setattr(ambient.subprocess, "run", lambda cmd, **kw: process)
+
+    buildkite = _provider(doctor.diagnose("some-audience"), "Buildkite")
+
+    assert buildkite["spawn"]["returncode"] == 0
+    assert popen.calls[0].args == (["buildkite-agent", "--version"],)
+    (call,) = buildkite["calls"]
+    assert call == {
+        "kind": "subprocess",
+        "command": "buildkite-agent",
+        "returncode": 1,
+        "seconds": call["seconds"],
+    }
+
+
+def test_spawn_timeout_kills_process(monkeypatch):
+    calls = []
+
+    def wait(timeout=None):
+        calls.append(("wait", timeout))
+        if timeout is not None:
+            raise subprocess.TimeoutExpired("buildkite-agent", timeout)
+        return -9
+
+    process = pretend.stub(wait=wait, kill=lambda: calls.append(("kill",)))
+    monkeypatch.setattr(doctor.subprocess, "Popen", lambda argv, **kw: process)
+
+    spawn = doctor._spawn(["buildkite-agent", "--version"])
+
+    assert "timed out" in spawn["error"]
+    assert calls == [("wait", doctor._PROBE_TIMEOUT), ("kill",), ("wait", None)]
+
+
+def test_trace_inactive_outside_doctor(monkeypatch):
+    resp = urllib3.HTTPResponse(body=io.BytesIO(b"ok"), status=200, preload_content=False)
+    monkeypatch.setattr(ambient.urllib3, "request", lambda meth, url, **kw: resp)
+
+    assert ambient._request("GET", "https://example.com").data == b"ok"
+    assert ambient._trace.get() is None
@@ -0,0 +1,276 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pretend
+import pytest
+import urllib3
+
+import id
+from id._internal.oidc import ambient
+from id._internal.oidc.hedging import HedgingPolicy
+
+
+@pytest.fixture(autouse=True)
+def no_hedging():
+    yield
+    id.configure(hedging=None)
+
+
+def test_hedging_delay_from_percentile():
+    policy = HedgingPolicy(percentile=0.5, initial_delay=1.0, min_delay=0.0, min_samples=3)
+    assert policy.delay("e") == 1.0
+
+    for latency in (0.1, 0.2, 0.3, 0.4):
+        policy._endpoint("e").latencies.append(latency)
+    assert policy.delay("e") == 0.3
+
+    policy.max_delay = 0.25
+    assert policy.delay("e") == 0.25
+
+
+def test_hedging_fast_request_not_hedged():
+    policy = HedgingPolicy(initial_delay=1.0)
+    calls = []
+
+    def fn():
+        calls.append(1)
+        return "ok"
+
+    assert policy.run("e", fn) == "ok"
+    assert calls == [1]
+    assert policy.stats()["e"]["requests"] == 1
+    assert policy.stats()["e"]["hedged"] == 0
+
+
+def test_hedging_slow_request_hedged():
+    policy = HedgingPolicy(initial_delay=0.01)
+    release = threading.Event()
+    attempts = []
+
+    def fn():
+        attempts.append(1)
+        if len(attempts) == 1:
+            # The first attempt hangs until the test is over.
+            release.wait(5)
+            return "slow"
+        return "fast"
+
+    try:
+        assert policy.run("e", fn) == "fast"
+    finally:
+        release.set()
+
+    stats = policy.stats()["e"]
+    assert stats == {"requests": 1, "hedged": 1, "hedge_wins": 1, "delay": 0.01}
+
+
+def test_hedging_falls_back_to_other_attempt_on_error():
+    policy = HedgingPolicy(initial_delay=0.01)
+    attempts = []
+
+    def fn():
+        attempts.append(1)
+        if len(attempts) == 1:
+            time.sleep(0.05)
+            return "primary"
+        raise OSError("hedge failed")
+
+    assert policy.run("e", fn) == "primary"
+    assert policy.stats()["e"]["hedge_wins"] == 0
+
+
+def test_hedging_both_fail():
+    policy = HedgingPolicy(initial_delay=0.01)
+
+    def fn():
+        time.sleep(0.02)
+        raise OSError("down")
+
+    with pytest.raises(OSError, match="down"):
+        policy.run("e", fn)
+
+
+def test_hedging_concurrent_callers_dont_queue():
+    policy = HedgingPolicy(initial_delay=1.0)
+
+    def fn():
+        time.sleep(0.2)
+        return "ok"
+
+    def timed_run():
+        start = time.perf_counter()
+        assert policy.run("e", fn) == "ok"
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(40) as pool:
+        latencies = list(pool.map(lambda _: timed_run(), range(40)))
+
+    # Every caller's attempt starts at once, rather than queueing for a worker.
+    assert max(latencies) < 0.6
+    assert policy.stats()["e"]["hedged"] == 0
+    assert all(latency < 0.6 for latency in policy._endpoint("e").latencies)
+
+
+def test_hedging_limited_hedges_in_flight():
+    policy = HedgingPolicy(initial_delay=0.01, max_hedges=1)
+    release = threading.Event()
+
+    def fn():
+        release.wait(5)
+        return "ok"
+
+    with ThreadPoolExecutor(3) as pool:
+        futures = [pool.submit(policy.run, "e", fn) for _ in range(3)]
+        time.sleep(0.1)
+        release.set()
+        assert [future.result() for future in futures] == ["ok"] * 3
+
+    assert policy.stats()["e"]["hedged"] == 1
+
+
+def test_hedging_reuses_threads():
+    policy = HedgingPolicy()
+    threads = set()
+
+    def fn():
+        threads.add(threading.get_ident())
+        return "ok"
+
+    for _ in range(20):
+        assert policy.run("e", fn) == "ok"
+    assert len(threads) == 1
+    assert threading.get_ident() not in threads
+
+
+def test_hedging_busy_workers_run_on_caller():
+    policy = HedgingPolicy(initial_delay=0.01, max_workers=1)
+    started, release = threading.Event(), threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return "slow"
+
+    with ThreadPoolExecutor(1) as pool:
+        first = pool.submit(policy.run, "e", slow)
+        assert started.wait(5)
+        # The only worker is busy, so this runs on the caller's thread...
+        assert policy.run("e", threading.get_ident) == threading.get_ident()
+        release.set()
+        assert first.result() == "slow"
+
+    # ...and the first request found no worker for its hedge either.
+    assert policy.stats()["e"]["hedged"] == 0
+
+
+def test_hedging_invalid_percentile():
+    with pytest.raises(ValueError, match="percentile"):
+        HedgingPolicy(percentile=1.5)
+
+
+def test_detect_github_hedged(monkeypatch):
+    monkeypatch.setenv("GITHUB_ACTIONS", "true")
+    monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_TOKEN", "faketoken")
+    monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_URL", "https://fakeurl/token?api-version=1")
+
+    resp = urllib3.HTTPResponse(
+        body=io.BytesIO(b'{"value": "fakejwt"}'), status=200, preload_content=False
+    )
+    monkeypatch.setattr(ambient.urllib3, "request", pretend.call_recorder(lambda *a, **kw: resp))
+
+    policy = HedgingPolicy()
+    id.configure(hedging=policy)
+    assert ambient.detect_github("some-audience") == "fakejwt"
+
+    assert list(policy.stats()) == ["https://fakeurl/token"]
+    assert ambient.urllib3.request.calls == [
+        pretend.call(
+            "GET",
+            "https://fakeurl/token?api-version=1&audience=some-audience",
+            fields=None,
+            headers={"Authorization": "bearer faketoken"},
+            timeout=30,
+            preload_content=False,
+        )
+    ]
+
+
+def test_configure_leaves_unset_options():
+    policy = HedgingPolicy()
+    id.configure(hedging=policy)
+    id.configure()
+    assert id._default_session._config.hedging is policy
+
+    id.configure(hedging=None)
+    assert id._default_session._config.hedging is None
+
+
+def test_hedging_loser_abandoned(monkeypatch):
+    monkeypatch.setenv("GITHUB_ACTIONS", "true")
+    monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_TOKEN", "faketoken")
+    monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_URL", "https://fakeurl/token")
+
+    release, abandoned = threading.Event(), threading.Event()
+    slow = pretend.stub(
+        status=200,
+        headers=urllib3.HTTPHeaderDict(),
+        stream=pretend.raiser(AssertionError("the loser's body was read")),
+        close=pretend.call_recorder(lambda: None),
+        release_conn=lambda: abandoned.set(),
+    )
+    attempts = []
+
+    def request(*args, **kwargs):
+        attempts.append(1)
+        if len(attempts) == 1:
+            release.wait(5)
+            return slow
+        return urllib3.HTTPResponse(
+            body=io.BytesIO(b'{"value": "fakejwt"}'), status=200, preload_content=False
+        )
+
+    monkeypatch.setattr(ambient.urllib3, "request", request)
+    policy = HedgingPolicy(initial_delay=0.01)
+    id.configure(hedging=policy)
+    assert ambient.detect_github("aud") == "fakejwt"
+    assert policy.stats()["https://fakeurl/token"]["hedge_wins"] == 1
+
+    # Once the losing request answers, its connection is closed unread.
+    release.set()
+    assert abandoned.wait(5)
+    assert slow.close.calls == [pretend.call()]
+
+
+def test_hedging_off_with_cassette(monkeypatch, tmp_path):
+    monkeypatch.setenv("GITHUB_ACTIONS", "true")
+    monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_TOKEN", "faketoken")
+    monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_URL", "https://fakeurl/token")
+    monkeypatch.setattr(
+        ambient.urllib3,
+        "request",
+        lambda *a, **kw: urllib3.HTTPResponse(
+            body=io.BytesIO(b'{"value": "fakejwt"}'), status=200, preload_content=False
+        ),
+    )
+
+    policy = HedgingPolicy()
+    id.configure(hedging=policy)
+    with id.record(tmp_path / "cassette.json"):
+        assert ambient.detect_github("aud") == "fakejwt"
+    assert policy.stats() == {}
@@ -0,0 +1,366 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import ipaddress
+import ssl
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import _issuer
+import pretend
+import pytest
+import urllib3
+
+from id import AmbientCredentialError, Session
+from id._internal.oidc import ambient, http2
+from id._internal.oidc.config import Config
+
+
+def test_http2_disabled(monkeypatch):
+    monkeypatch.delenv("ID_HTTP2", False)
+    assert not http2.enabled()
+    assert Session()._config.http2 is None
+
+
+def test_http2_without_h2(monkeypatch):
+    monkeypatch.setenv("ID_HTTP2", "1")
+    monkeypatch.setattr(http2.importlib.util, "find_spec", lambda name: None)
+    assert not http2.enabled()
+
+
+def test_http2_transport_per_session(monkeypatch):
+    monkeypatch.setenv("ID_HTTP2", "1")
+    monkeypatch.setattr(http2.importlib.util, "find_spec", lambda name: object())
+
+    first, second = Session(), Session()
+    transport = first._config.http2
+    assert isinstance(transport, http2.Http2Transport)
+    assert transport is not second._config.http2
+    # Requests that fall back to HTTP/1.1 use the session's own pool.
+    assert transport._pool is first._config.pool
+
+    # Reconfiguring the session keeps its transport, and closing closes it.
+    first.configure(hedging=None)
+    assert first._config.http2 is transport
+    close = pretend.call_recorder(lambda: None)
+    monkeypatch.setattr(transport, "close", close)
+    first.close()
+    assert close.calls == [pretend.call()]
+
+
+def test_request_uses_http2_transport(monkeypatch):
+    resp = http2.BufferedResponse(200, urllib3.HTTPHeaderDict(), b"")
+    transport = pretend.stub(request=pretend.call_recorder(lambda meth, url, **kw: resp))
+    monkeypatch.setattr(ambient, "_current_config", lambda: Config(http2=transport))
+
+    assert ambient._request("GET", "https://example.com/?a=b", fields={"c": "d"}) is resp
+    assert transport.request.calls == [
+        pretend.call("GET", "https://example.com/?a=b&c=d", fields=None, preload_content=False)
+    ]
+
+
+def test_fallback_uses_pool():
+    pool = pretend.stub(request=pretend.call_recorder(lambda meth, url, **kw: "resp"))
+
+    transport = http2.Http2Transport(pool=pool)
+    assert transport.request("GET", "http://metadata/foo") == "resp"
+    assert pool.request.calls == [
+        pretend.call(
+            "GET",
+            "http://metadata/foo",
+            fields=None,
+            headers=None,
+            json=None,
+            timeout=30,
+            preload_content=True,
+        )
+    ]
+
+
+def test_plain_http_falls_back(monkeypatch):
+    request = pretend.call_recorder(lambda meth, url, **kw: "resp")
+    monkeypatch.setattr(http2.urllib3, "request", request)
+
+    transport = http2.Http2Transport()
+    assert transport.request("GET", "http://metadata/foo", headers={"a": "b"}) == "resp"
+    assert request.calls == [
+        pretend.call(
+            "GET",
+            "http://metadata/foo",
+            fields=None,
+            headers={"a": "b"},
+            json=None,
+            timeout=30,
+            preload_content=True,
+        )
+    ]
+
+
+def test_no_alpn_h2_falls_back(monkeypatch):
+    request = pretend.call_recorder(lambda meth, url, **kw: "resp")
+    monkeypatch.setattr(http2.urllib3, "request", request)
+    connection = pretend.call_recorder(pretend.raiser(http2._NotHttp2("example.com")))
+    monkeypatch.setattr(http2, "_Connection", connection)
+
+    transport = http2.Http2Transport()
+    assert transport.request("GET", "https://example.com/") == "resp"
+    assert transport.request("GET", "https://example.com/") == "resp"
+
+    # The host is remembered as HTTP/1.1-only, and not probed again.
+    assert len(connection.calls) == 1
+    assert len(request.calls) == 2
+
+
+def test_connection_error_is_max_retry(monkeypatch):
+    monkeypatch.setattr(http2, "_Connection", pretend.raiser(ConnectionRefusedError()))
+
+    transport = http2.Http2Transport()
+    with pytest.raises(urllib3.exceptions.MaxRetryError):
+        transport.request("GET", "https://example.com/")
+
+
+def test_http2_response_json():
+    resp = http2.BufferedResponse(200, urllib3.HTTPHeaderDict(), b'{"value": "fakejwt"}')
+    assert resp.json() == {"value": "fakejwt"}
+
+
+def test_connect_doesnt_block_other_hosts(monkeypatch):
+    slow_connecting, release = threading.Event(), threading.Event()
+    connections = []
+
+    def connection(host, port, ssl_context, timeout):
+        if host == "slow.example.com":
+            slow_connecting.set()
+            release.wait(5)
+        conn = pretend.stub(
+            host=host,
+            closed=False,
+            request=lambda *args: http2.BufferedResponse(200, urllib3.HTTPHeaderDict(), b""),
+        )
+        connections.append(host)
+        return conn
+
+    monkeypatch.setattr(http2, "_Connection", connection)
+    transport = http2.Http2Transport()
+
+    with ThreadPoolExecutor(4) as pool:
+        slow = [
+            pool.submit(transport.request, "GET", "https://slow.example.com/") for _ in range(2)
+        ]
+        assert slow_connecting.wait(5)
+        # Another host connects while the first is still connecting...
+        assert transport.request("GET", "https://fast.example.com/").status == 200
+        release.set()
+        assert [future.result().status for future in slow] == [200, 200]
+
+    # ...and concurrent first requests to one host share a single connection.
+    assert connections == ["fast.example.com", "slow.example.com"]
+
+
+@pytest.fixture(scope="module")
+def certificate(tmp_path_factory):
+    pytest.importorskip("h2")
+    pytest.importorskip("cryptography")
+
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=5))
+        .not_valid_after(now + datetime.timedelta(hours=1))
+        .add_extension(
+            x509.SubjectAlternativeName(
+                [x509.DNSName("localhost"), x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]
+            ),
+            critical=False,
+        )
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+
+    directory = tmp_path_factory.mktemp("h2")
+    cert_path, key_path = directory / "cert.pem", directory / "key.pem"
+    cert_path.write_bytes(cert.public_bytes(serialization.Encoding.PEM))
+    key_path.write_bytes(
+        key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        )
+    )
+    return str(cert_path), str(key_path)
+
+
+@pytest.fixture
+def serve(certificate):
+    servers = []
+
+    def serve(handler, **kwargs):
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(*certificate)
+        server = _issuer.H2Server(handler, context, **kwargs)
+        servers.append(server)
+        return server
+
+    yield serve
+    for server in servers:
+        server.close()
+
+
+@pytest.fixture
+def transport(certificate):
+    transport = http2.Http2Transport(ssl.create_default_context(cafile=certificate[0]))
+    yield transport
+    transport.close()
+
+
+def _wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def _echo(reply, path):
+    reply.send(f'{{"path": "{path}"}}'.encode())
+
+
+def test_h2_requests_multiplexed(serve, transport):
+    release = threading.Event()
+
+    def handler(reply, path):
+        # Answer the first request last, so responses arrive out of order.
+        if path == "/0":
+            release.wait(5)
+        _echo(reply, path)
+        if path != "/0" and len(server.paths) == 8:
+            release.set()
+
+    server = serve(handler)
+    with ThreadPoolExecutor(8) as pool:
+        responses = list(
+            pool.map(lambda i: transport.request("GET", f"{server.url}/{i}"), range(8))
+        )
+
+    assert [resp.json() for resp in responses] == [{"path": f"/{i}"} for i in range(8)]
+    assert all(resp.status == 200 for resp in responses)
+    assert responses[0].headers["content-type"] == "application/json"
+    assert len(server.connections) == 1
+    assert server.max_in_flight > 1
+
+
+def test_h2_waits_for_free_stream(serve, transport):
+    def handler(reply, path):
+        time.sleep(0.05)
+        _echo(reply, path)
+
+    server = serve(handler, max_concurrent_streams=2)
+    # The first request's round trip delivers the server's settings.
+    assert transport.request("GET", f"{server.url}/warmup").status == 200
+
+    with ThreadPoolExecutor(6) as pool:
+        responses = list(
+            pool.map(lambda i: transport.request("GET", f"{server.url}/{i}"), range(6))
+        )
+
+    assert [resp.json() for resp in responses] == [{"path": f"/{i}"} for i in range(6)]
+    assert server.max_in_flight == 2
+    assert len(server.connections) == 1
+
+
+def test_h2_stream_reset(serve, transport):
+    server = serve(lambda reply, path: reply.reset() if path == "/reset" else _echo(reply, path))
+
+    with pytest.raises(urllib3.exceptions.MaxRetryError, match="stream reset"):
+        transport.request("GET", f"{server.url}/reset")
+
+    # Only the reset stream fails; the connection stays up.
+    assert transport.request("GET", f"{server.url}/ok").json() == {"path": "/ok"}
+    assert len(server.connections) == 1
+
+
+@pytest.mark.parametrize("end_stream", [True, False])
+def test_h2_oversized_response_reset(monkeypatch, serve, transport, end_stream):
+    monkeypatch.setattr(http2, "MAX_RESPONSE_SIZE", 100)
+
+    def handler(reply, path):
+        if path == "/big":
+            reply.send(b"x" * 1000, end_stream=end_stream)
+        else:
+            _echo(reply, path)
+
+    server = serve(handler)
+    with pytest.raises(AmbientCredentialError, match="exceeds 100 bytes"):
+        transport.request("GET", f"{server.url}/big")
+    if not end_stream:
+        # A response still streaming in is cut off with RST_STREAM.
+        _wait_for(lambda: server.resets)
+
+    assert transport.request("GET", f"{server.url}/ok").json() == {"path": "/ok"}
+    assert len(server.connections) == 1
+
+
+def test_h2_connection_terminated(serve, transport):
+    def handler(reply, path):
+        if path != "/hang":
+            _echo(reply, path)
+
+    server = serve(handler)
+    with ThreadPoolExecutor(3) as pool:
+        hung = [pool.submit(transport.request, "GET", f"{server.url}/hang") for _ in range(3)]
+        _wait_for(lambda: server.in_flight == 3)
+        server.connections[0].terminate()
+
+        # Every request in flight on the connection fails...
+        for future in hung:
+            with pytest.raises(urllib3.exceptions.MaxRetryError, match="terminated"):
+                future.result(5)
+
+    # ...and the next request opens a new one.
+    assert transport.request("GET", f"{server.url}/ok").json() == {"path": "/ok"}
+    assert len(server.connections) == 2
+
+
+def test_h2_close_stops_readers(serve, transport):
+    def handler(reply, path):
+        if path != "/hang":
+            _echo(reply, path)
+
+    servers = [serve(handler), serve(handler)]
+    for server in servers:
+        assert transport.request("GET", f"{server.url}/ok").status == 200
+    readers = [t for t in threading.enumerate() if t.name.startswith("id-h2-")]
+    assert len(readers) == 2
+
+    with ThreadPoolExecutor(1) as pool:
+        hung = pool.submit(transport.request, "GET", f"{servers[0].url}/hang")
+        _wait_for(lambda: servers[0].in_flight == 1)
+        transport.close()
+
+        # The request in flight fails, and every reader thread has exited.
+        with pytest.raises(urllib3.exceptions.MaxRetryError):
+            hung.result(5)
+    assert not any(reader.is_alive() for reader in readers)
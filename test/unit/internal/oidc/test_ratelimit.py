@@ -0,0 +1,155 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import email.utils
+import io
+import sys
+
+import pretend
+import pytest
+import urllib3
+
+import id
+from id._internal.oidc import ambient, ratelimit
+from id._internal.oidc.ratelimit import RateLimiter
+
+
+@pytest.fixture(autouse=True)
+def clock(monkeypatch):
+    now = [1_000_000.0]
+
+    def sleep(seconds):
+        now[0] += seconds
+
+    monkeypatch.setattr(ratelimit.time, "time", lambda: now[0])
+    monkeypatch.setattr(ratelimit.time, "sleep", sleep)
+    yield now
+    id.configure(rate_limits=None)
+
+
+def _resp(status, **headers):
+    return pretend.stub(status=status, headers=urllib3.HTTPHeaderDict(headers))
+
+
+def test_rate_limiter_burst_then_queue():
+    limiter = RateLimiter(10, burst=2)
+
+    waits = [limiter.acquire("e") for _ in range(4)]
+    assert waits == [0.0, 0.0, pytest.approx(0.1), pytest.approx(0.1)]
+
+    # Buckets are per endpoint.
+    assert limiter.acquire("other") == 0.0
+
+
+def test_rate_limiter_refills(clock):
+    limiter = RateLimiter(10, burst=2)
+
+    limiter.acquire("e")
+    limiter.acquire("e")
+    clock[0] += 1
+    assert limiter.acquire("e") == 0.0
+    assert limiter.acquire("e") == 0.0
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="no cross-process buckets on Windows")
+def test_rate_limiter_shared_dir(tmp_path):
+    # Separate limiters on the same directory stand in for separate processes.
+    a = RateLimiter(1, shared_dir=tmp_path)
+    b = RateLimiter(1, shared_dir=tmp_path)
+
+    assert a.acquire("e") == 0.0
+    assert b.acquire("e") == pytest.approx(1.0)
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+def test_rate_limiter_honors_retry_after(clock):
+    limiter = RateLimiter(100)
+    responses = iter([_resp(429, **{"Retry-After": "5"}), _resp(200)])
+    start = clock[0]
+
+    assert limiter.call("e", lambda: next(responses)).status == 200
+    assert clock[0] - start == pytest.approx(5.0)
+
+
+def test_rate_limiter_retry_after_http_date(clock):
+    limiter = RateLimiter(100)
+    date = email.utils.formatdate(clock[0] + 3, usegmt=True)
+    responses = iter([_resp(503, **{"Retry-After": date}), _resp(200)])
+    start = clock[0]
+
+    assert limiter.call("e", lambda: next(responses)).status == 200
+    assert clock[0] - start == pytest.approx(3.0)
+
+
+def test_rate_limiter_gives_up_on_long_retry_after():
+    limiter = RateLimiter(100, max_retry_after=10)
+    send = pretend.call_recorder(lambda: _resp(429, **{"Retry-After": "3600"}))
+
+    assert limiter.call("e", send).status == 429
+    assert len(send.calls) == 1
+
+
+def test_rate_limiter_retries_bounded():
+    limiter = RateLimiter(100, retries=2)
+    send = pretend.call_recorder(lambda: _resp(429, **{"Retry-After": "1"}))
+
+    assert limiter.call("e", send).status == 429
+    assert len(send.calls) == 3
+
+
+def test_rate_limiter_no_retry_after():
+    limiter = RateLimiter(100)
+    send = pretend.call_recorder(lambda: _resp(429))
+
+    assert limiter.call("e", send).status == 429
+    assert len(send.calls) == 1
+
+
+@pytest.mark.parametrize(("rate", "burst"), [(0, 1), (1, 0)])
+def test_rate_limiter_invalid(rate, burst):
+    with pytest.raises(ValueError):
+        RateLimiter(rate, burst=burst)
+
+
+def test_detect_github_rate_limited(monkeypatch, clock):
+    monkeypatch.setenv("GITHUB_ACTIONS", "true")
+    monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_TOKEN", "faketoken")
+    monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_URL", "https://fakeurl/token")
+
+    responses = iter(
+        [
+            urllib3.HTTPResponse(
+                body=io.BytesIO(b""),
+                status=429,
+                headers={"Retry-After": "2"},
+                preload_content=False,
+            ),
+            urllib3.HTTPResponse(
+                body=io.BytesIO(b'{"value": "fakejwt"}'), status=200, preload_content=False
+            ),
+        ]
+    )
+    monkeypatch.setattr(
+        ambient.urllib3, "request", pretend.call_recorder(lambda *a, **kw: next(responses))
+    )
+
+    id.configure(rate_limits={"GitHub": RateLimiter(10), "GCP": RateLimiter(1)})
+    assert ambient.detect_github("some-audience") == "fakejwt"
+    assert len(ambient.urllib3.request.calls) == 2
+
+    # `Retry-After` is left to the limiter, rather than urllib3's own retries.
+    call = ambient.urllib3.request.calls[0]
+    assert call.args == ("GET", "https://fakeurl/token?audience=some-audience")
+    assert call.kwargs["headers"] == {"Authorization": "bearer faketoken"}
+    assert not call.kwargs["retries"].respect_retry_after_header
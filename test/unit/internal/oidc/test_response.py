@@ -0,0 +1,120 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+
+import pytest
+import urllib3
+
+from id import AmbientCredentialError
+from id._internal.oidc import ambient, response
+
+
+class _Body(io.BytesIO):
+    """
+    A response body that counts the bytes read from it.
+    """
+
+    read_bytes = 0
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.read_bytes += len(data)
+        return data
+
+
+def _response(data, status=200, headers=None):
+    return urllib3.HTTPResponse(
+        body=io.BytesIO(data), status=status, headers=headers, preload_content=False
+    )
+
+
+def test_read_capped():
+    resp = response.read_capped(
+        _response(b'{"value": "fakejwt"}', headers={"Retry-After": "1"}), "https://example.com"
+    )
+
+    assert isinstance(resp, response.BufferedResponse)
+    assert resp.status == 200
+    assert resp.headers["Retry-After"] == "1"
+    assert resp.json() == {"value": "fakejwt"}
+
+
+def test_read_capped_streamed_too_large():
+    body = _Body(b"x" * (10 * response._CHUNK_SIZE))
+    resp = urllib3.HTTPResponse(body=body, status=502, preload_content=False)
+
+    with pytest.raises(
+        AmbientCredentialError, match=r"https://example.com/token: response body exceeds 100 bytes"
+    ):
+        response.read_capped(resp, "https://example.com/token", limit=100)
+
+    # Reading stopped at the first chunk past the limit.
+    assert body.read_bytes == response._CHUNK_SIZE
+    assert resp.closed
+
+
+def test_read_capped_content_length_too_large():
+    body = _Body(b"x" * 200)
+    resp = urllib3.HTTPResponse(
+        body=body, status=200, headers={"Content-Length": "200"}, preload_content=False
+    )
+
+    with pytest.raises(AmbientCredentialError, match="exceeds 100 bytes"):
+        response.read_capped(resp, "https://example.com/token", limit=100)
+    assert body.read_bytes == 0
+
+
+def test_error_body_truncated():
+    resp = response.BufferedResponse(500, urllib3.HTTPHeaderDict(), b"x" * 10000)
+
+    assert response.error_body(resp) == repr("x" * 512) + " (and 9488 more bytes)"
+
+
+def test_error_body_short():
+    resp = response.BufferedResponse(500, urllib3.HTTPHeaderDict(), b"\xffoops")
+
+    assert response.error_body(resp) == repr("�oops")
+
+
+def test_detect_github_huge_error_body(monkeypatch):
+    monkeypatch.setenv("GITHUB_ACTIONS", "true")
+    monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_TOKEN", "faketoken")
+    monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_URL", "https://fakeurl/token")
+    monkeypatch.setattr(
+        ambient.urllib3, "request", lambda *a, **kw: _response(b"<html>" * 20000, status=502)
+    )
+
+    with pytest.raises(AmbientCredentialError) as e:
+        ambient.detect_github("some-audience")
+
+    assert "code=502" in str(e.value)
+    assert "(and 119488 more bytes)" in str(e.value)
+    assert len(str(e.value)) < 1024
+
+
+def test_detect_github_oversized_response(monkeypatch):
+    monkeypatch.setenv("GITHUB_ACTIONS", "true")
+    monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_TOKEN", "faketoken")
+    monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_URL", "https://fakeurl/token?secret=1")
+    monkeypatch.setattr(
+        ambient.urllib3,
+        "request",
+        lambda *a, **kw: _response(b"x" * (response.MAX_RESPONSE_SIZE + 1)),
+    )
+
+    with pytest.raises(
+        AmbientCredentialError, match=r"^https://fakeurl/token: response body exceeds"
+    ):
+        ambient.detect_github("some-audience")
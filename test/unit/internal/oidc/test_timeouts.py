@@ -0,0 +1,214 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import io
+import json
+import socket
+import threading
+
+import pretend
+import pytest
+import urllib3
+
+import id
+from id._internal.oidc import ambient
+from id._internal.oidc.timeouts import AdaptiveTimeouts
+
+
+def _observe(timeouts, endpoint, latencies):
+    for latency in latencies:
+        timeouts.observe(endpoint, latency)
+
+
+def test_timeouts_from_percentile():
+    timeouts = AdaptiveTimeouts(percentile=0.5, multiplier=2.0, min_read=0.0, min_samples=4)
+    _observe(timeouts, "e", [0.4, 0.1, 0.3])
+    assert timeouts.timeouts("e", 30) == (30, 30)
+
+    # Only the read timeout is learned.
+    timeouts.observe("e", 0.2)
+    assert timeouts.timeouts("e", 30) == (30, 0.6)
+    assert AdaptiveTimeouts(connect=5.0).timeouts("e", 30) == (5.0, 30)
+
+
+def test_timeouts_clamped():
+    timeouts = AdaptiveTimeouts(connect=1.0, min_read=3.0, max_read=4.0)
+    _observe(timeouts, "fast", [0.001] * 10)
+    _observe(timeouts, "slow", [100.0] * 10)
+    assert timeouts.timeouts("fast", 30) == (1.0, 3.0)
+    assert timeouts.timeouts("slow", 30) == (1.0, 4.0)
+
+
+@pytest.mark.parametrize(
+    "options",
+    [{"percentile": 1.0}, {"percentile": 0}, {"min_read": 5, "max_read": 4}],
+)
+def test_timeouts_invalid(options):
+    with pytest.raises(ValueError):
+        AdaptiveTimeouts(**options)
+
+
+def test_timeouts_stats():
+    timeouts = AdaptiveTimeouts(percentile=0.9, min_samples=3, min_read=0.0)
+    timeouts.observe("e", 0.1)
+    assert timeouts.stats()["e"] == {
+        "requests": 1,
+        "timeouts": 0,
+        "samples": 1,
+        "p50": 0.1,
+        "percentile": 0.1,
+        "read": None,
+    }
+
+    timeouts.observe("e", 0.2)
+    timeouts.observe("e", 0.5, timed_out=True)
+    stats = timeouts.stats()["e"]
+    assert (stats["requests"], stats["timeouts"], stats["samples"]) == (3, 1, 3)
+    assert (stats["p50"], stats["percentile"]) == (0.2, 0.5)
+    assert stats["read"] == 1.0
+
+
+def test_timeouts_persisted(tmp_path):
+    path = tmp_path / "latencies.json"
+    timeouts = AdaptiveTimeouts(path=path, save_interval=3600)
+    _observe(timeouts, "e", [0.5] * 10)
+
+    # Nothing is saved on the requests' path, only once the interval is up.
+    assert not path.exists()
+    timeouts.save()
+    assert AdaptiveTimeouts(path=path).timeouts("e", 30) == (30, 1.0)
+    # An explicit save cancels the pending one.
+    assert timeouts._saving is None
+
+
+def test_timeouts_saved_in_background(monkeypatch, tmp_path):
+    path = tmp_path / "latencies.json"
+    saved = threading.Event()
+    timeouts = AdaptiveTimeouts(path=path, save_interval=0.05)
+    monkeypatch.setattr(timeouts, "save", pretend.call_recorder(lambda: saved.set()))
+
+    # Observations made before the save are batched into it.
+    _observe(timeouts, "e", [0.5] * 10)
+    assert saved.wait(5)
+    assert timeouts.save.calls == [pretend.call()]
+
+
+def test_timeouts_unreadable_file(tmp_path, caplog):
+    path = tmp_path / "latencies.json"
+    path.write_text("{")
+    timeouts = AdaptiveTimeouts(path=path)
+    assert "ignoring unreadable latencies" in caplog.text
+
+    # It's replaced by the next save.
+    timeouts.observe("e", 0.5)
+    timeouts.save()
+    assert json.loads(path.read_text()) == {"endpoints": {"e": [0.5]}}
+
+
+@pytest.fixture
+def github(monkeypatch):
+    monkeypatch.setenv("GITHUB_ACTIONS", "true")
+    monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_TOKEN", "faketoken")
+    monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_URL", "https://fakeurl/token")
+
+
+def test_session_learns_timeouts(monkeypatch, github):
+    def request(*args, **kwargs):
+        return urllib3.HTTPResponse(
+            body=io.BytesIO(b'{"value": "fakejwt"}'), status=200, preload_content=False
+        )
+
+    timeouts = AdaptiveTimeouts(min_samples=2, connect=0.25, min_read=0.5)
+    with id.Session(timeouts=timeouts) as session:
+        pool = session._config.pool
+        monkeypatch.setattr(pool, "request", pretend.call_recorder(request))
+        with session._activated():
+            for _ in range(3):
+                assert ambient.detect_github("aud") == "fakejwt"
+
+    # The fixed timeout is used until enough latencies have been observed.
+    first, second, third = (call.kwargs["timeout"] for call in pool.request.calls)
+    assert (first.connect_timeout, first.read_timeout) == (0.25, 30)
+    assert (second.connect_timeout, second.read_timeout) == (0.25, 30)
+    assert (third.connect_timeout, third.read_timeout) == (0.25, 0.5)
+    # Read timeouts aren't retried, which would multiply them.
+    assert all(call.kwargs["retries"].read == 0 for call in pool.request.calls)
+    assert timeouts.stats()["https://fakeurl"]["requests"] == 3
+
+
+def test_timed_out_request_observed(monkeypatch, github):
+    error = urllib3.exceptions.MaxRetryError(
+        None, "https://fakeurl/token", urllib3.exceptions.ReadTimeoutError(None, None, "timed out")
+    )
+    monkeypatch.setattr(ambient.urllib3, "request", pretend.raiser(error))
+
+    timeouts = AdaptiveTimeouts(min_samples=1)
+    timeouts.observe("https://fakeurl", 0.1)
+    id.configure(timeouts=timeouts)
+    try:
+        with pytest.raises(id.AmbientCredentialError, match="timed out"):
+            ambient.detect_github("aud")
+    finally:
+        id.configure(timeouts=None)
+
+    stats = timeouts.stats()["https://fakeurl"]
+    assert (stats["requests"], stats["timeouts"]) == (2, 1)
+    # It counts as a latency of the read timeout it was given.
+    assert stats["percentile"] == 1.0
+
+
+def test_untracked_requests_keep_their_timeout(monkeypatch):
+    request = pretend.call_recorder(
+        lambda *a, **kw: urllib3.HTTPResponse(body=io.BytesIO(b""), preload_content=False)
+    )
+    monkeypatch.setattr(ambient.urllib3, "request", request)
+
+    timeouts = AdaptiveTimeouts()
+    id.configure(timeouts=timeouts)
+    try:
+        ambient._request("GET", "http://metadata.google.internal/", timeout=0.5)
+    finally:
+        id.configure(timeouts=None)
+
+    assert request.calls[0].kwargs["timeout"] == 0.5
+    assert timeouts.stats() == {}
+
+
+def test_read_timeout_not_retried(monkeypatch):
+    # Accepts connections, and never answers.
+    listener = socket.create_server(("127.0.0.1", 0))
+    url = f"http://127.0.0.1:{listener.getsockname()[1]}/token"
+    monkeypatch.setenv("GITHUB_ACTIONS", "true")
+    monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_TOKEN", "faketoken")
+    monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_URL", url)
+
+    timeouts = AdaptiveTimeouts(min_samples=1, min_read=0.2)
+    timeouts.observe(url.rpartition("/")[0], 0.01)
+    connections = []
+    try:
+        with id.Session(timeouts=timeouts) as session, session._activated():
+            with pytest.raises(id.AmbientCredentialError, match="timed out"):
+                ambient.detect_github("aud")
+
+        # One request timed out, rather than one per retry.
+        listener.setblocking(False)
+        with contextlib.suppress(BlockingIOError):
+            while True:
+                connections.append(listener.accept()[0])
+        assert len(connections) == 1
+    finally:
+        for conn in connections:
+            conn.close()
+        listener.close()
@@ -0,0 +1,103 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import json
+
+import pytest
+
+from id import IdentityError, TokenArchive, build_archive
+
+
+def _token(**claims):
+    def b64(obj):
+        return base64.urlsafe_b64encode(json.dumps(obj).encode()).decode().rstrip("=")
+
+    return f"{b64({'alg': 'RS256'})}.{b64(claims)}.sig"
+
+
+_GHA = "https://token.actions.githubusercontent.com"
+_GITLAB = "https://gitlab.com"
+
+_TOKENS = [
+    _token(iss=_GHA, sub="repo:a/a:ref:refs/heads/main", repository="a/a", exp=100),
+    _token(iss=_GHA, sub="repo:b/b:ref:refs/heads/main", repository="b/b", exp=200),
+    _token(iss=_GITLAB, sub="project_path:c/c:ref_type:branch:ref:main", exp=300),
+    _token(iss=_GHA, sub="repo:a/a:ref:refs/heads/dev", repository="a/a", exp=400),
+    _token(iss=_GHA, sub="repo:d/d:ref:refs/heads/main", repository="d/d"),
+]
+
+
+@pytest.fixture
+def archive(tmp_path):
+    path = tmp_path / "tokens.idar"
+    assert build_archive(_TOKENS, path) == len(_TOKENS)
+    with TokenArchive(path) as archive:
+        yield archive
+
+
+def _subs(matches):
+    return [claims["sub"] for claims in matches]
+
+
+def test_archive_all(archive):
+    assert len(archive) == 5
+    assert len(list(archive.query())) == 5
+    assert archive.record(0)[2] == "sig"
+
+
+def test_archive_query_claims(archive):
+    assert _subs(archive.query(iss=_GITLAB)) == ["project_path:c/c:ref_type:branch:ref:main"]
+    assert _subs(archive.query(repository="a/a")) == [
+        "repo:a/a:ref:refs/heads/main",
+        "repo:a/a:ref:refs/heads/dev",
+    ]
+    assert _subs(archive.query(iss=_GHA, sub="repo:b/b:ref:refs/heads/main")) == [
+        "repo:b/b:ref:refs/heads/main"
+    ]
+    assert list(archive.query(iss=_GITLAB, repository="a/a")) == []
+    assert list(archive.query(iss="https://unknown.example.com")) == []
+
+
+def test_archive_query_exp(archive):
+    assert [c["exp"] for c in archive.query(exp_min=200)] == [200, 300, 400]
+    assert [c["exp"] for c in archive.query(exp_max=200)] == [100, 200]
+    assert [c["exp"] for c in archive.query(exp_min=150, exp_max=350)] == [200, 300]
+    assert [c["exp"] for c in archive.query(repository="a/a", exp_min=150)] == [400]
+    assert list(archive.query(exp_min=500)) == []
+
+
+def test_archive_query_unindexed(archive):
+    with pytest.raises(ValueError, match="not an indexed claim: aud"):
+        list(archive.query(aud="sigstore"))
+
+
+def test_archive_skips_malformed(tmp_path):
+    path = tmp_path / "tokens.idar"
+    assert build_archive([_TOKENS[0], "", "not-a-token", "a.bm90LWpzb24.c"], path) == 1
+
+
+def test_archive_empty(tmp_path):
+    path = tmp_path / "tokens.idar"
+    assert build_archive([], path) == 0
+    with TokenArchive(path) as archive:
+        assert list(archive.query(iss=_GHA, exp_min=0)) == []
+
+
+@pytest.mark.parametrize("contents", [b"", b"short", b"x" * 128])
+def test_archive_not_an_archive(tmp_path, contents):
+    path = tmp_path / "tokens.idar"
+    path.write_bytes(contents)
+    with pytest.raises(IdentityError, match="is not a token archive"):
+        TokenArchive(path)
@@ -0,0 +1,199 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import socketserver
+import sys
+import threading
+import time
+
+import pytest
+
+from id import IdentityError
+from id._internal.cache import CacheBackend, MemcacheTokenCache, SqliteTokenCache, TokenCache
+
+
+def test_cache_backend_is_abstract():
+    class Incomplete(CacheBackend):
+        def get(self, key):
+            return None
+
+        def put(self, key, credential, expires_at):
+            pass
+
+    with pytest.raises(TypeError):
+        CacheBackend()
+    with pytest.raises(TypeError, match="clear"):
+        Incomplete()
+
+
+def test_token_cache_get_put():
+    cache = TokenCache(leeway=10)
+    assert cache.get("aud") is None
+
+    cache.put("aud", "token", time.time() + 60)
+    assert cache.get("aud") == "token"
+
+    cache.clear()
+    assert cache.get("aud") is None
+
+
+def test_token_cache_expires_with_leeway():
+    cache = TokenCache(leeway=10)
+
+    cache.put("aud", "token", time.time() + 5)
+    assert cache.get("aud") is None
+
+
+class _Memcached(socketserver.ThreadingTCPServer):
+    """
+    A stand-in memcached server, speaking just enough of the text protocol.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        self.entries = {}
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(handler):
+                for line in handler.rfile:
+                    command, *args = line.split()
+                    if command == b"get":
+                        entry = self.entries.get(args[0])
+                        if entry is not None and entry[1] > time.time():
+                            handler.wfile.write(b"VALUE %s 0 %d\r\n" % (args[0], len(entry[0])))
+                            handler.wfile.write(entry[0] + b"\r\n")
+                        handler.wfile.write(b"END\r\n")
+                    elif command == b"set":
+                        data = handler.rfile.read(int(args[3]) + 2)[:-2]
+                        self.entries[args[0]] = (data, time.time() + int(args[2]))
+                        handler.wfile.write(b"STORED\r\n")
+                    elif command == b"delete":
+                        found = self.entries.pop(args[0], None) is not None
+                        handler.wfile.write(b"DELETED\r\n" if found else b"NOT_FOUND\r\n")
+
+        super().__init__(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+@pytest.fixture
+def memcached():
+    server = _Memcached()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_sqlite_token_cache(tmp_path):
+    cache = SqliteTokenCache(tmp_path / "cache.db", leeway=10, plaintext=True)
+    assert cache.get("aud") is None
+
+    cache.put("aud", "token", time.time() + 60)
+    assert cache.get("aud") == "token"
+
+    cache.put("soon", "token", time.time() + 5)
+    assert cache.get("soon") is None
+
+    cache.clear()
+    assert cache.get("aud") is None
+
+
+def test_sqlite_token_cache_shared(tmp_path):
+    a = SqliteTokenCache(tmp_path / "cache.db", plaintext=True)
+    b = SqliteTokenCache(tmp_path / "cache.db", plaintext=True)
+    other = SqliteTokenCache(tmp_path / "cache.db", namespace="other", plaintext=True)
+
+    a.put("aud", "token", time.time() + 300)
+    assert b.get("aud") == "token"
+    assert other.get("aud") is None
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="POSIX permissions")
+def test_sqlite_token_cache_private(tmp_path):
+    old = os.umask(0o022)
+    try:
+        SqliteTokenCache(tmp_path / "cache.db", plaintext=True).close()
+    finally:
+        os.umask(old)
+
+    assert (tmp_path / "cache.db").stat().st_mode & 0o777 == 0o600
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="POSIX permissions")
+def test_sqlite_token_cache_refuses_world_readable(tmp_path):
+    path = tmp_path / "cache.db"
+    path.touch()
+    path.chmod(0o644)
+
+    with pytest.raises(IdentityError, match="accessible to other users"):
+        SqliteTokenCache(path, plaintext=True)
+
+
+@pytest.mark.parametrize("options", [{}, {"encryption_key": b"key", "plaintext": True}])
+def test_shared_caches_require_encryption_choice(tmp_path, options):
+    with pytest.raises(ValueError, match="encryption_key"):
+        SqliteTokenCache(tmp_path / "cache.db", **options)
+    with pytest.raises(ValueError, match="encryption_key"):
+        MemcacheTokenCache(**options)
+
+
+def test_sqlite_token_cache_encrypted(tmp_path):
+    fernet = pytest.importorskip("cryptography.fernet")
+    key = fernet.Fernet.generate_key()
+
+    cache = SqliteTokenCache(tmp_path / "cache.db", encryption_key=key)
+    cache.put("aud", "secret-token", time.time() + 300)
+    assert cache.get("aud") == "secret-token"
+    cache.close()
+
+    data = (tmp_path / "cache.db").read_bytes()
+    assert b"secret-token" not in data
+    assert b"aud" not in data
+
+    wrong = SqliteTokenCache(tmp_path / "cache.db", encryption_key=fernet.Fernet.generate_key())
+    assert wrong.get("aud") is None
+
+
+def test_memcache_token_cache(memcached):
+    cache = MemcacheTokenCache(*memcached.server_address, leeway=10, plaintext=True)
+    assert cache.get("aud") is None
+
+    cache.put("aud", "token", time.time() + 60)
+    assert cache.get("aud") == "token"
+    ((_, ttl),) = [(k, v[1] - time.time()) for k, v in memcached.entries.items()]
+    assert 45 < ttl <= 50
+
+    # Entries within the leeway aren't stored at all.
+    cache.put("soon", "token", time.time() + 5)
+    assert len(memcached.entries) == 1
+
+    other = MemcacheTokenCache(*memcached.server_address, namespace="other", plaintext=True)
+    assert other.get("aud") is None
+
+    cache.clear()
+    assert memcached.entries == {}
+    cache.close()
+
+
+def test_memcache_token_cache_unreachable(memcached, caplog):
+    host, port = memcached.server_address
+    memcached.shutdown()
+    memcached.server_close()
+
+    cache = MemcacheTokenCache(host, port, timeout=0.1, plaintext=True)
+    cache.put("aud", "token", time.time() + 300)
+    assert cache.get("aud") is None
+    assert "memcached lookup failed" in caplog.text
@@ -0,0 +1,144 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import builtins
+import json
+
+import pytest
+
+from id import ClaimColumns, IdentityError, decode_columns
+from id._internal import columnar
+from id._internal.columnar import MISSING
+
+
+def _token(claims):
+    def b64(obj):
+        return base64.urlsafe_b64encode(json.dumps(obj).encode()).decode().rstrip("=")
+
+    return f"{b64({'alg': 'RS256'})}.{b64(claims)}.sig"
+
+
+_GHA = "https://token.actions.githubusercontent.com"
+
+_TOKENS = [
+    _token({"iss": _GHA, "aud": "pypi", "repository": "a/a", "iat": 100, "exp": 400}),
+    "not.a-token",
+    _token({"iss": _GHA, "aud": ["sigstore"], "repository": "b/b", "iat": 200.9, "exp": 500}),
+    "",
+    _token({"iss": "https://gitlab.com", "aud": ["a", "b"], "iat": True, "exp": 1e30}),
+    _token(["not", "an", "object"]),
+    _token({"iss": _GHA, "aud": "pypi", "repository": "a/a", "exp": float("nan")}),
+]
+
+
+@pytest.fixture
+def columns():
+    return decode_columns(_TOKENS)
+
+
+def test_decode_columns(columns):
+    assert isinstance(columns, ClaimColumns)
+    assert len(columns) == 4
+    assert columns.values["iss"] == [_GHA, "https://gitlab.com"]
+    assert list(columns.codes["iss"]) == [0, 0, 1, 0]
+    # A single audience in a list counts; several don't.
+    assert columns.values["aud"] == ["pypi", "sigstore"]
+    assert list(columns.codes["aud"]) == [0, 1, -1, 0]
+    assert list(columns.codes["repository"]) == [0, 1, -1, 0]
+    assert list(columns.codes["sub"]) == [-1] * 4
+
+    assert list(columns.timestamps["iat"]) == [100, 200, MISSING, MISSING]
+    assert list(columns.timestamps["exp"]) == [400, 500, MISSING, MISSING]
+    assert list(columns.timestamps["nbf"]) == [MISSING] * 4
+
+
+def test_decode_columns_skips_malformed(caplog):
+    decode_columns(_TOKENS)
+    assert "skipping malformed token #2" in caplog.text
+    assert "skipping malformed token #6: payload is not a JSON object" in caplog.text
+    assert "#4" not in caplog.text
+
+
+def test_decode_columns_selected_claims():
+    columns = decode_columns(_TOKENS, strings=["repository"], timestamps=[])
+    assert list(columns.codes) == ["repository"]
+    assert columns.timestamps == {}
+
+
+def test_to_numpy(columns):
+    numpy = pytest.importorskip("numpy")
+
+    arrays = columns.to_numpy()
+    assert arrays["exp"].dtype == numpy.int64
+    assert arrays["iss"].dtype == numpy.int32
+    assert arrays["exp"].tolist() == [400, 500, MISSING, MISSING]
+    assert arrays["aud"].tolist() == [0, 1, -1, 0]
+
+    # The arrays share memory with the columns.
+    assert not arrays["exp"].flags.owndata
+
+
+def test_to_arrow(columns, tmp_path):
+    pyarrow = pytest.importorskip("pyarrow")
+    parquet = pytest.importorskip("pyarrow.parquet")
+
+    table = columns.to_arrow()
+    assert table.column_names == ["iss", "sub", "aud", "repository", "iat", "nbf", "exp"]
+    assert table.schema.field("exp").type == pyarrow.int64()
+    assert table.schema.field("iss").type == pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+    assert table.column("exp").to_pylist() == [400, 500, None, None]
+    assert table.column("aud").to_pylist() == ["pypi", "sigstore", None, "pypi"]
+
+    parquet.write_table(table, tmp_path / "claims.parquet")
+    assert parquet.read_table(tmp_path / "claims.parquet").to_pylist() == table.to_pylist()
+
+
+def test_empty():
+    pytest.importorskip("pyarrow")
+
+    columns = decode_columns([])
+    assert len(columns) == 0
+    assert columns.to_arrow().num_rows == 0
+
+
+@pytest.mark.parametrize(("method", "module"), [("to_numpy", "numpy"), ("to_arrow", "pyarrow")])
+def test_missing_dependency(columns, monkeypatch, method, module):
+    real_import = builtins.__import__
+
+    def _import(name, *args, **kwargs):
+        if name.split(".")[0] == module:
+            raise ImportError(name)
+        return real_import(name, *args, **kwargs)
+
+    monkeypatch.setattr(builtins, "__import__", _import)
+    with pytest.raises(IdentityError, match=rf"require `{module}` \(id\[columnar\]\)"):
+        getattr(columns, method)()
+
+
+def test_decode_columns_in_chunks(columns, monkeypatch):
+    # Codes stay consistent across chunks.
+    monkeypatch.setattr(columnar, "_CHUNK", 2)
+    chunked = decode_columns(_TOKENS)
+    assert len(chunked) == len(columns)
+    assert chunked.values == columns.values
+    assert chunked.codes == columns.codes
+    assert chunked.timestamps == columns.timestamps
+
+
+def test_decode_columns_out_of_range():
+    columns = decode_columns(
+        [_token({"exp": 2**70}), _token({"exp": -(2**63)}), _token({"exp": 1})]
+    )
+    assert list(columns.timestamps["exp"]) == [MISSING, MISSING, 1]
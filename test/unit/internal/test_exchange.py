@@ -0,0 +1,161 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pretend
+import pytest
+
+import id
+from id import AmbientCredentialError, Session, TokenExchange
+
+
+class _Exchange:
+    """
+    A stand-in exchange endpoint, answering every POST with `response`.
+    """
+
+    def __init__(self, status=200, response=None, delay=0.0):
+        self.status = status
+        self.response = response if response is not None else {"token": "pypi-abc"}
+        self.delay = delay
+        self.requests = []
+
+        exchange = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                exchange.requests.append(json.loads(body))
+                time.sleep(exchange.delay)
+                data = json.dumps(exchange.response).encode()
+                self.send_response(exchange.status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self._server.server_port}/_/oidc/mint-token"
+        threading.Thread(target=self._server.serve_forever, args=(0.05,), daemon=True).start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+@pytest.fixture
+def exchange():
+    servers = []
+
+    def _make(**kwargs):
+        server = _Exchange(**kwargs)
+        servers.append(server)
+        return server
+
+    yield _make
+    for server in servers:
+        server.close()
+
+
+@pytest.fixture
+def detect(monkeypatch):
+    _detect_credential = pretend.call_recorder(lambda audience: "oidc-token")
+    monkeypatch.setattr(id, "_detect_credential", _detect_credential)
+    return _detect_credential
+
+
+def test_exchange_cached(exchange, detect):
+    server = exchange(response={"token": "pypi-abc", "expires": time.time() + 900})
+    with Session() as session:
+        pypi = TokenExchange(server.url, "pypi", session=session)
+        assert [pypi.credential() for _ in range(3)] == ["pypi-abc"] * 3
+
+    assert detect.calls == [pretend.call("pypi")]
+    assert server.requests == [{"token": "oidc-token"}]
+
+
+def test_exchange_single_flight(exchange, detect):
+    server = exchange(response={"token": "pypi-abc", "expires_in": 900}, delay=0.2)
+    pypi = TokenExchange(server.url, "pypi")
+
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda _: pypi.credential(), range(8)))
+
+    assert results == ["pypi-abc"] * 8
+    assert len(server.requests) == 1
+
+
+def test_exchange_fields(exchange, detect):
+    server = exchange(response={"access_token": "downstream"})
+    creds = TokenExchange(
+        server.url,
+        "aud",
+        request_field="jwt",
+        response_field="access_token",
+        default_lifetime=600,
+    )
+
+    assert creds.credential() == "downstream"
+    assert creds.credential() == "downstream"
+    assert server.requests == [{"jwt": "oidc-token"}]
+
+
+def test_exchange_without_expiry_not_cached(exchange, detect):
+    server = exchange()
+    pypi = TokenExchange(server.url, "pypi")
+
+    assert pypi.credential() == "pypi-abc"
+    assert pypi.credential() == "pypi-abc"
+    assert len(server.requests) == 2
+
+
+def test_exchange_expired_not_cached(exchange, detect):
+    server = exchange(response={"token": "pypi-abc", "expires": time.time() - 1})
+    pypi = TokenExchange(server.url, "pypi")
+
+    pypi.credential()
+    pypi.credential()
+    assert len(server.requests) == 2
+
+
+def test_exchange_no_ambient_credential(monkeypatch, exchange):
+    monkeypatch.setattr(id, "_detect_credential", lambda audience: None)
+    server = exchange()
+
+    assert TokenExchange(server.url, "pypi").credential() is None
+    assert server.requests == []
+
+
+def test_exchange_rejected(exchange, detect):
+    server = exchange(status=403, response={"message": "invalid-publisher"})
+
+    with pytest.raises(
+        AmbientCredentialError, match=r"token exchange failed \(code=403, body=.*invalid-publisher"
+    ):
+        TokenExchange(server.url, "pypi").credential()
+
+
+def test_exchange_malformed(exchange, detect):
+    server = exchange(response={"message": "no token here"})
+
+    with pytest.raises(AmbientCredentialError, match="malformed or incomplete JSON"):
+        TokenExchange(server.url, "pypi").credential()
@@ -0,0 +1,128 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import json
+
+import pytest
+import urllib3
+
+from id import LocalIssuer, decode_oidc_token
+from id._internal.oidc import ambient
+
+pytest.importorskip("cryptography")
+
+from cryptography.hazmat.primitives import hashes, serialization  # noqa: E402
+from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa, utils  # noqa: E402
+
+
+def _int(b64):
+    return int.from_bytes(base64.urlsafe_b64decode(b64 + "=="), "big")
+
+
+def _verify(issuer, token):
+    (jwk,) = issuer.jwks()["keys"]
+    header, payload, signature = token.split(".")
+    message = f"{header}.{payload}".encode()
+    signature = base64.urlsafe_b64decode(signature + "==")
+
+    if jwk["kty"] == "EC":
+        key = ec.EllipticCurvePublicNumbers(_int(jwk["x"]), _int(jwk["y"]), ec.SECP256R1())
+        der = utils.encode_dss_signature(
+            int.from_bytes(signature[:32], "big"), int.from_bytes(signature[32:], "big")
+        )
+        key.public_key().verify(der, message, ec.ECDSA(hashes.SHA256()))
+    else:
+        key = rsa.RSAPublicNumbers(_int(jwk["e"]), _int(jwk["n"]))
+        key.public_key().verify(signature, message, padding.PKCS1v15(), hashes.SHA256())
+
+
+@pytest.mark.parametrize("algorithm", ["ES256", "RS256"])
+def test_local_issuer_signs(algorithm):
+    issuer = LocalIssuer(algorithm=algorithm)
+    tokens = issuer.mint_batch("sigstore", 3, "example/repo")
+
+    assert len(set(tokens)) == 3
+    for token in tokens:
+        _verify(issuer, token)
+        header, payload, _ = decode_oidc_token(token)
+        assert json.loads(header) == {"alg": algorithm, "kid": issuer.kid, "typ": "JWT"}
+
+        claims = json.loads(payload)
+        assert claims["aud"] == "sigstore"
+        assert claims["repository"] == "example/repo"
+        assert claims["sub"] == "repo:example/repo:ref:refs/heads/main"
+        assert claims["exp"] - claims["iat"] == 300
+
+
+@pytest.mark.parametrize(
+    ("provider", "claim"),
+    [("github", "repository"), ("gcp", "email"), ("gitlab", "project_path"), ("circleci", "sub")],
+)
+def test_local_issuer_provider_shapes(provider, claim):
+    issuer = LocalIssuer(provider=provider)
+    claims = json.loads(decode_oidc_token(issuer.mint("aud", extra="value"))[1])
+    assert claim in claims
+    assert claims["extra"] == "value"
+    assert claims["iss"] == "http://localhost"
+
+
+def test_local_issuer_reuses_key():
+    issuer = LocalIssuer()
+    again = LocalIssuer(private_key_pem=issuer.private_key_pem)
+    assert again.kid == issuer.kid
+    _verify(issuer, again.mint("aud"))
+
+
+def test_local_issuer_bad_arguments():
+    with pytest.raises(ValueError, match="unknown provider"):
+        LocalIssuer(provider="nope")
+    with pytest.raises(ValueError, match="unknown algorithm"):
+        LocalIssuer(algorithm="none")
+    with pytest.raises(ValueError, match="RS256 requires an RSA private key"):
+        LocalIssuer(algorithm="RS256", private_key_pem=LocalIssuer().private_key_pem)
+
+    p384 = ec.generate_private_key(ec.SECP384R1()).private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+    with pytest.raises(ValueError, match="ES256 requires an EC P-256 private key"):
+        LocalIssuer(algorithm="ES256", private_key_pem=p384)
+
+
+def test_local_issuer_serves(monkeypatch):
+    issuer = LocalIssuer()
+    url = issuer.serve()
+    try:
+        discovery = urllib3.request("GET", f"{url}/.well-known/openid-configuration").json()
+        assert discovery["issuer"] == url
+        assert urllib3.request("GET", discovery["jwks_uri"]).json() == issuer.jwks()
+
+        # The /token endpoint stands in for GitHub Actions.
+        monkeypatch.setenv("GITHUB_ACTIONS", "true")
+        monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_TOKEN", "faketoken")
+        monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_URL", f"{url}/token")
+        token = ambient.detect_github("sigstore")
+        _verify(issuer, token)
+        assert json.loads(decode_oidc_token(token)[1])["iss"] == url
+
+        batch = urllib3.request("GET", f"{url}/token?audience=a&count=2").json()
+        assert len(batch["values"]) == 2
+
+        for count in ("0", "-1", "many", "1001"):
+            resp = urllib3.request("GET", f"{url}/token?count={count}")
+            assert resp.status == 400
+    finally:
+        issuer.shutdown()
@@ -0,0 +1,83 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import pstats
+import time
+import tracemalloc
+
+import id
+from id._internal.profile import active
+
+
+def _work():
+    return [str(i) for i in range(10000)]
+
+
+def test_profile_writes_stats(tmp_path):
+    path = tmp_path / "id.pstats"
+    stream = io.StringIO()
+    with id.profile(str(path), stream=stream):
+        assert active()
+        _work()
+    assert not active()
+
+    stats = pstats.Stats(str(path))
+    assert any(func[2] == "_work" for func in stats.stats)
+    summary = stream.getvalue()
+    assert f"profile written to {path}" in summary
+    assert "_work" in summary
+    assert "allocation sites" not in summary
+
+
+def test_profile_memory(tmp_path):
+    stream = io.StringIO()
+    with id.profile(memory=True, top=3, stream=stream):
+        data = _work()
+
+    summary = stream.getvalue()
+    assert "top 3 allocation sites" in summary
+    assert "test_profile.py" in summary
+    assert not tracemalloc.is_tracing()
+    del data
+
+
+def test_profile_leaves_existing_tracing(tmp_path):
+    tracemalloc.start()
+    try:
+        with id.profile(memory=True, stream=io.StringIO()):
+            _work()
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+
+
+def test_profile_includes_session_threads(monkeypatch, tmp_path, make_token):
+    token = make_token("aud", time.time() + 300)
+
+    def detect(audience):
+        _work()
+        return token
+
+    monkeypatch.setattr(id, "_detect_credential", detect)
+    path = tmp_path / "id.pstats"
+    with id.Session() as session:
+        with id.profile(str(path), stream=io.StringIO()):
+            futures = session.prefetch(["a", "b"])
+            assert [future.result() for future in futures.values()] == [token, token]
+
+    stats = pstats.Stats(str(path)).stats
+    # Minted on the session's threads, and profiled there.
+    assert [func for func in stats if func[2] == "detect"]
+    assert not active()
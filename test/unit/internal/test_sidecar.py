@@ -0,0 +1,164 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import stat
+import sys
+import threading
+import time
+
+import pretend
+import pytest
+
+import id
+from id import AmbientCredentialError
+from id.__main__ import main
+from id._internal.session import _DefaultSession
+from id._internal.sidecar import Sidecar
+
+
+def _session(mint):
+    return pretend.stub(detect_credential=pretend.call_recorder(mint))
+
+
+def test_sidecar_writes_private_files(tmp_path, make_token):
+    token = make_token("aud", time.time() + 100)
+    path = tmp_path / "aud.token"
+    sidecar = Sidecar({"aud": str(path)}, session=_session(lambda audience: token))
+
+    assert sidecar.refresh()
+    assert path.read_text() == token
+    if sys.platform != "win32":
+        assert stat.S_IMODE(path.stat().st_mode) == 0o600
+    # No temporary files are left behind.
+    assert [p.name for p in tmp_path.iterdir()] == ["aud.token"]
+    # The token is refreshed after 80% of its lifetime.
+    assert 75 < sidecar.delay() <= 80
+
+
+def test_sidecar_refreshes_only_due_tokens(tmp_path, make_token):
+    lifetimes = {"short": 1, "long": 1000}
+    session = _session(lambda audience: make_token(audience, time.time() + lifetimes[audience]))
+    sidecar = Sidecar(
+        {audience: str(tmp_path / audience) for audience in lifetimes},
+        refresh_at=0.01,
+        session=session,
+    )
+
+    assert sidecar.refresh()
+    time.sleep(0.02)
+    assert sidecar.refresh()
+    # Only the short-lived token was due again.
+    assert sorted(call.args for call in session.detect_credential.calls) == [
+        ("long",),
+        ("short",),
+        ("short",),
+    ]
+
+
+def test_sidecar_without_expiry_uses_interval(tmp_path):
+    sidecar = Sidecar(
+        {"aud": str(tmp_path / "aud")}, interval=42, session=_session(lambda audience: "e30.e30.")
+    )
+    assert sidecar.refresh()
+    assert 41 < sidecar.delay() <= 42
+
+
+def test_sidecar_failure_keeps_previous_token(tmp_path, make_token, caplog):
+    token = make_token("aud", time.time() + 100)
+    tokens = iter([token])
+
+    def mint(audience):
+        try:
+            return next(tokens)
+        except StopIteration:
+            raise AmbientCredentialError("issuer down")
+
+    path = tmp_path / "aud.token"
+    heartbeat = tmp_path / "heartbeat"
+    sidecar = Sidecar(
+        {"aud": str(path)},
+        heartbeat=str(heartbeat),
+        refresh_at=0.0001,
+        retry=5,
+        session=_session(mint),
+    )
+
+    assert sidecar.refresh()
+    beat = heartbeat.read_text()
+    time.sleep(0.02)
+    # The refresh fails, but the previous token is still valid.
+    assert sidecar.refresh()
+    assert path.read_text() == token
+    assert heartbeat.read_text() >= beat
+    assert "issuer down" in caplog.text
+    assert 4 < sidecar.delay() <= 5
+
+
+def test_sidecar_unhealthy_without_valid_token(tmp_path, make_token):
+    heartbeat = tmp_path / "heartbeat"
+    sidecar = Sidecar(
+        {"aud": str(tmp_path / "aud")},
+        heartbeat=str(heartbeat),
+        session=_session(lambda audience: None),
+    )
+    assert not sidecar.refresh()
+    assert not heartbeat.exists()
+
+    # An expired token doesn't count either.
+    sidecar = Sidecar(
+        {"aud": str(tmp_path / "aud")},
+        session=_session(lambda audience: make_token(audience, time.time() - 1)),
+    )
+    assert not sidecar.run(threading.Event())
+
+
+def test_sidecar_run_until_stopped(tmp_path, make_token):
+    stop = threading.Event()
+    stop.set()
+    sidecar = Sidecar(
+        {"aud": str(tmp_path / "aud")},
+        session=_session(lambda audience: make_token(audience, time.time() + 100)),
+    )
+    assert sidecar.run(stop)
+
+
+def test_sidecar_invalid_refresh_at():
+    with pytest.raises(ValueError, match="refresh_at"):
+        Sidecar({}, refresh_at=1.5)
+
+
+def test_sidecar_cli_once(monkeypatch, tmp_path, make_token):
+    monkeypatch.setattr(id, "_default_session", _DefaultSession())
+    monkeypatch.setattr(
+        id, "_detect_credential", lambda audience: make_token(audience, time.time() + 100)
+    )
+
+    custom = tmp_path / "custom"
+    with pytest.raises(SystemExit) as e:
+        main(
+            [
+                "sidecar",
+                "--once",
+                "--directory",
+                str(tmp_path),
+                "-a",
+                "https://example.com",
+                "-a",
+                "sigstore",
+                "--file",
+                f"sigstore={custom}",
+            ]
+        )
+    assert e.value.code == 0
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["custom", "https_example.com.token"]
@@ -0,0 +1,117 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import json
+import time
+
+import pretend
+import pytest
+
+from id import IdentityError, TokenVerifier
+
+_ISS = "https://token.actions.githubusercontent.com"
+
+
+def _token(**claims):
+    claims = {"iss": _ISS, "aud": "pypi", "exp": time.time() + 300, **claims}
+    payload = base64.urlsafe_b64encode(json.dumps(claims).encode()).decode().rstrip("=")
+    return f"e30.{payload}.sig"
+
+
+def _verifier(**kwargs):
+    kwargs.setdefault("verify_signature", lambda token: None)
+    return TokenVerifier(audiences=["pypi"], issuers=[_ISS], **kwargs)
+
+
+def test_verify_caches_claims():
+    verify_signature = pretend.call_recorder(lambda token: None)
+    verifier = _verifier(verify_signature=verify_signature)
+    token = _token(sub="repo:a/a")
+
+    claims = verifier.verify(token)
+    assert claims["sub"] == "repo:a/a"
+    assert verifier.verify(token) is claims
+    assert (verifier.hits, verifier.misses) == (1, 1)
+    assert verify_signature.calls == [pretend.call(token)]
+
+    with pytest.raises(TypeError):
+        claims["sub"] = "repo:b/b"
+
+    verifier.clear()
+    verifier.verify(token)
+    assert verifier.misses == 2
+
+
+def test_verify_audience_list():
+    assert _verifier().verify(_token(aud=["other", "pypi"]))["aud"] == ["other", "pypi"]
+
+
+@pytest.mark.parametrize(
+    ("token", "message"),
+    [
+        ("not-a-token", "Malformed token"),
+        ("e30.W10.sig", "JWT is not a JSON object"),
+        (_token(iss="https://evil.example.com"), "Token issuer not allowed"),
+        (_token(iss=["https://evil.example.com"]), "Token issuer not allowed"),
+        (_token(aud="other"), "Token audience not allowed"),
+        (_token(exp=None), "expiry claim is missing"),
+        (_token(exp=time.time() - 1), "Token has expired"),
+        (_token(nbf=time.time() + 60), r"nbf is in the future"),
+    ],
+)
+def test_verify_rejects(token, message):
+    with pytest.raises(IdentityError, match=message):
+        _verifier().verify(token)
+
+
+def test_verify_signature_rejects():
+    verifier = _verifier(verify_signature=pretend.raiser(IdentityError("bad signature")))
+    with pytest.raises(IdentityError, match="bad signature"):
+        verifier.verify(_token())
+
+
+@pytest.mark.parametrize("kwargs", [{}, {"verify_signature": None}])
+def test_verify_signature_required(kwargs):
+    with pytest.raises(TypeError, match="verify_signature"):
+        TokenVerifier(audiences=["pypi"], issuers=[_ISS], **kwargs)
+
+
+def test_verify_leeway():
+    assert _verifier(leeway=60).verify(_token(exp=time.time() - 1))
+
+
+def test_verify_cached_token_expires(monkeypatch):
+    verifier = _verifier()
+    token = _token(exp=time.time() + 10)
+    verifier.verify(token)
+
+    monkeypatch.setattr(time, "time", lambda: 2**40)
+    with pytest.raises(IdentityError, match="Token has expired"):
+        verifier.verify(token)
+
+
+def test_verify_lru_eviction():
+    verifier = _verifier(maxsize=2)
+    a, b, c = _token(sub="a"), _token(sub="b"), _token(sub="c")
+
+    verifier.verify(a)
+    verifier.verify(b)
+    verifier.verify(a)
+    verifier.verify(c)  # evicts b, the least recently used
+
+    verifier.verify(a)
+    assert verifier.hits == 2
+    verifier.verify(b)
+    assert verifier.misses == 4
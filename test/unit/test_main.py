@@ -0,0 +1,245 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import json
+import os
+import pstats
+import time
+from pathlib import Path
+
+import pretend
+import pytest
+import urllib3
+
+import id
+import id.__main__
+from id.__main__ import main
+from id._internal.oidc import ambient
+from id._internal.session import _DefaultSession
+
+_GHA_TOKEN = (Path(__file__).parent / "internal" / "oidc" / "gha_token.txt").read_text().strip()
+
+
+def test_archive_build_and_query(tmp_path, capsys):
+    tokens = tmp_path / "tokens.txt"
+    tokens.write_text(f"{_GHA_TOKEN}\n")
+    archive = tmp_path / "tokens.idar"
+
+    main(["archive", "build", str(archive), str(tokens)])
+    assert "archived 1 tokens" in capsys.readouterr().err
+
+    main(["archive", "query", str(archive), "--iss", "https://token.actions.githubusercontent.com"])
+    (line,) = capsys.readouterr().out.splitlines()
+    assert json.loads(line)["aud"] == "sigstore"
+
+    main(["archive", "query", str(archive), "--iss", "https://gitlab.com"])
+    assert capsys.readouterr().out == ""
+
+
+@pytest.fixture
+def tokens(monkeypatch, make_token):
+    monkeypatch.setattr(id, "_default_session", _DefaultSession())
+    tokens = {
+        "sigstore": make_token("sigstore", time.time() + 300),
+        "https://example.com/?a=b": make_token("https://example.com/?a=b", time.time() + 300),
+    }
+    monkeypatch.setattr(id, "_detect_credential", lambda audience: tokens.get(audience))
+    return tokens
+
+
+def test_multiple_audiences_json(capsys, tokens):
+    main(["--format", "json", *tokens])
+    assert json.loads(capsys.readouterr().out) == tokens
+
+
+def test_multiple_audiences_token(capsys, tokens):
+    main(list(tokens))
+    assert capsys.readouterr().out.splitlines() == list(tokens.values())
+
+
+def test_multiple_audiences_env(capsys, tokens):
+    main(["-f", "env", "--name", "https://example.com/?a=b=EXAMPLE", *tokens])
+    assert capsys.readouterr().out.splitlines() == [
+        f"export SIGSTORE_ID_TOKEN={tokens['sigstore']}",
+        f"export EXAMPLE={tokens['https://example.com/?a=b']}",
+    ]
+
+
+def test_multiple_audiences_dotenv(capsys, tokens):
+    main(["-f", "dotenv", "sigstore"])
+    assert capsys.readouterr().out == f"SIGSTORE_ID_TOKEN={tokens['sigstore']}\n"
+
+
+def test_audience_from_environment(monkeypatch, capsys, tokens):
+    monkeypatch.setenv("ID_OIDC_AUDIENCE", "sigstore")
+    main([])
+    assert capsys.readouterr().out == f"{tokens['sigstore']}\n"
+
+    monkeypatch.delenv("ID_OIDC_AUDIENCE")
+    with pytest.raises(SystemExit):
+        main([])
+    assert "an audience is required" in capsys.readouterr().err
+
+
+def test_missing_credential_exits(capsys, tokens):
+    with pytest.raises(SystemExit) as e:
+        main(["-f", "json", "sigstore", "nope"])
+    assert e.value.code == 1
+    assert "no credential available for 'nope'" in capsys.readouterr().err
+
+
+def test_invalid_name(capsys, tokens):
+    with pytest.raises(SystemExit):
+        main(["-f", "env", "--name", "sigstore=1BAD", "sigstore"])
+    assert "invalid --name" in capsys.readouterr().err
+
+
+def test_exec(monkeypatch, tokens):
+    execvpe = pretend.call_recorder(lambda file, args, env: None)
+    monkeypatch.setattr(id.__main__.os, "execvpe", execvpe)
+    monkeypatch.setattr(id.__main__.sys, "platform", "linux")
+
+    main(["exec", "-a", "sigstore", "--name", "sigstore=TOKEN", "--", "twine", "-a", "--", "x"])
+
+    ((file, args, env),) = [call.args for call in execvpe.calls]
+    assert (file, args) == ("twine", ["twine", "-a", "--", "x"])
+    assert env["TOKEN"] == tokens["sigstore"]
+    assert env["PATH"] == os.environ["PATH"]
+
+
+def test_exec_requires_command(capsys, tokens):
+    with pytest.raises(SystemExit):
+        main(["exec", "-a", "sigstore"])
+    assert "a command to run is required" in capsys.readouterr().err
+
+
+def test_profile_flag(tmp_path, capsys, tokens):
+    path = tmp_path / "id.pstats"
+    main(["-f", "json", "--profile", str(path), "--profile-memory", "sigstore"])
+
+    captured = capsys.readouterr()
+    assert json.loads(captured.out) == {"sigstore": tokens["sigstore"]}
+    assert f"profile written to {path}" in captured.err
+    assert "allocation sites" in captured.err
+    assert any(func[2] == "_main" for func in pstats.Stats(str(path)).stats)
+
+
+def test_profile_mints_on_threads(monkeypatch, tmp_path, capsys, tokens):
+    def detect(audience, **options):
+        return tokens.get(audience)
+
+    monkeypatch.setattr(id, "_detect_credential", detect)
+    path = tmp_path / "id.pstats"
+    audiences = ["sigstore", "https://example.com/?a=b"]
+    # Each audience is minted on a thread of its own, and profiled there:
+    # prefetched by the session, or with custom claims, by the CLI itself.
+    for options in [[], ["--claim", "n=1"]]:
+        main(["--profile", str(path), *options, *audiences])
+        assert any(func[2] == "detect" for func in pstats.Stats(str(path)).stats)
+        path.unlink()
+
+
+@pytest.mark.parametrize("argv", [["--profile"], ["--profile", "--profile-memory"], ["--profile="]])
+def test_profile_requires_path(capsys, argv):
+    with pytest.raises(SystemExit) as e:
+        main(argv)
+    assert e.value.code == 2
+    assert "--profile: expected a PATH" in capsys.readouterr().err
+
+
+def test_profile_environment(monkeypatch, tmp_path, capsys, tokens):
+    path = tmp_path / "id.pstats"
+    monkeypatch.setenv("ID_PROFILE", str(path))
+    execvpe = pretend.call_recorder(lambda file, args, env: None)
+    monkeypatch.setattr(id.__main__.os, "execvpe", execvpe)
+    run = pretend.call_recorder(lambda command, env: pretend.stub(returncode=3))
+    monkeypatch.setattr(id.__main__.subprocess, "run", run)
+
+    # The command's `--profile` is left alone, and it runs as a child so that
+    # the profile is still written.
+    with pytest.raises(SystemExit) as e:
+        main(["exec", "-a", "sigstore", "--", "cmd", "--profile", "x"])
+    assert e.value.code == 3
+    assert run.calls[0].args == (["cmd", "--profile", "x"],)
+    assert execvpe.calls == []
+    assert path.exists()
+
+
+def test_custom_claims(monkeypatch, capsys, make_token):
+    monkeypatch.setattr(id, "_default_session", _DefaultSession())
+    calls = []
+
+    def _detect_credential(audience, **options):
+        calls.append((audience, options))
+        return make_token(audience, time.time() + 300)
+
+    monkeypatch.setattr(id, "_detect_credential", _detect_credential)
+
+    main(["--claim", "n=1", "--claim", "repo=a/b", "--circleci-org-issuer", "x", "y"])
+    assert len(capsys.readouterr().out.splitlines()) == 2
+    options = {"claims": {"n": 1, "repo": "a/b"}, "circleci_root_issuer": False}
+    assert sorted(calls) == [("x", options), ("y", options)]
+
+    with pytest.raises(SystemExit):
+        main(["--claim", "aud=z", "x"])
+    assert "can't set `aud`" in capsys.readouterr().err
+
+
+def test_timeouts_file(monkeypatch, capsys, tmp_path, tokens):
+    path = tmp_path / "latencies.json"
+    path.write_text(json.dumps({"endpoints": {"https://example.com": [0.25]}}))
+    monkeypatch.setenv("ID_TIMEOUTS_FILE", str(path))
+
+    main(["sigstore"])
+    assert capsys.readouterr().out.strip() == tokens["sigstore"]
+    timeouts = id._default_session._config.timeouts
+    assert timeouts.path == str(path)
+    assert timeouts.stats()["https://example.com"]["samples"] == 1
+    assert json.loads(path.read_text()) == {"endpoints": {"https://example.com": [0.25]}}
+
+
+@pytest.mark.parametrize(
+    "args",
+    [["sigstore"], ["sigstore", "pypi"], ["--claim", "n=1", "sigstore", "pypi"]],
+)
+def test_record_and_replay(monkeypatch, capsys, tmp_path, github, make_token, args):
+    audiences = [arg for arg in args if arg in {"sigstore", "pypi"}]
+    tokens = {audience: make_token(audience, time.time() + 300) for audience in audiences}
+
+    def request(method, url, **kw):
+        (audience,) = [tokens[a] for a in tokens if f"audience={a}" in url]
+        body = json.dumps({"value": audience}).encode()
+        return urllib3.HTTPResponse(body=io.BytesIO(body), status=200, preload_content=False)
+
+    monkeypatch.setattr(ambient.urllib3, "request", request)
+    monkeypatch.setattr(ambient.shutil, "which", lambda bin: None)
+    path = tmp_path / "cassette.json"
+
+    monkeypatch.setattr(id, "_default_session", _DefaultSession())
+    monkeypatch.setenv("ID_RECORD", str(path))
+    main(["-f", "json", *args])
+    assert json.loads(capsys.readouterr().out) == tokens
+    requests = [i for i in json.loads(path.read_text())["interactions"] if i["kind"] == "http"]
+    assert len(requests) == len(audiences)
+
+    # Replayed without GitHub Actions, or the network.
+    monkeypatch.delenv("ID_RECORD")
+    for var in ("GITHUB_ACTIONS", "ACTIONS_ID_TOKEN_REQUEST_TOKEN", "ACTIONS_ID_TOKEN_REQUEST_URL"):
+        monkeypatch.delenv(var)
+    monkeypatch.setattr(ambient.urllib3, "request", pretend.raiser(AssertionError("online")))
+    monkeypatch.setattr(id, "_default_session", _DefaultSession())
+    monkeypatch.setenv("ID_REPLAY", str(path))
+    main(["-f", "json", *args])
+    assert json.loads(capsys.readouterr().out) == tokens
@@ -0,0 +1,83 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+import pretend
+import pytest
+
+import id
+from id import AmbientCredentialError, detect_credential, prefetch
+from id._internal.session import _DefaultSession
+
+
+@pytest.fixture(autouse=True)
+def prefetch_state(monkeypatch):
+    monkeypatch.setattr(id, "_default_session", _DefaultSession())
+
+
+def test_prefetch_serves_detect_credential(monkeypatch, make_token):
+    token = make_token("aud", time.time() + 300)
+    _detect_credential = pretend.call_recorder(lambda audience: token)
+    monkeypatch.setattr(id, "_detect_credential", _detect_credential)
+
+    assert prefetch(["aud"])["aud"].result() == token
+    assert detect_credential("aud") == token
+    assert detect_credential("aud") == token
+    assert _detect_credential.calls == [pretend.call("aud")]
+
+    # An already-prefetched audience isn't minted again.
+    assert prefetch(["aud"])["aud"].result() == token
+    assert _detect_credential.calls == [pretend.call("aud")]
+
+
+def test_prefetch_in_flight(monkeypatch, make_token):
+    token = make_token("aud", time.time() + 300)
+    release = threading.Event()
+
+    def _detect_credential(audience):
+        release.wait()
+        return token
+
+    monkeypatch.setattr(id, "_detect_credential", _detect_credential)
+
+    future = prefetch(["aud"])["aud"]
+    assert prefetch(["aud"])["aud"] is future
+
+    # detect_credential waits on the in-flight prefetch rather than minting.
+    threading.Timer(0.05, release.set).start()
+    assert detect_credential("aud") == token
+
+
+def test_prefetch_error(monkeypatch):
+    monkeypatch.setattr(
+        id, "_detect_credential", pretend.raiser(AmbientCredentialError("GitHub: boom"))
+    )
+
+    future = prefetch(["aud"])["aud"]
+    with pytest.raises(AmbientCredentialError, match="GitHub: boom"):
+        future.result()
+    with pytest.raises(AmbientCredentialError, match="GitHub: boom"):
+        detect_credential("aud")
+
+
+def test_prefetch_without_expiry_not_cached(monkeypatch):
+    token = "e30.eyJhdWQiOiAiYXVkIn0.sig"
+    _detect_credential = pretend.call_recorder(lambda audience: token)
+    monkeypatch.setattr(id, "_detect_credential", _detect_credential)
+
+    assert prefetch(["aud"])["aud"].result() == token
+    assert detect_credential("aud") == token
+    assert len(_detect_credential.calls) == 2
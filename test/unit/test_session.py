@@ -0,0 +1,335 @@
+# Copyright 2022 The Sigstore Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import json
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pretend
+import pytest
+import urllib3
+
+import id
+from id import Session
+from id._internal.cache import TokenCache
+from id._internal.oidc import ambient
+from id._internal.session import _DefaultSession
+
+
+def test_session_uses_own_pool(monkeypatch, github, make_token):
+    token = make_token("aud", time.time() + 300)
+    resp = urllib3.HTTPResponse(
+        body=io.BytesIO(json.dumps({"value": token}).encode()), status=200, preload_content=False
+    )
+    monkeypatch.setattr(ambient.urllib3, "request", pretend.raiser(AssertionError("global pool")))
+
+    with Session() as session:
+        pool = session._config.pool
+        monkeypatch.setattr(pool, "request", pretend.call_recorder(lambda *a, **kw: resp))
+        assert session.detect_credential("aud") == token
+
+    assert pool.request.calls == [
+        pretend.call(
+            "GET",
+            "https://fakeurl/token?audience=aud",
+            fields=None,
+            headers={"Authorization": "bearer faketoken"},
+            timeout=30,
+            preload_content=False,
+        )
+    ]
+
+
+def test_sessions_are_isolated(monkeypatch, make_token):
+    breaker = id.CircuitBreaker()
+    a = Session(circuit_breaker=breaker)
+    b = Session()
+
+    assert a._config.circuit_breaker is breaker
+    assert b._config.circuit_breaker is None
+    assert id._default_session._config.circuit_breaker is None
+    assert a._config.pool is not b._config.pool
+
+    token = make_token("aud", time.time() + 300)
+    _detect_credential = pretend.call_recorder(lambda audience: token)
+    monkeypatch.setattr(id, "_detect_credential", _detect_credential)
+
+    assert a.prefetch(["aud"])["aud"].result() == token
+    assert a.detect_credential("aud") == token
+    assert len(_detect_credential.calls) == 1
+
+    # Prefetched credentials belong to the session that prefetched them.
+    assert b.detect_credential("aud") == token
+    assert len(_detect_credential.calls) == 2
+
+    a.close()
+    b.close()
+
+
+def test_session_config_active_during_detection(monkeypatch):
+    breaker = id.CircuitBreaker()
+    seen = []
+    monkeypatch.setattr(
+        id, "_detect_credential", lambda audience: seen.append(ambient._current_config())
+    )
+
+    with Session(circuit_breaker=breaker) as session:
+        session.detect_credential("aud")
+        session.prefetch(["other"])["other"].result()
+
+    assert [config.circuit_breaker for config in seen] == [breaker, breaker]
+    assert ambient._current_config() is id._default_session._config
+
+
+def test_session_closed():
+    session = Session()
+    session.close()
+
+    with pytest.raises(RuntimeError, match="session is closed"):
+        session.detect_credential("aud")
+    with pytest.raises(RuntimeError, match="session is closed"):
+        session.prefetch(["aud"])
+
+
+def test_prefetch_racing_close():
+    session = Session()
+
+    def get(key):
+        # `close` runs while `prefetch` reads the cache, outside the lock.
+        session.close()
+        return None
+
+    session._cache = pretend.stub(get=get, clear=lambda: None)
+    with pytest.raises(RuntimeError, match="session is closed"):
+        session.prefetch(["aud"])
+    assert session._executor is None
+
+
+def test_sessions_share_cache_backend(monkeypatch, tmp_path, make_token):
+    token = make_token("aud", time.time() + 300)
+    _detect_credential = pretend.call_recorder(lambda audience: token)
+    monkeypatch.setattr(id, "_detect_credential", _detect_credential)
+
+    # Two sessions on one SQLite cache stand in for two runners on one host.
+    with Session(cache=id.SqliteTokenCache(tmp_path / "cache.db", plaintext=True)) as a:
+        assert a.detect_credential("aud") == token
+    with Session(cache=id.SqliteTokenCache(tmp_path / "cache.db", plaintext=True)) as b:
+        assert b.detect_credential("aud") == token
+
+    assert _detect_credential.calls == [pretend.call("aud")]
+
+
+def test_refresh_serves_fresh_credential(monkeypatch, make_token):
+    token = make_token("aud", time.time() + 300)
+    _detect_credential = pretend.call_recorder(lambda audience: token)
+    monkeypatch.setattr(id, "_detect_credential", _detect_credential)
+
+    with Session(refresh=id.RefreshPolicy(soft=120, hard=30)) as session:
+        assert session.detect_credential("aud") == token
+        assert session.detect_credential("aud") == token
+        assert session._prefetching == {}
+
+    assert _detect_credential.calls == [pretend.call("aud")]
+
+
+def test_refresh_stale_credential_revalidated_once(monkeypatch, make_token):
+    stale, fresh = make_token("aud", time.time() + 100), make_token("aud", time.time() + 300)
+    release = threading.Event()
+    calls = []
+
+    def _detect_credential(audience):
+        calls.append(audience)
+        if len(calls) == 1:
+            return stale
+        release.wait(5)
+        return fresh
+
+    monkeypatch.setattr(id, "_detect_credential", _detect_credential)
+
+    with Session(refresh=id.RefreshPolicy(soft=120, hard=30)) as session:
+        assert session.detect_credential("aud") == stale
+
+        # Past the soft threshold, the stale credential is served immediately
+        # while a single refresh runs in the background.
+        assert [session.detect_credential("aud") for _ in range(5)] == [stale] * 5
+        pending = session._prefetching["aud"]
+        release.set()
+        assert pending.result() == fresh
+
+        assert session.detect_credential("aud") == fresh
+
+    assert calls == ["aud", "aud"]
+
+
+def test_refresh_failure_serves_previous(monkeypatch, caplog, make_token):
+    stale = make_token("aud", time.time() + 100)
+    _detect_credential = pretend.call_recorder(lambda audience: stale)
+    monkeypatch.setattr(id, "_detect_credential", _detect_credential)
+
+    with Session(refresh=id.RefreshPolicy(soft=120, hard=30)) as session:
+        assert session.detect_credential("aud") == stale
+
+        monkeypatch.setattr(
+            id, "_detect_credential", pretend.raiser(id.AmbientCredentialError("issuer down"))
+        )
+        assert session.detect_credential("aud") == stale
+        deadline = time.monotonic() + 5
+        while "background refresh" not in caplog.text and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert session.detect_credential("aud") == stale
+
+    assert "background refresh for 'aud' failed" in caplog.text
+    assert "issuer down" in caplog.text
+
+
+def test_refresh_past_hard_threshold(monkeypatch, make_token):
+    token = make_token("aud", time.time() + 20)
+    _detect_credential = pretend.call_recorder(lambda audience: token)
+    monkeypatch.setattr(id, "_detect_credential", _detect_credential)
+
+    with Session(refresh=id.RefreshPolicy(soft=120, hard=30)) as session:
+        assert session.detect_credential("aud") == token
+        assert session.detect_credential("aud") == token
+
+    assert len(_detect_credential.calls) == 2
+
+
+def test_configure_refresh(monkeypatch):
+    monkeypatch.setattr(id, "_default_session", _DefaultSession())
+    policy = id.RefreshPolicy()
+
+    id.configure(refresh=policy)
+    assert id._default_session._refresh is policy
+    id.configure(hedging=None)
+    assert id._default_session._refresh is policy
+    id.configure(refresh=None)
+    assert id._default_session._refresh is None
+
+
+@pytest.mark.parametrize(("soft", "hard"), [(10, 20), (10, -1)])
+def test_refresh_policy_invalid(soft, hard):
+    with pytest.raises(ValueError):
+        id.RefreshPolicy(soft=soft, hard=hard)
+
+
+def test_shared_cache_scoped_to_identity(monkeypatch, tmp_path, make_token):
+    tokens = iter([make_token("pypi", time.time() + 300), make_token("pypi", time.time() + 301)])
+    _detect_credential = pretend.call_recorder(lambda audience: next(tokens))
+    monkeypatch.setattr(id, "_detect_credential", _detect_credential)
+
+    # Two jobs on one persistent runner, minting for the same audience.
+    monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_URL", "https://example.com/run/1")
+    with Session(cache=id.SqliteTokenCache(tmp_path / "cache.db", plaintext=True)) as a:
+        first = a.detect_credential("pypi")
+    monkeypatch.setenv("ACTIONS_ID_TOKEN_REQUEST_URL", "https://example.com/run/2")
+    with Session(cache=id.SqliteTokenCache(tmp_path / "cache.db", plaintext=True)) as b:
+        second = b.detect_credential("pypi")
+
+    assert first != second
+    assert len(_detect_credential.calls) == 2
+
+
+def test_import_is_lazy():
+    # `import id` shouldn't load the networking, caching or archive machinery
+    # until something that needs it is used.
+    code = (
+        "import sys, id\n"
+        "heavy = {'urllib3', 'sqlite3', 'http.server', 'mmap', 'concurrent.futures'}\n"
+        "print(sorted(heavy & set(sys.modules)))\n"
+        "id.TokenArchive, id.Session, id._default_session\n"
+        "print('id._internal.session' in sys.modules)\n"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    ).stdout
+    assert output.splitlines() == ["[]", "True"]
+
+
+def test_unknown_attribute():
+    with pytest.raises(AttributeError, match="has no attribute 'nope'"):
+        id.nope
+
+
+def test_claims_cached_by_canonical_claims(monkeypatch, make_token):
+    calls = []
+
+    def _detect_credential(audience, **options):
+        calls.append(options)
+        return make_token(audience, time.time() + 300)
+
+    monkeypatch.setattr(id, "_detect_credential", _detect_credential)
+    session = Session()
+
+    first = session.detect_credential("aud", claims={"a": 1, "b": 2})
+    assert session.detect_credential("aud", claims={"b": 2, "a": 1}) == first
+    assert calls == [{"claims": {"a": 1, "b": 2}, "circleci_root_issuer": True}]
+
+    # Another claim set, or the organization's issuer, is minted separately.
+    session.detect_credential("aud", claims={"a": 2})
+    session.detect_credential("aud", claims={"a": 2}, circleci_root_issuer=False)
+    session.detect_credential("aud", circleci_root_issuer=False)
+    assert len(calls) == 4
+    assert calls[-1] == {"claims": {}, "circleci_root_issuer": False}
+
+    # Plain requests don't see credentials minted with custom claims.
+    session.detect_credential("aud")
+    assert len(calls) == 5
+
+
+def test_tenants_minted_with_own_env(monkeypatch, tmp_path, make_token):
+    calls = []
+
+    def _detect_credential(audience, *, env=None, **options):
+        calls.append(env)
+        return make_token(audience, time.time() + 300)
+
+    monkeypatch.setattr(id, "_detect_credential", _detect_credential)
+    tenants = [{"ACTIONS_ID_TOKEN_REQUEST_URL": f"https://example.com/run/{i}"} for i in range(8)]
+
+    with Session(cache=id.SqliteTokenCache(tmp_path / "cache.db", plaintext=True)) as session:
+        with ThreadPoolExecutor(len(tenants)) as pool:
+            first = list(pool.map(lambda env: session.detect_credential("aud", env=env), tenants))
+        assert len(set(first)) == len(tenants)
+        assert sorted(calls, key=str) == sorted(tenants, key=str)
+
+        # Each tenant's credential is cached under its own identity, and the
+        # process environment's is separate again.
+        assert [session.detect_credential("aud", env=env) for env in tenants] == first
+        assert session.detect_credential("aud") not in first
+        assert len(calls) == len(tenants) + 1
+        assert calls[-1] is None
+
+    # Without a cache backend, tenants' credentials aren't kept around.
+    with Session() as session:
+        session.detect_credential("aud", env=tenants[0])
+        session.detect_credential("aud", env=tenants[0])
+    assert len(calls) == len(tenants) + 3
+
+
+@pytest.mark.parametrize(
+    "cache", [TokenCache, lambda: id.SqliteTokenCache(":memory:", plaintext=True)]
+)
+def test_tenants_differing_only_in_credentials(monkeypatch, make_token, cache):
+    # Two GitLab tenants with the same job ID; only the token variable differs.
+    monkeypatch.delenv("GITLAB_CI", raising=False)
+    tokens = [make_token("pypi", time.time() + 300 + i) for i in range(2)]
+    tenants = [{"GITLAB_CI": "1", "CI_JOB_ID": "1", "PYPI_ID_TOKEN": token} for token in tokens]
+
+    with Session(cache=cache()) as session:
+        assert [session.detect_credential("pypi", env=env) for env in tenants] == tokens
+        assert [session.detect_credential("pypi", env=env) for env in tenants] == tokens